@@ -0,0 +1,162 @@
+"""Аналитика по истории курсов на NumPy
+
+История загружается из SQLite одним запросом в матрицу "интервалы x валюты"
+(курс за единицу номинала), все расчёты выполняются над столбцами целиком.
+Пропуски (NaN) заполняются последним известным значением.
+"""
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+from controllers.databasecontr import HISTORY_STEPS
+
+
+class RateMatrix(NamedTuple):
+    """Курсы валют на равномерной сетке времени"""
+    codes: List[str]
+    ids: np.ndarray
+    ts: np.ndarray
+    values: np.ndarray
+
+    def column(self, code: str) -> np.ndarray:
+        return self.values[:, self.codes.index(code)]
+
+
+def forward_fill(values: np.ndarray) -> np.ndarray:
+    """Замена NaN последним предыдущим значением по оси времени"""
+    mask = np.isnan(values)
+    if not mask.any():
+        return values
+    index = np.where(mask, 0, np.arange(len(values))[:, None])
+    np.maximum.accumulate(index, axis=0, out=index)
+    filled = values[index, np.arange(values.shape[1])]
+    # До первого известного значения остаётся NaN
+    filled[np.minimum.accumulate(mask, axis=0)] = np.nan
+    return filled
+
+
+def load_rate_matrix(db, step: str = 'day', start: Optional[float] = None,
+                     end: Optional[float] = None) -> RateMatrix:
+    """Загрузка истории всех валют в матрицу одним запросом к БД
+
+    На каждый интервал step берётся последний курс интервала.
+    """
+    codes_by_id = {row['id']: row['char_code'] for row in db.read_currencies()}
+    data = np.array(db.read_history_points(start, end), dtype=float).reshape(-1, 3)
+    # Валюты без строки в currency (удалённые) не показываются
+    data = data[np.isin(data[:, 0], list(codes_by_id))]
+    if not len(data):
+        return RateMatrix([], np.empty(0, int), np.empty(0), np.empty((0, 0)))
+
+    size, offset = HISTORY_STEPS[step]
+    buckets = (data[:, 1] + offset) // size
+    # Точки упорядочены по (currency_id, ts): последняя точка интервала -
+    # та, за которой идёт другая валюта или другой интервал
+    last = np.ones(len(data), dtype=bool)
+    last[:-1] = (data[1:, 0] != data[:-1, 0]) | (buckets[1:] != buckets[:-1])
+    data, buckets = data[last], buckets[last]
+
+    ids, columns = np.unique(data[:, 0].astype(int), return_inverse=True)
+    first = buckets.min()
+    rows = (buckets - first).astype(int)
+    values = np.full((rows.max() + 1, len(ids)), np.nan)
+    values[rows, columns] = data[:, 2]
+
+    ts = (first + np.arange(len(values))) * size - offset
+    return RateMatrix([codes_by_id[i] for i in ids.tolist()], ids, ts, forward_fill(values))
+
+
+def _window_sums(values: np.ndarray, window: int):
+    """Суммы по скользящему окну и число известных значений в нём
+
+    Строка i соответствует окну, заканчивающемуся на строке i + window - 1.
+    """
+    known = np.isfinite(values)
+    zeros = np.zeros((1,) + values.shape[1:])
+    sums = np.concatenate([zeros, np.cumsum(np.where(known, values, 0), axis=0)])
+    counts = np.concatenate([zeros, np.cumsum(known, axis=0)])
+    return sums[window:] - sums[:-window], counts[window:] - counts[:-window]
+
+
+def moving_average(values: np.ndarray, window: int) -> np.ndarray:
+    """Скользящее среднее за window интервалов
+
+    Там, где в окне есть пропуски (в том числе первые window-1 строк), - NaN.
+    """
+    if window < 1:
+        raise ValueError('Окно должно быть положительным')
+    result = np.full(values.shape, np.nan)
+    if len(values) < window:
+        return result
+    sums, counts = _window_sums(values, window)
+    result[window - 1:] = np.where(counts == window, sums / window, np.nan)
+    return result
+
+
+def percent_change(values: np.ndarray, periods: int = 1) -> np.ndarray:
+    """Изменение в процентах относительно значения periods интервалов назад"""
+    result = np.full(values.shape, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result[periods:] = (values[periods:] / values[:-periods] - 1) * 100
+    return result
+
+
+def log_returns(values: np.ndarray) -> np.ndarray:
+    """Логарифмические доходности между соседними интервалами"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.diff(np.log(values), axis=0)
+
+
+def rolling_volatility(values: np.ndarray, window: int) -> np.ndarray:
+    """Стандартное отклонение лог-доходностей за window интервалов
+
+    Строка i относится к доходностям, закончившимся на интервале i.
+    """
+    if window < 2:
+        raise ValueError('Окно должно быть не меньше 2')
+    returns = log_returns(values)
+    result = np.full(values.shape, np.nan)
+    if len(returns) < window:
+        return result
+    # Окна - представления без копирования; отклонения считаются от среднего
+    # окна, а не через сумму квадратов, чтобы не терять точность
+    windows = np.lib.stride_tricks.sliding_window_view(returns, window, axis=0)
+    result[window:] = windows.std(axis=-1, ddof=1)
+    return result
+
+
+def correlation_matrix(values: np.ndarray) -> np.ndarray:
+    """Корреляция лог-доходностей валют по интервалам без пропусков"""
+    returns = log_returns(values)
+    returns = returns[np.isfinite(returns).all(axis=1)]
+    if len(returns) < 2:
+        return np.full((values.shape[1], values.shape[1]), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.corrcoef(returns, rowvar=False).reshape(values.shape[1], values.shape[1])
+
+
+def to_json(values: np.ndarray) -> List[Any]:
+    """Массив в список для JSON: NaN и бесконечности заменяются на None"""
+    result = np.round(values, 6).astype(object)
+    result[~np.isfinite(values)] = None
+    return result.tolist()
+
+
+def summary(matrix: RateMatrix, window: int = 30) -> Dict[str, Dict[str, Any]]:
+    """Последние значения показателей по каждой валюте"""
+    if not matrix.codes:
+        return {}
+    last = matrix.values[-1]
+    averages = moving_average(matrix.values, window)[-1]
+    volatility = rolling_volatility(matrix.values, window)[-1] if window >= 2 \
+        else np.full(len(last), np.nan)
+    change = percent_change(matrix.values)[-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        first_known = matrix.values[np.argmax(~np.isnan(matrix.values), axis=0),
+                                    np.arange(len(matrix.codes))]
+        period_change = (last / first_known - 1) * 100
+    columns = zip(*(to_json(column) for column in
+                    (last, averages, volatility, change, period_change)))
+    return {code: dict(zip(('last', 'moving_average', 'volatility', 'change',
+                            'period_change'), values))
+            for code, values in zip(matrix.codes, columns)}
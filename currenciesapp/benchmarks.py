@@ -0,0 +1,696 @@
+"""Нагрузочные замеры приложения
+
+Запуск: python benchmarks.py <сценарий> [параметры]
+"""
+import argparse
+import http.client
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROUTES = ['/', '/users', '/user?id=1', '/currencies', '/currencies/admin']
+# Маршруты, каждый запрос к которым без кэша страниц читает SQLite
+DB_ROUTES = ['/users', '/user?id=1', '/currencies/admin', '/api/v1/users?limit=50']
+
+
+def _quiet_handler():
+    """Обработчик приложения без вывода журнала запросов в stderr"""
+    import myapp
+
+    class QuietHandler(myapp.SimpleHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    return QuietHandler
+
+
+def _simulate_upstream(delay: float):
+    """Подмена запроса к ЦБ РФ задержкой фиксированной длины"""
+    import myapp
+
+    def fake_get_currencies(codes):
+        time.sleep(delay)
+        return {code: 1.0 for code in codes}
+
+    myapp.get_currencies = fake_get_currencies
+
+
+def _fire(host: str, port: int, requests_total: int, clients: int, routes=ROUTES,
+          keep_alive: bool = False) -> float:
+    """Отправка запросов параллельными клиентами, возвращает запросов в секунду
+
+    При keep_alive каждый клиент использует одно соединение для всех
+    своих запросов, иначе открывает новое на каждый запрос.
+    """
+    def client(index, n):
+        conn = http.client.HTTPConnection(host, port, timeout=30)
+        for i in range(index, index + n):
+            headers = {} if keep_alive else {'Connection': 'close'}
+            conn.request('GET', routes[i % len(routes)], headers=headers)
+            conn.getresponse().read()
+            if not keep_alive:
+                conn.close()
+        conn.close()
+
+    per_client = max(1, requests_total // clients)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(client, range(clients), [per_client] * clients))
+    return per_client * clients / (time.perf_counter() - started)
+
+
+def bench_threaded(args):
+    """Пропускная способность пула потоков в зависимости от числа рабочих
+
+    По умолчанию БД - файл в режиме WAL, как у сервера: читатели работают на
+    своих соединениях параллельно. С --db memory все обращения к SQLite
+    выполняются под одной общей блокировкой: рабочие потоки ускоряют только
+    ожидание сети, а запросы к БД идут по одному. --routes db отключает кэш
+    страниц, чтобы каждый запрос читал БД.
+    """
+    import myapp
+    from servers import ThreadPoolHTTPServer
+
+    _simulate_upstream(args.upstream_delay)
+    handler = _quiet_handler()
+    routes = DB_ROUTES if args.routes == 'db' else ROUTES
+    cache = myapp.app.cache
+    if args.routes == 'db':
+        myapp.app.cache = None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        myapp.configure_database(':memory:' if args.db == 'memory'
+                                 else os.path.join(tmp, 'currencies.db'))
+        try:
+            for workers in args.workers:
+                httpd = ThreadPoolHTTPServer(('127.0.0.1', 0), handler, workers=workers,
+                                             queue_size=args.clients * 2)
+                thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+                thread.start()
+                rps = _fire('127.0.0.1', httpd.server_address[1], args.requests,
+                            args.clients, routes)
+                httpd.shutdown()
+                httpd.server_close()
+                print(f'db={args.db:<6} routes={args.routes:<5} workers={workers:<3} '
+                      f'{rps:10.1f} req/s')
+        finally:
+            myapp.app.cache = cache
+            myapp.db_controller.close()
+
+
+def bench_keepalive(args):
+    """Запросов в секунду с постоянными соединениями и без них"""
+    from servers import ThreadPoolHTTPServer
+
+    handler = _quiet_handler()
+    routes = ['/author', '/users', '/currencies/admin']
+
+    httpd = ThreadPoolHTTPServer(('127.0.0.1', 0), handler, workers=args.clients,
+                                 queue_size=args.clients * 2)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        for keep_alive in (False, True):
+            rps = _fire('127.0.0.1', httpd.server_address[1], args.requests, args.clients,
+                        routes, keep_alive=keep_alive)
+            print(f'keep-alive={"on " if keep_alive else "off"} {rps:10.1f} req/s')
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def bench_prefork(args):
+    """Пропускная способность в зависимости от числа рабочих процессов"""
+    import myapp
+    from servers import PreforkSupervisor, ThreadPoolHTTPServer
+
+    _simulate_upstream(args.upstream_delay)
+    handler = _quiet_handler()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        myapp.configure_database(os.path.join(tmp, 'currencies.db'))
+
+        def make_server(address, handler_class, bind_and_activate=True):
+            return ThreadPoolHTTPServer(address, handler_class, workers=args.threads,
+                                        queue_size=args.clients * 2,
+                                        bind_and_activate=bind_and_activate)
+
+        for processes in args.processes:
+            supervisor = PreforkSupervisor(make_server, handler, ('127.0.0.1', 0),
+                                           processes=processes,
+                                           after_fork=lambda slot: myapp.db_controller.after_fork())
+            supervisor.start()
+            time.sleep(0.5)
+            try:
+                rps = _fire('127.0.0.1', supervisor.server_address[1], args.requests,
+                            args.clients)
+            finally:
+                supervisor.stop()
+            print(f'processes={processes:<3} {rps:10.1f} req/s  '
+                  f'per worker: {list(supervisor.counts)}')
+
+        myapp.db_controller.close()
+
+
+def bench_stream(args):
+    """Пик памяти и время до первого байта при полном и потоковом рендеринге
+
+    Шаблон рендерится напрямую и через Application.respond с кэшем страниц
+    (app-full, app-stream): во втором случае учитывается и накопление
+    потокового ответа для кэша.
+    """
+    import tracemalloc
+    import myapp
+    from models import User
+    from pagecache import PageCache
+    from routing import Application, Page, Request, Route, Router, encode_chunks
+
+    template = myapp.env.get_template('users.html')
+    for rows in args.users:
+        users = [User(i, f'Пользователь {i}') for i in range(1, rows + 1)]
+        context = dict(myapp.BASE_CONTEXT, users=users)
+
+        def full():
+            yield template.render(**context).encode('utf-8')
+
+        def stream():
+            return encode_chunks(template.generate(**context))
+
+        def application(streaming):
+            router = Router()
+            router.add(Route('/users', lambda request: Page('users.html', context), cache=True))
+            app = Application(router, myapp.env, cache=PageCache(), stream=streaming,
+                              data_state=lambda tables: ((), None))
+
+            def respond():
+                response = app.respond(Request('GET', '/users'))
+                return response.chunks if response.chunks is not None else [response.body]
+            return respond
+
+        for name, render in (('full', full), ('stream', stream),
+                             ('app-full', application(False)),
+                             ('app-stream', application(True))):
+            tracemalloc.start()
+            started = time.perf_counter()
+            first_byte = None
+            total = 0
+            for chunk in render():
+                if first_byte is None:
+                    first_byte = time.perf_counter() - started
+                total += len(chunk)
+            elapsed = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'users={rows:<8} {name:<10} body={total / 2 ** 20:7.2f} MB  '
+                  f'peak={peak / 2 ** 20:7.2f} MB  first byte={first_byte * 1000:8.2f} ms  '
+                  f'total={elapsed * 1000:8.1f} ms')
+
+
+def bench_bulk(args):
+    """Строк в секунду: построчные методы DatabaseController против пакетных"""
+    from controllers import DatabaseController
+
+    def measure(label, rows, operation):
+        started = time.perf_counter()
+        operation()
+        elapsed = time.perf_counter() - started
+        print(f'{label:<34} rows={rows:<8} {rows / elapsed:12.0f} rows/s')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = ':memory:' if args.db == 'memory' else os.path.join(tmp, 'bench.db')
+        db = DatabaseController(path)
+        n, m = args.rows, min(args.rows, args.per_row_rows)
+
+        def currency(i, value=1.0):
+            return {'num_code': f'{i % 1000:03d}', 'char_code': f'C{i:07d}',
+                    'name': f'Валюта {i}', 'value': value, 'nominal': 1}
+
+        measure('create_currency', m,
+                lambda: [db.create_currency(currency(i)) for i in range(m)])
+        measure('bulk_upsert_currencies (insert)', n,
+                lambda: db.bulk_upsert_currencies([currency(i) for i in range(m, m + n)]))
+        measure('bulk_upsert_currencies (update)', n,
+                lambda: db.bulk_upsert_currencies([currency(i, 2.0) for i in range(m, m + n)]))
+
+        measure('update_currency_value', m,
+                lambda: [db.update_currency_value(i, 3.0) for i in range(1, m + 1)])
+        measure('bulk_update_values', n,
+                lambda: db.bulk_update_values({f'C{i:07d}': 4.0 for i in range(m, m + n)}))
+
+        measure('create_user', m, lambda: [db.create_user(f'user{i}') for i in range(m)])
+        measure('bulk_create_users', n,
+                lambda: db.bulk_create_users(f'user{i}' for i in range(n)))
+
+        measure('add_user_subscription', m,
+                lambda: [db.add_user_subscription(i, 1) for i in range(1, m + 1)])
+        measure('bulk_add_subscriptions', n,
+                lambda: db.bulk_add_subscriptions((i, 2) for i in range(1, n + 1)))
+        db.close()
+
+
+class _LegacyCurrency:
+    """Прежнее представление Currency: атрибуты в __dict__ каждого объекта"""
+
+    def __init__(self, id=None, num_code='', char_code='', name='', value=0.0, nominal=1):
+        self.__id = id
+        self.__num_code = num_code
+        self.__char_code = char_code
+        self.__name = name
+        self.__value = value
+        self.__nominal = nominal
+
+
+def bench_hydrate(args):
+    """Загрузка таблицы currency в объекты: словари и from_dict против кортежей и from_row"""
+    import tracemalloc
+    from controllers import DatabaseController
+    from models import Currency
+
+    _LegacyCurrency.from_dict = classmethod(Currency.from_dict.__func__)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseController(os.path.join(tmp, 'bench.db'))
+        db.bulk_upsert_currencies(
+            {'num_code': f'{i % 1000:03d}', 'char_code': f'C{i:07d}', 'name': f'Валюта {i}',
+             'value': float(i), 'nominal': 1} for i in range(args.rows))
+
+        variants = [
+            ('dict', db.read_currencies, _LegacyCurrency.from_dict),
+            ('slots', db.read_currency_rows, Currency.from_row),
+        ]
+        print(f'{"":6} {"read":>10} {"hydrate":>10} {"objects/s":>12} {"objects":>10}')
+        for name, read, hydrate in variants:
+            started = time.perf_counter()
+            rows = read()
+            loaded = time.perf_counter()
+            objects = [hydrate(row) for row in rows]
+            elapsed = time.perf_counter() - loaded
+            read_time = loaded - started
+            del objects
+
+            # Память, которую занимают сами объекты (без строк выборки)
+            tracemalloc.start()
+            objects = [hydrate(row) for row in rows]
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del objects, rows
+            print(f'{name:6} {read_time * 1000:8.1f}ms {elapsed * 1000:8.1f}ms '
+                  f'{args.rows / elapsed:12.0f} {size / 2 ** 20:7.1f} MB')
+        db.close()
+
+
+def bench_paginate(args):
+    """Время страницы /users: вся таблица против страницы по курсору"""
+    import myapp
+    from routing import Request
+
+    def render(path):
+        started = time.perf_counter()
+        page = myapp.users(Request('GET', path))
+        myapp.env.get_template(page.template).render(page.context)
+        return time.perf_counter() - started
+
+    def render_all():
+        started = time.perf_counter()
+        users = myapp.user_controller.list_users()
+        subscriptions = myapp.user_controller.subscription_loader().load_many(
+            user.id for user in users)
+        myapp.env.get_template('users.html').render(
+            dict(myapp.BASE_CONTEXT, users=users, subscriptions=subscriptions))
+        return time.perf_counter() - started
+
+    with tempfile.TemporaryDirectory() as tmp:
+        myapp.configure_database(os.path.join(tmp, 'bench.db'))
+        total = 0
+        print(f'{"users":>8} {"first page":>12} {"middle page":>12} {"last page":>12} {"all":>10}')
+        for rows in args.users:
+            myapp.db_controller.bulk_create_users(f'user{i}' for i in range(total, rows))
+            total = rows
+            timings = [render(f'/users?limit={args.limit}'),
+                       render(f'/users?limit={args.limit}&cursor=after:{rows // 2}'),
+                       render(f'/users?limit={args.limit}&cursor=before:{rows + 3}')]
+            full = render_all() if rows <= args.max_full else None
+            print(f'{rows:>8} ' + ' '.join(f'{t * 1000:10.2f}ms' for t in timings) +
+                  (f' {full * 1000:8.1f}ms' if full is not None else f' {"-":>10}'))
+        myapp.db_controller.close()
+
+
+def bench_metrics(args):
+    """Стоимость записи метрик запроса: в отдельности и в обработке запроса"""
+    import myapp
+    from metrics import Metrics
+    from routing import Request, Response
+
+    metrics = Metrics()
+    response = Response(b'')
+
+    def record():
+        timer = metrics.request('GET')
+        timer.route = '/users'
+        started = time.perf_counter()
+        timer.phase('db', started)
+        timer.phase('render', started)
+        timer.finish(response)
+
+    for name, n, operation in (('inc', args.iterations, lambda: metrics.inc('jobs_total')),
+                               ('observe', args.iterations,
+                                lambda: metrics.observe('job_seconds', (), 0.003)),
+                               ('request', args.iterations, record)):
+        started = time.perf_counter()
+        for _ in range(n):
+            operation()
+        print(f'{name:<8} {(time.perf_counter() - started) / n * 1e9:8.0f} ns')
+
+    # Полная обработка запроса с метриками и без: из кэша страниц и с рендерингом
+    myapp.refresher.on_demand = False
+    page_cache = myapp.app.cache
+    for cached in (True, False):
+        myapp.app.cache = page_cache if cached else None
+        myapp.app.respond(Request('GET', '/users'))
+        for enabled in (False, True):
+            myapp.metrics.enabled = enabled
+            started = time.perf_counter()
+            for _ in range(args.requests):
+                myapp.app.respond(Request('GET', '/users'))
+            per_request = (time.perf_counter() - started) / args.requests
+            print(f'respond /users cached={"yes" if cached else "no":<3} '
+                  f'metrics={"on" if enabled else "off":<3} {per_request * 1e6:8.1f} us')
+    myapp.app.cache = page_cache
+
+
+def bench_logging(args):
+    """Стоимость декоратора logger: выключен, с выборкой, с записью в файл"""
+    import logging
+    import queue
+    from logging.handlers import QueueListener
+
+    from lab7 import DeferredQueueHandler, JsonLinesFormatter, logger
+
+    rates = {f'C{i:02d}': 70.0 + i for i in range(args.currencies)}
+
+    def work(codes):
+        return rates
+
+    def legacy(func, handle):
+        # Прежний декоратор: строки формируются в вызывающем потоке до и после вызова
+        def wrapper(*a, **kw):
+            handle.info(f"INFO: {func.__name__} called with args={a}, kwargs={kw}")
+            result = func(*a, **kw)
+            handle.info(f"INFO: {func.__name__} returned {result}")
+            return result
+        return wrapper
+
+    with tempfile.TemporaryDirectory() as tmp:
+        file_handler = logging.FileHandler(os.path.join(tmp, 'legacy.log'), encoding='utf-8')
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - '
+                                                    '%(message)s'))
+        legacy_log = logging.getLogger('bench.legacy')
+        legacy_log.propagate = False
+        legacy_log.addHandler(file_handler)
+        legacy_log.setLevel(logging.INFO)
+
+        target = logging.FileHandler(os.path.join(tmp, 'queued.log'), encoding='utf-8')
+        target.setFormatter(JsonLinesFormatter())
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, target)
+        log = logging.getLogger('bench.queued')
+        log.propagate = False
+        log.addHandler(DeferredQueueHandler(log_queue))
+        listener.start()
+
+        variants = (
+            ('plain', work, logging.INFO),
+            ('disabled', logger(work, handle=log), logging.WARNING),
+            (f'sample {args.sample:g}', logger(work, handle=log, sample=args.sample), logging.INFO),
+            ('queued', logger(work, handle=log), logging.INFO),
+            ('legacy', legacy(work, legacy_log), logging.INFO),
+        )
+        codes = list(rates)
+        for name, func, level in variants:
+            log.setLevel(level)
+            started = time.perf_counter()
+            for _ in range(args.calls):
+                func(codes)
+            elapsed = time.perf_counter() - started
+            # Время вызывающего потока; очередь дописывается отдельно
+            flushed = time.perf_counter()
+            listener.stop()
+            listener.start()
+            print(f'{name:<12} {elapsed / args.calls * 1e6:8.2f} us/call'
+                  f'  (дозапись очереди {time.perf_counter() - flushed:.2f} s)')
+        listener.stop()
+        target.close()
+        file_handler.close()
+
+
+def bench_ingest(args):
+    """Загрузка истории курсов из журнала: прежний формат и строки JSON"""
+    import json
+    import logingest
+    from controllers import DatabaseController
+
+    codes = ['USD', 'EUR', 'GBP', 'JPY']
+    with tempfile.TemporaryDirectory() as tmp:
+        log_path = os.path.join(tmp, 'currency_log.txt')
+        with open(log_path, 'w', encoding='utf-8') as f:
+            for i in range(args.lines):
+                ts = 1700000000 + i
+                rates = {code: round(70 + j + i % 1000 / 1000, 4) for j, code in enumerate(codes)}
+                if i % 2:
+                    f.write(json.dumps({'time': time.strftime('%Y-%m-%d %H:%M:%S,000',
+                                                              time.localtime(ts)),
+                                        'ts': ts, 'level': 'INFO', 'logger': 'currency',
+                                        'event': 'return', 'function': 'get_currencies',
+                                        'duration_ms': 1.0, 'args': repr((codes,)),
+                                        'kwargs': '{}', 'result': rates}) + '\n')
+                else:
+                    stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))
+                    f.write(f"{stamp},000 - currency - INFO - INFO: get_currencies called with "
+                            f"args=({codes},), kwargs={{}}\n")
+                    f.write(f"{stamp},000 - currency - INFO - INFO: get_currencies returned "
+                            f"{rates}\n")
+        size = os.path.getsize(log_path) / 2 ** 20
+
+        for workers in sorted({1, os.cpu_count() or 1}):
+            db = DatabaseController(os.path.join(tmp, f'ingest{workers}.db'))
+            db.seed_initial_data()
+            started = time.perf_counter()
+            stats = logingest.ingest(db, log_path, workers, int(args.chunk_mb * 2 ** 20))
+            elapsed = time.perf_counter() - started
+            print(f'workers={workers:<3} {size:7.1f} MB {stats.points:9d} точек '
+                  f'{elapsed:6.2f} s ({size / elapsed:6.1f} MB/s)')
+            # Повторный запуск читает только новые байты
+            started = time.perf_counter()
+            logingest.ingest(db, log_path, workers)
+            print(f'{"повторно":<11} {(time.perf_counter() - started) * 1000:6.1f} ms')
+            db.close()
+
+
+def _naive_analytics(series, window):
+    """Те же показатели, что в analytics, циклами на чистом Python"""
+    import math
+
+    results = {}
+    returns = {}
+    for code, values in series.items():
+        averages, volatility, changes = [], [], []
+        rets = [math.log(b / a) for a, b in zip(values, values[1:])]
+        for i in range(len(values)):
+            if i >= window - 1:
+                averages.append(sum(values[i - window + 1:i + 1]) / window)
+            if i >= window:
+                chunk = rets[i - window:i]
+                mean = sum(chunk) / window
+                volatility.append(math.sqrt(sum((r - mean) ** 2 for r in chunk) / (window - 1)))
+            if i:
+                changes.append((values[i] / values[i - 1] - 1) * 100)
+        results[code] = (averages, volatility, changes)
+        returns[code] = rets
+
+    codes = list(returns)
+    correlation = [[0.0] * len(codes) for _ in codes]
+    for i, a in enumerate(codes):
+        for j, b in enumerate(codes):
+            x, y = returns[a], returns[b]
+            mx, my = sum(x) / len(x), sum(y) / len(y)
+            cov = sum((p - mx) * (q - my) for p, q in zip(x, y))
+            var = math.sqrt(sum((p - mx) ** 2 for p in x) * sum((q - my) ** 2 for q in y))
+            correlation[i][j] = cov / var
+    return results, correlation
+
+
+def bench_analytics(args):
+    """Векторизованная аналитика (NumPy) против циклов на Python"""
+    import numpy as np
+    import analytics
+    from controllers import DatabaseController
+    from models import Currency
+
+    days = args.years * 365
+    rng = np.random.default_rng(1)
+    walk = 50 * np.exp(np.cumsum(rng.normal(0, 0.01, (days, args.currencies)), axis=0))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseController(os.path.join(tmp, 'bench.db'))
+        db.bulk_upsert_currencies(
+            {'num_code': f'{i:03d}', 'char_code': f'C{i:02d}', 'name': f'Валюта {i}',
+             'value': None, 'nominal': 1} for i in range(args.currencies))
+        ids = [row['id'] for row in db.read_currencies()]
+        db.bulk_add_history((ids[j], day * 86400.0, float(walk[day, j]), 1)
+                            for day in range(days) for j in range(args.currencies))
+        print(f'{days} days x {args.currencies} currencies = {days * args.currencies} points')
+
+        started = time.perf_counter()
+        series = {}
+        for currency_id in ids:
+            history = db.read_rate_history(currency_id)
+            currency = Currency.from_dict(db.read_currencies()[ids.index(currency_id)])
+            series[currency.char_code] = [row['value'] / row['nominal'] for row in history]
+        naive_load = time.perf_counter() - started
+        started = time.perf_counter()
+        _naive_analytics(series, args.window)
+        naive_compute = time.perf_counter() - started
+
+        started = time.perf_counter()
+        matrix = analytics.load_rate_matrix(db)
+        numpy_load = time.perf_counter() - started
+        started = time.perf_counter()
+        analytics.moving_average(matrix.values, args.window)
+        analytics.rolling_volatility(matrix.values, args.window)
+        analytics.percent_change(matrix.values)
+        analytics.correlation_matrix(matrix.values)
+        numpy_compute = time.perf_counter() - started
+        db.close()
+
+    print(f'{"":8} {"load":>10} {"compute":>10}')
+    print(f'{"python":8} {naive_load * 1000:8.1f}ms {naive_compute * 1000:8.1f}ms')
+    print(f'{"numpy":8} {numpy_load * 1000:8.1f}ms {numpy_compute * 1000:8.1f}ms')
+    print(f'speedup: load x{naive_load / numpy_load:.1f}, compute x{naive_compute / numpy_compute:.1f}')
+
+
+def bench_convert(args):
+    """Пакетный пересчёт сумм по матрице кросс-курсов"""
+    import numpy as np
+    from conversion import CrossRates
+
+    rng = np.random.default_rng(1)
+    codes = [f'{chr(65 + i // 26)}{chr(65 + i % 26)}X' for i in range(args.currencies)]
+    engine = CrossRates()
+    engine.build((code, float(rng.uniform(0.1, 200)), int(rng.choice([1, 10, 100])))
+                 for code in codes)
+
+    names = np.array(engine.codes)
+    source = names[rng.integers(0, len(names), args.amounts)]
+    target = names[rng.integers(0, len(names), args.amounts)]
+    amounts = rng.uniform(1, 1000, args.amounts)
+
+    started = time.perf_counter()
+    engine.convert(source, target, amounts)
+    by_code = time.perf_counter() - started
+
+    source_index, target_index = engine.resolve(source), engine.resolve(target)
+    started = time.perf_counter()
+    engine.convert_indices(source_index, target_index, amounts)
+    by_index = time.perf_counter() - started
+
+    started = time.perf_counter()
+    engine.update(codes[0], 42.0, 1)
+    update = time.perf_counter() - started
+    started = time.perf_counter()
+    engine.build((code, 1.0, 1) for code in codes)
+    rebuild = time.perf_counter() - started
+
+    print(f'{args.amounts} conversions, {len(names)} currencies')
+    print(f'by code:  {by_code * 1000:8.1f} ms')
+    print(f'by index: {by_index * 1000:8.1f} ms')
+    print(f'update one rate: {update * 1e6:8.1f} us, full rebuild: {rebuild * 1e6:8.1f} us')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Замеры производительности')
+    subparsers = parser.add_subparsers(dest='scenario', required=True)
+
+    threaded = subparsers.add_parser('threaded', help=bench_threaded.__doc__)
+    threaded.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    threaded.add_argument('--requests', type=int, default=200)
+    threaded.add_argument('--clients', type=int, default=16)
+    threaded.add_argument('--upstream-delay', type=float, default=0.05,
+                          help='имитируемая задержка ответа ЦБ РФ, с')
+    threaded.add_argument('--db', choices=['memory', 'file'], default='file',
+                          help="':memory:' под общей блокировкой или файл в режиме WAL")
+    threaded.add_argument('--routes', choices=['pages', 'db'], default='pages',
+                          help='страницы с кэшем или маршруты, читающие БД без кэша')
+    threaded.set_defaults(func=bench_threaded)
+
+    keepalive = subparsers.add_parser('keepalive', help=bench_keepalive.__doc__)
+    keepalive.add_argument('--requests', type=int, default=2000)
+    keepalive.add_argument('--clients', type=int, default=4)
+    keepalive.set_defaults(func=bench_keepalive)
+
+    prefork = subparsers.add_parser('prefork', help=bench_prefork.__doc__)
+    prefork.add_argument('--processes', type=int, nargs='+',
+                         default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    prefork.add_argument('--threads', type=int, default=4,
+                         help='рабочих потоков в каждом процессе')
+    prefork.add_argument('--requests', type=int, default=2000)
+    prefork.add_argument('--clients', type=int, default=16)
+    prefork.add_argument('--upstream-delay', type=float, default=0.0,
+                         help='имитируемая задержка ответа ЦБ РФ, с')
+    prefork.set_defaults(func=bench_prefork)
+
+    bulk = subparsers.add_parser('bulk', help=bench_bulk.__doc__)
+    bulk.add_argument('--rows', type=int, default=100000,
+                      help='строк в пакетных операциях')
+    bulk.add_argument('--per-row-rows', type=int, default=5000,
+                      help='строк в построчных операциях (они намного медленнее)')
+    bulk.add_argument('--db', choices=['file', 'memory'], default='file')
+    bulk.set_defaults(func=bench_bulk)
+
+    ingest = subparsers.add_parser('ingest', help=bench_ingest.__doc__)
+    ingest.add_argument('--lines', type=int, default=500000)
+    ingest.add_argument('--chunk-mb', type=float, default=32)
+    ingest.set_defaults(func=bench_ingest)
+
+    logging_ = subparsers.add_parser('logging', help=bench_logging.__doc__)
+    logging_.add_argument('--calls', type=int, default=200000)
+    logging_.add_argument('--sample', type=float, default=0.01)
+    logging_.add_argument('--currencies', type=int, default=40)
+    logging_.set_defaults(func=bench_logging)
+
+    metrics = subparsers.add_parser('metrics', help=bench_metrics.__doc__)
+    metrics.add_argument('--iterations', type=int, default=1000000)
+    metrics.add_argument('--requests', type=int, default=20000)
+    metrics.set_defaults(func=bench_metrics)
+
+    paginate = subparsers.add_parser('paginate', help=bench_paginate.__doc__)
+    paginate.add_argument('--users', type=int, nargs='+', default=[1000, 100000, 1000000])
+    paginate.add_argument('--limit', type=int, default=50)
+    paginate.add_argument('--max-full', type=int, default=100000,
+                          help='наибольшая таблица, которую читать целиком')
+    paginate.set_defaults(func=bench_paginate)
+
+    hydrate = subparsers.add_parser('hydrate', help=bench_hydrate.__doc__)
+    hydrate.add_argument('--rows', type=int, default=1000000)
+    hydrate.set_defaults(func=bench_hydrate)
+
+    analytics = subparsers.add_parser('analytics', help=bench_analytics.__doc__)
+    analytics.add_argument('--years', type=int, default=10)
+    analytics.add_argument('--currencies', type=int, default=50)
+    analytics.add_argument('--window', type=int, default=30)
+    analytics.set_defaults(func=bench_analytics)
+
+    convert = subparsers.add_parser('convert', help=bench_convert.__doc__)
+    convert.add_argument('--amounts', type=int, default=1000000)
+    convert.add_argument('--currencies', type=int, default=50)
+    convert.set_defaults(func=bench_convert)
+
+    stream = subparsers.add_parser('stream', help=bench_stream.__doc__)
+    stream.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000])
+    stream.set_defaults(func=bench_stream)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,5 +2,6 @@
 from .databasecontr import DatabaseController
 from .currencycontr import CurrencyController
 from .usercontr import UserController
+from .loaders import BatchLoader
 
-__all__ = ['DatabaseController', 'CurrencyController', 'UserController']
\ No newline at end of file
+__all__ = ['DatabaseController', 'CurrencyController', 'UserController', 'BatchLoader']
\ No newline at end of file
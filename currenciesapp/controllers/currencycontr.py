@@ -1,26 +1,39 @@
 
 from typing import List, Dict, Any, Optional
 from models.currency import Currency
+from controllers.databasecontr import KeysetPage
+from controllers.identitymap import IdentityMap
 
 
 class CurrencyController:
     """Контроллер для бизнес-логики валют"""
     
-    def __init__(self, db_controller):
+    def __init__(self, db_controller, identity_map_size: int = 1024):
         self.db = db_controller
+        # Валюты по id и char_code; сбрасывается при любом изменении currency
+        self.identity_map = IdentityMap(db_controller, 'currency', identity_map_size,
+                                        key=lambda currency: currency.char_code)
     
     def list_currencies(self) -> List[Currency]:
         """Получение списка всех валют"""
-        currencies_data = self.db.read_currencies()
-        return [Currency.from_dict(data) for data in currencies_data]
+        return [Currency.from_row(row) for row in self.db.read_currency_rows()]
     
+    def list_currencies_page(self, limit: int, cursor: Optional[str] = None,
+                             sort: Optional[str] = None) -> KeysetPage:
+        """Страница валют; ValueError при некорректных курсоре или сортировке"""
+        page = self.db.read_page('currency', limit, cursor, sort)
+        return page._replace(rows=[Currency.from_row(row) for row in page.rows])
+
     def get_currency(self, currency_id: int) -> Optional[Currency]:
         """Получение валюты по ID"""
-        currencies_data = self.db.read_currencies()
-        for data in currencies_data:
-            if data['id'] == currency_id:
-                return Currency.from_dict(data)
-        return None
+        currency = self.identity_map.get(int(currency_id))
+        if currency is not None:
+            return currency
+        generation = self.identity_map.generation
+        data = self.db.read_currency(currency_id)
+        if data is None:
+            return None
+        return self.identity_map.put(data['id'], Currency.from_dict(data), generation)
     
     def create_currency(self, currency_data: Dict[str, Any]) -> Currency:
         """Создание новой валюты"""
@@ -39,10 +52,52 @@ class CurrencyController:
         
         return currency
     
+    def ingest_valute(self, valute: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+        """Загрузка всего словаря Valute из ответа ЦБ РФ в БД
+
+        Все корректные записи сохраняются одним пакетом, недостающие валюты
+        создаются. Некорректные записи пропускаются и перечисляются в отчёте
+        вместе с причиной, остальные от них не зависят.
+        """
+        rows = []
+        errors = {}
+        for code, entry in valute.items():
+            # Setters модели выполняют ту же проверку, что и при создании валюты
+            currency = Currency()
+            try:
+                currency.num_code = entry['NumCode']
+                currency.char_code = entry['CharCode']
+                currency.name = entry['Name']
+                currency.value = entry['Value']
+                currency.nominal = entry['Nominal']
+            except KeyError as e:
+                errors[code] = f'Нет поля {e}'
+                continue
+            except (ValueError, TypeError) as e:
+                errors[code] = str(e)
+                continue
+            rows.append(currency.to_dict())
+
+        changed = self.db.bulk_upsert_currencies(rows) if rows else 0
+        return {'received': len(valute), 'stored': len(rows), 'changed': changed,
+                'errors': errors}
+
     def update_currency_value(self, currency_id: int, value: float) -> bool:
         """Обновление курса валюты"""
         return self.db.update_currency_value(currency_id, value)
     
+    def get_history(self, currency_id: int, start: Optional[float] = None,
+                    end: Optional[float] = None, step: Optional[str] = None,
+                    aggregate: str = 'last') -> List[Dict[str, Any]]:
+        """История курса валюты; step='day'/'week' - прореживание на стороне БД"""
+        if step is None:
+            return self.db.read_rate_history(currency_id, start, end)
+        return self.db.read_rate_history_downsampled(currency_id, step, aggregate, start, end)
+
+    def update_values(self, rates: Dict[str, float]) -> int:
+        """Обновление курсов по символьным кодам одним пакетом"""
+        return self.db.bulk_update_values(rates)
+
     def update_currency(self, currency_id: int, currency_data: Dict[str, Any]) -> bool:
         """Полное обновление валюты"""
         return self.db.update_currency(currency_id, currency_data)
@@ -53,7 +108,12 @@ class CurrencyController:
     
     def get_currency_by_char_code(self, char_code: str) -> Optional[Currency]:
         """Получение валюты по символьному коду"""
+        currency = self.identity_map.get_by_key(char_code)
+        if currency is not None:
+            return currency
+        generation = self.identity_map.generation
         currencies_data = self.db.read_currencies(char_code)
         if currencies_data:
-            return Currency.from_dict(currencies_data[0])
+            data = currencies_data[0]
+            return self.identity_map.put(data['id'], Currency.from_dict(data), generation)
         return None
\ No newline at end of file
@@ -1,30 +1,232 @@
 
+import json
 import sqlite3
-from contextlib import contextmanager
-from typing import List, Dict, Any, Optional
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Iterable, List, Dict, Any, NamedTuple, Optional, Tuple
+
+# Таблицы, для которых ведутся счётчики версий данных
+VERSIONED_TABLES = ('currency', 'user', 'user_currency', 'rate_history')
+# Изменение курса в currency триггером дописывается в rate_history
+DEPENDENT_TABLES = {'currency': ('rate_history',)}
+# Шаги прореживания истории курсов, с; недели начинаются с понедельника
+HISTORY_STEPS = {'day': (86400, 0), 'week': (7 * 86400, 3 * 86400)}
+HISTORY_AGGREGATES = ('last', 'mean')
+# Порядок столбцов в кортежах для Currency.from_row и User.from_row
+CURRENCY_COLUMNS = 'id, num_code, char_code, name, value, nominal'
+USER_COLUMNS = 'id, name'
+# Постраничное чтение: столбцы таблицы и уникальные ключи сортировки
+PAGE_COLUMNS = {'currency': CURRENCY_COLUMNS, 'user': USER_COLUMNS,
+                'user_currency': 'id, user_id, currency_id'}
+PAGE_KEYS = {'currency': ('char_code', 'id'), 'user': ('id',), 'user_currency': ('id',)}
+# Точка с уже существующими currency_id и ts заменяется
+HISTORY_UPSERT = '''
+    INSERT INTO rate_history(currency_id, ts, value, nominal) VALUES(?, ?, ?, ?)
+    ON CONFLICT(currency_id, ts) DO UPDATE
+    SET value = excluded.value, nominal = excluded.nominal
+'''
+
+
+class KeysetPage(NamedTuple):
+    """Страница выборки и курсоры соседних страниц (None - страницы нет)"""
+    rows: List[Any]
+    next: Optional[str]
+    prev: Optional[str]
+
+
+def encode_cursor(direction: str, value) -> str:
+    """Курсор 'after:<ключ>' или 'before:<ключ>' относительно строки с ключом"""
+    return f'{direction}:{value}'
+
+
+def decode_cursor(cursor: str, key: str) -> Tuple[str, Any]:
+    """Направление и значение ключа из курсора; ValueError, если он некорректен"""
+    direction, _, value = cursor.partition(':')
+    if direction not in ('after', 'before') or not value:
+        raise ValueError(f'Некорректный курсор: {cursor}')
+    return direction, int(value) if key == 'id' else value
 
 
 class DatabaseController:
-    """Контроллер для работы с базой данных"""
+    """Контроллер для работы с базой данных
+
+    Каждый поток получает собственное соединение с БД. Для ':memory:'
+    используется именованная in-memory БД с общим кэшем, чтобы все потоки
+    видели одни и те же данные; доступ к ней сериализуется блокировкой.
+    Файловая БД открывается в режиме WAL и может быть общей для процессов.
+
+    Для каждой таблицы ведётся счётчик версий, который увеличивается при
+    любом изменении данных, и время последнего изменения; по ним кэши
+    определяют устаревшие записи.
+    """
     
     def __init__(self, db_path: str = ':memory:'):
         self.db_path = db_path
-        self.conn = sqlite3.connect(db_path)
-        self.conn.row_factory = sqlite3.Row
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+        if db_path == ':memory:':
+            self._database = f'file:memdb{id(self)}?mode=memory&cache=shared'
+            self._lock = threading.RLock()
+        else:
+            self._database = db_path
+            self._lock = None
+
+        self._versions = dict.fromkeys(VERSIONED_TABLES, 0)
+        self._modified = dict.fromkeys(VERSIONED_TABLES, time.time())
+        self._versions_lock = threading.Lock()
+        # Обработчики записи: вызываются с множеством изменённых таблиц
+        self._write_listeners = []
+
+        # Соединение создающего потока держит общую in-memory БД живой
+        self._keeper = self.conn
         self._create_tables()
+
+    @staticmethod
+    def _affected(tables) -> set:
+        """Таблицы и зависимые от них таблицы (DEPENDENT_TABLES)"""
+        return set(tables).union(*(DEPENDENT_TABLES.get(table, ()) for table in tables))
+
+    def _bump_version(self, *tables: str):
+        """Отметка об изменении данных в таблицах"""
+        now = time.time()
+        tables = self._affected(tables)
+        with self._versions_lock:
+            for table in tables:
+                self._versions[table] += 1
+                self._modified[table] = now
+        for listener in self._write_listeners:
+            listener(tables)
+
+    def add_write_listener(self, listener):
+        """Подписка на изменения данных: listener(tables) после каждой записи"""
+        self._write_listeners.append(listener)
+
+    @property
+    def shared(self) -> bool:
+        """Может ли БД изменяться другими процессами"""
+        return self._lock is None
+
+    def table_state(self) -> Dict[str, Tuple[int, float]]:
+        """Версия и время последнего изменения каждой таблицы
+
+        In-memory БД доступна только этому процессу, поэтому состояние
+        берётся из счётчиков в памяти без обращения к БД. Файловую БД могут
+        менять другие процессы, её версии хранятся в table_version.
+        """
+        if self._lock is not None:
+            with self._versions_lock:
+                return {table: (self._versions[table], self._modified[table])
+                        for table in VERSIONED_TABLES}
+
+        with self._read_cursor() as cursor:
+            cursor.execute("SELECT name, version, modified_at FROM table_version")
+            return {row['name']: (row['version'], row['modified_at'])
+                    for row in cursor.fetchall()}
+
+    def table_versions(self) -> Dict[str, int]:
+        """Текущие версии данных таблиц"""
+        return {table: version for table, (version, _) in self.table_state().items()}
+
+    def data_version(self, tables=VERSIONED_TABLES) -> Tuple[int, ...]:
+        """Версии данных указанных таблиц"""
+        versions = self.table_versions()
+        return tuple(versions[table] for table in tables)
+
+    def data_state(self, tables=VERSIONED_TABLES) -> Tuple[Tuple[int, ...], Optional[float]]:
+        """Версии указанных таблиц и время последнего изменения любой из них"""
+        state = self.table_state()
+        versions = tuple(state[table][0] for table in tables)
+        modified = max((state[table][1] for table in tables), default=None)
+        return versions, modified
+
+    def _connect(self) -> sqlite3.Connection:
+        """Открытие нового соединения для текущего потока"""
+        conn = sqlite3.connect(self._database, uri=self._lock is not None,
+                               timeout=30, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        if self._lock is None:
+            # Файловая БД может использоваться несколькими процессами:
+            # WAL позволяет читать параллельно с записью
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+
+    def after_fork(self):
+        """Сброс соединений, унаследованных от родительского процесса
+
+        Соединения SQLite нельзя использовать после fork(), поэтому дочерний
+        процесс открывает собственные, не закрывая родительские.
+        """
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._local = threading.local()
+        self._keeper = self.conn
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Соединение текущего потока"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
     
     @contextmanager
     def _get_cursor(self):
         """Контекстный менеджер для работы с курсором"""
-        cursor = self.conn.cursor()
-        try:
+        with self._lock or nullcontext():
+            conn = self.conn
+            cursor = conn.cursor()
+            try:
+                yield cursor
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                raise e
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def _write_cursor(self, *tables: str):
+        """Курсор для изменения tables в одной транзакции
+
+        Если транзакция изменила хотя бы одну строку, версии таблиц
+        увеличиваются: для файловой БД - в table_version в той же транзакции,
+        обработчики записи вызываются после commit.
+        """
+        with self._get_cursor() as cursor:
+            conn = self.conn
+            changes = conn.total_changes
             yield cursor
-            self.conn.commit()
-        except Exception as e:
-            self.conn.rollback()
-            raise e
-        finally:
-            cursor.close()
+            changed = conn.total_changes != changes
+            if changed:
+                self._update_versions(cursor, tables)
+        if changed:
+            self._bump_version(*tables)
+
+    def _update_versions(self, cursor, tables):
+        """Увеличение версий в table_version в текущей транзакции (файловая БД)"""
+        if not self.shared:
+            return
+        names = sorted(self._affected(tables))
+        cursor.execute(f'''
+            UPDATE table_version SET version = version + 1, modified_at = ?
+            WHERE name IN ({', '.join('?' * len(names))})
+        ''', (time.time(), *names))
+
+    @contextmanager
+    def _read_cursor(self):
+        """Курсор для чтения: без commit, SELECT не открывает транзакцию"""
+        with self._lock or nullcontext():
+            cursor = self.conn.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
     
     def _create_tables(self):
         """Создание таблиц в базе данных"""
@@ -60,6 +262,78 @@ class DatabaseController:
                     UNIQUE(user_id, currency_id)
                 )
             ''')
+
+            # История курсов: строка на каждое изменение курса валюты.
+            # Первичный ключ (currency_id, ts) служит индексом для выборок
+            # по диапазону времени
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS rate_history (
+                    currency_id INTEGER NOT NULL,
+                    ts REAL NOT NULL,
+                    value FLOAT NOT NULL,
+                    nominal INTEGER NOT NULL,
+                    PRIMARY KEY(currency_id, ts),
+                    FOREIGN KEY(currency_id) REFERENCES currency(id) ON DELETE CASCADE
+                ) WITHOUT ROWID
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS currency_history_insert
+                AFTER INSERT ON currency WHEN NEW.value IS NOT NULL
+                BEGIN
+                    INSERT INTO rate_history(currency_id, ts, value, nominal)
+                    VALUES(NEW.id, (julianday('now') - 2440587.5) * 86400.0,
+                           NEW.value, COALESCE(NEW.nominal, 1))
+                    ON CONFLICT(currency_id, ts) DO UPDATE
+                    SET value = excluded.value, nominal = excluded.nominal;
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS currency_history_update
+                AFTER UPDATE OF value, nominal ON currency
+                WHEN NEW.value IS NOT NULL
+                    AND (NEW.value IS NOT OLD.value OR NEW.nominal IS NOT OLD.nominal)
+                BEGIN
+                    INSERT INTO rate_history(currency_id, ts, value, nominal)
+                    VALUES(NEW.id, (julianday('now') - 2440587.5) * 86400.0,
+                           NEW.value, COALESCE(NEW.nominal, 1))
+                    ON CONFLICT(currency_id, ts) DO UPDATE
+                    SET value = excluded.value, nominal = excluded.nominal;
+                END
+            ''')
+
+            # Прочитанная часть файлов журнала (logingest); файл определяется
+            # по первой строке, чтобы смещение сохранялось после ротации.
+            # finished - сжатая копия прочитана до конца
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS log_offset (
+                    fingerprint TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    offset INTEGER NOT NULL,
+                    finished INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            cursor.execute('PRAGMA table_info(log_offset)')
+            if 'finished' not in [row[1] for row in cursor.fetchall()]:
+                cursor.execute('ALTER TABLE log_offset '
+                               'ADD COLUMN finished INTEGER NOT NULL DEFAULT 0')
+
+            # Версии данных таблиц, общие для всех процессов файловой БД;
+            # их увеличивают методы записи, один раз на транзакцию
+            for table in VERSIONED_TABLES:
+                for event in ('insert', 'update', 'delete'):
+                    # Построчные триггеры версий из прежних версий схемы
+                    cursor.execute(f'DROP TRIGGER IF EXISTS {table}_version_{event}')
+            if self.shared:
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS table_version (
+                        name TEXT PRIMARY KEY,
+                        version INTEGER NOT NULL DEFAULT 0,
+                        modified_at REAL NOT NULL
+                            DEFAULT ((julianday('now') - 2440587.5) * 86400.0)
+                    )
+                ''')
+                cursor.executemany("INSERT OR IGNORE INTO table_version(name) VALUES(?)",
+                                   ((table,) for table in VERSIONED_TABLES))
     
     # CRUD операции для Currency
     
@@ -69,10 +343,91 @@ class DatabaseController:
             INSERT INTO currency(num_code, char_code, name, value, nominal)
             VALUES(:num_code, :char_code, :name, :value, :nominal)
         '''
-        with self._get_cursor() as cursor:
+        with self._write_cursor('currency') as cursor:
             cursor.execute(sql, currency_data)
-            return cursor.lastrowid
+            currency_id = cursor.lastrowid
+        return currency_id
     
+    def _read_tuples(self, sql: str, params=()) -> List[Tuple]:
+        """Строки выборки кортежами, без sqlite3.Row и словарей"""
+        with self._read_cursor() as cursor:
+            cursor.row_factory = None
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def read_currency_rows(self, char_code: Optional[str] = None) -> List[Tuple]:
+        """Чтение валют кортежами в порядке CURRENCY_COLUMNS"""
+        if char_code:
+            return self._read_tuples(
+                f"SELECT {CURRENCY_COLUMNS} FROM currency WHERE char_code = ?", (char_code,))
+        return self._read_tuples(f"SELECT {CURRENCY_COLUMNS} FROM currency ORDER BY char_code")
+
+    def read_page(self, table: str, limit: int, cursor: Optional[str] = None,
+                  sort: Optional[str] = None) -> KeysetPage:
+        """Страница строк table (кортежи в порядке PAGE_COLUMNS) по ключу сортировки
+
+        sort - один из PAGE_KEYS[table], с '-' для убывания. Вместо OFFSET
+        используется условие по ключу последней показанной строки, поэтому
+        время чтения страницы не зависит от её номера и размера таблицы.
+        """
+        return self._read_page(table, limit, cursor, sort)
+
+    def read_subscription_page(self, user_id: int, limit: int, cursor: Optional[str] = None,
+                               sort: Optional[str] = None) -> KeysetPage:
+        """Страница валют, на которые подписан user_id, как в read_page('currency')"""
+        return self._read_page(
+            'currency', limit, cursor, sort,
+            'id IN (SELECT currency_id FROM user_currency WHERE user_id = ?)', (user_id,))
+
+    def _read_page(self, table: str, limit: int, cursor: Optional[str], sort: Optional[str],
+                   condition: str = '', params=()) -> KeysetPage:
+        """Страница строк table, удовлетворяющих condition с параметрами params"""
+        keys = PAGE_KEYS[table]
+        sort = sort or keys[0]
+        key, descending = sort.lstrip('-'), sort.startswith('-')
+        if key not in keys:
+            raise ValueError(f'Недопустимая сортировка: {sort}')
+        if limit < 1:
+            raise ValueError('Размер страницы должен быть положительным')
+        direction, value = decode_cursor(cursor, key) if cursor else ('after', None)
+        backward = direction == 'before'
+
+        # Назад читаем в обратном порядке и переворачиваем результат
+        reverse = descending != backward
+        conditions = [condition] if condition else []
+        params = list(params)
+        if value is not None:
+            conditions.append(f"{key} {'<' if reverse else '>'} ?")
+            params.append(value)
+        where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+        sql = f'''
+            SELECT {PAGE_COLUMNS[table]} FROM {table} {where}
+            ORDER BY {key} {'DESC' if reverse else 'ASC'} LIMIT ?
+        '''
+        rows = self._read_tuples(sql, params + [limit + 1])
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if backward:
+            rows.reverse()
+        if not rows:
+            return KeysetPage(rows, None, None)
+
+        index = PAGE_COLUMNS[table].split(', ').index(key)
+        first, last = rows[0][index], rows[-1][index]
+        if backward:
+            return KeysetPage(rows, encode_cursor('after', last),
+                              encode_cursor('before', first) if more else None)
+        return KeysetPage(rows, encode_cursor('after', last) if more else None,
+                          encode_cursor('before', first) if value is not None else None)
+
+    def read_currency(self, currency_id: int) -> Optional[Dict]:
+        """Чтение одной валюты по первичному ключу"""
+        sql = "SELECT * FROM currency WHERE id = ?"
+        with self._read_cursor() as cursor:
+            cursor.execute(sql, (currency_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+
     def read_currencies(self, char_code: Optional[str] = None) -> List[Dict]:
         """Чтение валют"""
         if char_code:
@@ -82,17 +437,56 @@ class DatabaseController:
             sql = "SELECT * FROM currency ORDER BY char_code"
             params = ()
         
-        with self._get_cursor() as cursor:
+        with self._read_cursor() as cursor:
             cursor.execute(sql, params)
             return [dict(row) for row in cursor.fetchall()]
     
     def update_currency_value(self, currency_id: int, value: float) -> bool:
         """Обновление курса валюты"""
-        sql = "UPDATE currency SET value = ? WHERE id = ?"
-        with self._get_cursor() as cursor:
-            cursor.execute(sql, (value, currency_id))
-            return cursor.rowcount > 0
+        # Неизменившийся курс не перезаписывается, чтобы не сбрасывать кэши
+        sql = "UPDATE currency SET value = ? WHERE id = ? AND value IS NOT ?"
+        with self._write_cursor('currency') as cursor:
+            cursor.execute(sql, (value, currency_id, value))
+            if cursor.rowcount == 0:
+                cursor.execute("SELECT 1 FROM currency WHERE id = ?", (currency_id,))
+                if cursor.fetchone() is None:
+                    return False
+        return True
     
+    def bulk_upsert_currencies(self, currencies: List[Dict[str, Any]]) -> int:
+        """Вставка или обновление валют по char_code в одной транзакции
+
+        Возвращает число созданных или изменённых строк; строки с
+        неизменившимися данными не перезаписываются.
+        """
+        sql = '''
+            INSERT INTO currency(num_code, char_code, name, value, nominal)
+            VALUES(:num_code, :char_code, :name, :value, :nominal)
+            ON CONFLICT(char_code) DO UPDATE SET
+                num_code = excluded.num_code,
+                name = excluded.name,
+                value = excluded.value,
+                nominal = excluded.nominal
+            WHERE (num_code, name, value, nominal)
+                IS NOT (excluded.num_code, excluded.name, excluded.value, excluded.nominal)
+        '''
+        with self._write_cursor('currency') as cursor:
+            cursor.executemany(sql, currencies)
+            changed = max(cursor.rowcount, 0)
+        return changed
+
+    def bulk_update_values(self, values: Dict[str, float]) -> int:
+        """Обновление курсов по символьным кодам в одной транзакции
+
+        Возвращает число изменённых строк; неизвестные коды пропускаются.
+        """
+        sql = "UPDATE currency SET value = :value WHERE char_code = :char_code AND value IS NOT :value"
+        with self._write_cursor('currency') as cursor:
+            cursor.executemany(sql, ({'char_code': char_code, 'value': value}
+                                     for char_code, value in values.items()))
+            changed = max(cursor.rowcount, 0)
+        return changed
+
     def update_currency(self, currency_id: int, currency_data: Dict[str, Any]) -> bool:
         """Полное обновление валюты"""
         sql = '''
@@ -106,37 +500,171 @@ class DatabaseController:
         '''
         currency_data['id'] = currency_id
         
-        with self._get_cursor() as cursor:
+        with self._write_cursor('currency') as cursor:
             cursor.execute(sql, currency_data)
-            return cursor.rowcount > 0
+            updated = cursor.rowcount > 0
+        return updated
     
     def delete_currency(self, currency_id: int) -> bool:
         """Удаление валюты"""
         sql = "DELETE FROM currency WHERE id = ?"
-        with self._get_cursor() as cursor:
+        with self._write_cursor('currency', 'user_currency') as cursor:
             cursor.execute(sql, (currency_id,))
-            return cursor.rowcount > 0
+            deleted = cursor.rowcount > 0
+        return deleted
     
+    # История курсов
+
+    def bulk_add_history(self, rows: Iterable[Tuple[int, float, float, int]]) -> int:
+        """Добавление точек истории (currency_id, ts, value, nominal) одним пакетом
+
+        Точка с уже существующими currency_id и ts заменяется.
+        """
+        with self._write_cursor('rate_history') as cursor:
+            cursor.executemany(HISTORY_UPSERT, rows)
+            added = max(cursor.rowcount, 0)
+        return added
+
+    def read_log_offsets(self) -> Dict[str, Tuple[int, bool]]:
+        """Прочитанные части файлов журнала: отпечаток -> (байт, прочитан до конца)"""
+        with self._read_cursor() as cursor:
+            cursor.row_factory = None
+            cursor.execute('SELECT fingerprint, offset, finished FROM log_offset')
+            return {fp: (offset, bool(finished)) for fp, offset, finished in cursor.fetchall()}
+
+    def add_log_history(self, rows: Iterable[Tuple[int, float, float, int]],
+                        fingerprint: str, path: str, offset: int,
+                        finished: bool = False) -> int:
+        """Точки истории из журнала и новое смещение файла в одной транзакции
+
+        Повторный запуск после сбоя не читает файл с места, до которого
+        точки уже записаны. finished отмечает сжатую копию, прочитанную до конца.
+        """
+        with self._get_cursor() as cursor:
+            cursor.executemany(HISTORY_UPSERT, rows)
+            added = max(cursor.rowcount, 0)
+            if added:
+                self._update_versions(cursor, ('rate_history',))
+            cursor.execute('''
+                INSERT INTO log_offset(fingerprint, path, offset, finished) VALUES(?, ?, ?, ?)
+                ON CONFLICT(fingerprint) DO UPDATE
+                SET path = excluded.path, offset = excluded.offset,
+                    finished = excluded.finished
+            ''', (fingerprint, path, offset, int(finished)))
+        if added:
+            self._bump_version('rate_history')
+        return added
+
+    def read_rate_history(self, currency_id: int, start: Optional[float] = None,
+                          end: Optional[float] = None) -> List[Dict]:
+        """Точки истории курса за полуинтервал [start, end) по возрастанию времени"""
+        sql = '''
+            SELECT ts, value, nominal FROM rate_history
+            WHERE currency_id = :currency_id AND ts >= :start AND ts < :end
+            ORDER BY ts
+        '''
+        params = {'currency_id': currency_id,
+                  'start': float('-inf') if start is None else start,
+                  'end': float('inf') if end is None else end}
+        with self._read_cursor() as cursor:
+            cursor.execute(sql, params)
+            return [dict(row) for row in cursor.fetchall()]
+
+    def read_rate_history_downsampled(self, currency_id: int, step: str = 'day',
+                                      aggregate: str = 'last', start: Optional[float] = None,
+                                      end: Optional[float] = None) -> List[Dict]:
+        """История курса, прореженная до одной точки на интервал step
+
+        aggregate='last' - последнее значение интервала, 'mean' - среднее.
+        ts точки - начало интервала (UTC).
+        """
+        if step not in HISTORY_STEPS:
+            raise ValueError(f'Неизвестный шаг: {step}')
+        if aggregate not in HISTORY_AGGREGATES:
+            raise ValueError(f'Неизвестная агрегация: {aggregate}')
+
+        # Для 'last' SQLite берёт value и nominal из строки с MAX(ts) группы
+        columns = ('MAX(ts) AS last_ts, value, nominal' if aggregate == 'last'
+                   else 'AVG(value) AS value, MAX(nominal) AS nominal')
+        sql = f'''
+            SELECT CAST((ts + :offset) / :size AS INTEGER) * :size - :offset AS ts, {columns}
+            FROM rate_history
+            WHERE currency_id = :currency_id AND ts >= :start AND ts < :end
+            GROUP BY CAST((ts + :offset) / :size AS INTEGER)
+            ORDER BY ts
+        '''
+        size, offset = HISTORY_STEPS[step]
+        params = {'currency_id': currency_id, 'size': size, 'offset': offset,
+                  'start': float('-inf') if start is None else start,
+                  'end': float('inf') if end is None else end}
+        with self._read_cursor() as cursor:
+            cursor.execute(sql, params)
+            return [{'ts': row['ts'], 'value': row['value'], 'nominal': row['nominal']}
+                    for row in cursor.fetchall()]
+
+    def read_history_points(self, start: Optional[float] = None,
+                            end: Optional[float] = None) -> List[Tuple[int, float, float]]:
+        """Все точки истории за период в порядке первичного ключа
+
+        Возвращает кортежи (currency_id, ts, value / nominal) без создания
+        словарей на строку - для загрузки в массивы.
+        """
+        sql = '''
+            SELECT currency_id, ts, value / nominal FROM rate_history
+            WHERE ts >= :start AND ts < :end
+            ORDER BY currency_id, ts
+        '''
+        params = {'start': float('-inf') if start is None else start,
+                  'end': float('inf') if end is None else end}
+        with self._read_cursor() as cursor:
+            cursor.row_factory = None
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def explain_history_query(self, currency_id: int = 1) -> List[str]:
+        """План выполнения выборки истории по диапазону (EXPLAIN QUERY PLAN)"""
+        sql = '''
+            EXPLAIN QUERY PLAN
+            SELECT ts, value, nominal FROM rate_history
+            WHERE currency_id = ? AND ts >= ? AND ts < ? ORDER BY ts
+        '''
+        with self._read_cursor() as cursor:
+            cursor.execute(sql, (currency_id, 0.0, 1.0))
+            return [row['detail'] for row in cursor.fetchall()]
+
     # CRUD операции для User
     
     def create_user(self, name: str) -> int:
         """Создание нового пользователя"""
         sql = "INSERT INTO user(name) VALUES(?)"
-        with self._get_cursor() as cursor:
+        with self._write_cursor('user') as cursor:
             cursor.execute(sql, (name,))
-            return cursor.lastrowid
+            user_id = cursor.lastrowid
+        return user_id
     
+    def bulk_create_users(self, names: Iterable[str]) -> int:
+        """Создание пользователей в одной транзакции; возвращает их число"""
+        sql = "INSERT INTO user(name) VALUES(?)"
+        with self._write_cursor('user') as cursor:
+            cursor.executemany(sql, ((name,) for name in names))
+            created = max(cursor.rowcount, 0)
+        return created
+
     def read_users(self) -> List[Dict]:
         """Чтение всех пользователей"""
         sql = "SELECT * FROM user"
-        with self._get_cursor() as cursor:
+        with self._read_cursor() as cursor:
             cursor.execute(sql)
             return [dict(row) for row in cursor.fetchall()]
     
+    def read_user_rows(self) -> List[Tuple]:
+        """Чтение всех пользователей кортежами в порядке USER_COLUMNS"""
+        return self._read_tuples(f"SELECT {USER_COLUMNS} FROM user")
+
     def read_user(self, user_id: int) -> Optional[Dict]:
         """Чтение одного пользователя"""
         sql = "SELECT * FROM user WHERE id = ?"
-        with self._get_cursor() as cursor:
+        with self._read_cursor() as cursor:
             cursor.execute(sql, (user_id,))
             row = cursor.fetchone()
             return dict(row) if row else None
@@ -146,10 +674,25 @@ class DatabaseController:
     def add_user_subscription(self, user_id: int, currency_id: int) -> int:
         """Добавление подписки пользователя на валюту"""
         sql = "INSERT INTO user_currency(user_id, currency_id) VALUES(?, ?)"
-        with self._get_cursor() as cursor:
+        with self._write_cursor('user_currency') as cursor:
             cursor.execute(sql, (user_id, currency_id))
-            return cursor.lastrowid
+            subscription_id = cursor.lastrowid
+        return subscription_id
     
+    def bulk_add_subscriptions(self, subscriptions: Iterable[Tuple[int, int]]) -> int:
+        """Добавление подписок (user_id, currency_id) в одной транзакции
+
+        Уже существующие подписки пропускаются; возвращает число добавленных.
+        """
+        sql = '''
+            INSERT INTO user_currency(user_id, currency_id) VALUES(?, ?)
+            ON CONFLICT(user_id, currency_id) DO NOTHING
+        '''
+        with self._write_cursor('user_currency') as cursor:
+            cursor.executemany(sql, subscriptions)
+            added = max(cursor.rowcount, 0)
+        return added
+
     def get_user_subscriptions(self, user_id: int) -> List[Dict]:
         """Получение подписок пользователя"""
         sql = '''
@@ -158,21 +701,57 @@ class DatabaseController:
             JOIN user_currency uc ON c.id = uc.currency_id
             WHERE uc.user_id = ?
         '''
-        with self._get_cursor() as cursor:
+        with self._read_cursor() as cursor:
             cursor.execute(sql, (user_id,))
             return [dict(row) for row in cursor.fetchall()]
     
+    def get_user_subscription_rows(self, user_id: int) -> List[Tuple]:
+        """Подписки пользователя кортежами в порядке CURRENCY_COLUMNS"""
+        columns = ', '.join(f'c.{column}' for column in CURRENCY_COLUMNS.split(', '))
+        sql = f'''
+            SELECT {columns}
+            FROM currency c
+            JOIN user_currency uc ON c.id = uc.currency_id
+            WHERE uc.user_id = ?
+        '''
+        return self._read_tuples(sql, (user_id,))
+
+    def get_subscriptions_for_users(self, user_ids: Iterable[int]) -> List[Tuple]:
+        """Подписки нескольких пользователей одним запросом
+
+        Кортежи (user_id, столбцы CURRENCY_COLUMNS...) упорядочены по
+        пользователю. Идентификаторы передаются одним JSON-параметром, поэтому
+        запрос не зависит от их числа и от лимита параметров SQLite.
+        """
+        columns = ', '.join(f'c.{column}' for column in CURRENCY_COLUMNS.split(', '))
+        sql = f'''
+            SELECT uc.user_id, {columns}
+            FROM user_currency uc
+            JOIN currency c ON c.id = uc.currency_id
+            WHERE uc.user_id IN (SELECT value FROM json_each(?))
+            ORDER BY uc.user_id, c.char_code
+        '''
+        return self._read_tuples(sql, (json.dumps([int(user_id) for user_id in user_ids]),))
+
+    def read_subscriptions(self) -> List[Dict]:
+        """Чтение всех подписок"""
+        sql = "SELECT id, user_id, currency_id FROM user_currency ORDER BY id"
+        with self._read_cursor() as cursor:
+            cursor.execute(sql)
+            return [dict(row) for row in cursor.fetchall()]
+
     def remove_user_subscription(self, subscription_id: int) -> bool:
         """Удаление подписки"""
         sql = "DELETE FROM user_currency WHERE id = ?"
-        with self._get_cursor() as cursor:
+        with self._write_cursor('user_currency') as cursor:
             cursor.execute(sql, (subscription_id,))
-            return cursor.rowcount > 0
+            deleted = cursor.rowcount > 0
+        return deleted
     
     def seed_initial_data(self):
         """Начальное заполнение базы данных"""
         # Добавляем начальные данные, если таблицы пусты
-        with self._get_cursor() as cursor:
+        with self._write_cursor(*VERSIONED_TABLES) as cursor:
             cursor.execute("SELECT COUNT(*) FROM user")
             if cursor.fetchone()[0] == 0:
                 # Пользователи
@@ -218,9 +797,15 @@ class DatabaseController:
                 )
     
     def close(self):
-        """Закрытие соединения с базой данных"""
-        if self.conn:
-            self.conn.close()
+        """Закрытие всех соединений с базой данных"""
+        connections_lock = getattr(self, '_connections_lock', None)
+        if connections_lock is None:
+            return
+        with connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
     
     def __del__(self):
-        self.close()
\ No newline at end of file
+        self.close()
@@ -0,0 +1,110 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class IdentityMap:
+    """Ограниченный LRU-кэш объектов одной таблицы по id и по доп. ключу
+
+    Один и тот же объект доступен по id и, если задан key, по значению
+    этого ключа (например, char_code). Записи сбрасываются обработчиком
+    записи DatabaseController при любом изменении таблицы. Файловую БД
+    могут менять другие процессы, поэтому для неё перед поиском
+    дополнительно сверяется версия таблицы.
+
+    Возвращаемые объекты общие для всех вызывающих и не должны изменяться.
+    """
+
+    def __init__(self, db, table: str, max_size: int = 1024,
+                 key: Optional[Callable[[Any], Hashable]] = None):
+        if max_size < 0:
+            raise ValueError('Размер кэша не может быть отрицательным')
+        self.db = db
+        self.table = table
+        self.max_size = max_size
+        self.key = key
+        self._by_id: 'OrderedDict[int, Any]' = OrderedDict()
+        self._by_key: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+        self._version = None
+        # Номер поколения растёт при каждом сбросе; объект, прочитанный из БД
+        # до сброса, не должен попасть в кэш после него
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        db.add_write_listener(self._on_write)
+
+    def _on_write(self, tables):
+        if self.table in tables:
+            self.clear()
+
+    def _check_version(self):
+        """Сброс кэша, если таблицу изменил другой процесс"""
+        if not self.db.shared:
+            return
+        version = self.db.data_version((self.table,))
+        if version != self._version:
+            self.clear()
+            self._version = version
+
+    def get(self, object_id: int):
+        """Объект по id или None"""
+        self._check_version()
+        with self._lock:
+            obj = self._by_id.get(object_id)
+            if obj is None:
+                self.misses += 1
+                return None
+            self._by_id.move_to_end(object_id)
+            self.hits += 1
+            return obj
+
+    def get_by_key(self, value: Hashable):
+        """Объект по значению дополнительного ключа или None"""
+        self._check_version()
+        with self._lock:
+            object_id = self._by_key.get(value)
+            if object_id is None:
+                self.misses += 1
+                return None
+            self._by_id.move_to_end(object_id)
+            self.hits += 1
+            return self._by_id[object_id]
+
+    def put(self, object_id: int, obj, generation: Optional[int] = None):
+        """Сохранение объекта, прочитанного в поколении generation"""
+        if not self.max_size:
+            return obj
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return obj
+            self._by_id[object_id] = obj
+            self._by_id.move_to_end(object_id)
+            if self.key is not None:
+                self._by_key[self.key(obj)] = object_id
+            while len(self._by_id) > self.max_size:
+                _, evicted = self._by_id.popitem(last=False)
+                if self.key is not None:
+                    self._by_key.pop(self.key(evicted), None)
+        return obj
+
+    def clear(self):
+        with self._lock:
+            self._by_id.clear()
+            self._by_key.clear()
+            self.generation += 1
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, float]:
+        """Счётчики попаданий и промахов"""
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / requests if requests else 0.0,
+                'entries': len(self._by_id),
+                'max_size': self.max_size,
+                'invalidations': self.invalidations,
+            }
@@ -0,0 +1,49 @@
+from typing import Any, Callable, Dict, Hashable, Iterable, List
+
+
+class BatchLoader:
+    """Объединение загрузок по ключам в один пакетный запрос (как DataLoader)
+
+    load(key) только запоминает ключ. Первое обращение к результату любого
+    ключа выполняет batch(keys) сразу для всех накопленных ключей; batch
+    возвращает словарь ключ -> значение, отсутствующие ключи получают
+    default. Результаты хранятся до конца жизни загрузчика, поэтому
+    загрузчик создаётся на один запрос.
+    """
+
+    def __init__(self, batch: Callable[[List[Hashable]], Dict[Hashable, Any]],
+                 default: Callable[[], Any] = list):
+        self.batch = batch
+        self.default = default
+        self.batches = 0
+        self._pending: Dict[Hashable, None] = {}
+        self._loaded: Dict[Hashable, Any] = {}
+
+    def load(self, key: Hashable) -> 'BatchLoader':
+        if key not in self._loaded:
+            self._pending[key] = None
+        return self
+
+    def load_many(self, keys: Iterable[Hashable]) -> 'BatchLoader':
+        for key in keys:
+            self.load(key)
+        return self
+
+    def dispatch(self):
+        """Загрузка всех накопленных ключей одним вызовом batch"""
+        if not self._pending:
+            return
+        keys = list(self._pending)
+        self._pending.clear()
+        self.batches += 1
+        values = self.batch(keys)
+        for key in keys:
+            self._loaded[key] = values[key] if key in values else self.default()
+
+    def get(self, key: Hashable):
+        if key not in self._loaded:
+            self.load(key)
+            self.dispatch()
+        return self._loaded[key]
+
+    __getitem__ = get
@@ -1,31 +1,57 @@
 # controllers/usercontroller.py
-from typing import List, Dict, Optional
+from typing import Iterable, List, Dict, Optional
 from models.user import User
 from models.currency import Currency
+from controllers.databasecontr import KeysetPage
+from controllers.identitymap import IdentityMap
+from controllers.loaders import BatchLoader
 
 
 class UserController:
     """Контроллер для бизнес-логики пользователей"""
 
-    def __init__(self, db_controller):
+    def __init__(self, db_controller, identity_map_size: int = 1024):
         self.db = db_controller
+        # Пользователи по id; сбрасывается при любом изменении user
+        self.identity_map = IdentityMap(db_controller, 'user', identity_map_size)
 
     def list_users(self) -> List[User]:
         """Получение списка всех пользователей"""
-        users_data = self.db.read_users()
-        return [User(str(data['id']), data['name']) for data in users_data]
+        return [User.from_row(row) for row in self.db.read_user_rows()]
+
+    def list_users_page(self, limit: int, cursor: Optional[str] = None,
+                        sort: Optional[str] = None) -> KeysetPage:
+        """Страница пользователей; ValueError при некорректных курсоре или сортировке"""
+        page = self.db.read_page('user', limit, cursor, sort)
+        return page._replace(rows=[User.from_row(row) for row in page.rows])
 
     def get_user(self, user_id: int) -> Optional[User]:
         """Получение пользователя по ID"""
+        user = self.identity_map.get(int(user_id))
+        if user is not None:
+            return user
+        generation = self.identity_map.generation
         user_data = self.db.read_user(user_id)
         if user_data:
-            return User(str(user_data['id']), user_data['name'])
+            return self.identity_map.put(user_data['id'],
+                                         User(str(user_data['id']), user_data['name']),
+                                         generation)
         return None
 
     def get_user_subscriptions(self, user_id: int) -> List[Currency]:
         """Получение подписок пользователя"""
-        subscriptions_data = self.db.get_user_subscriptions(user_id)
-        return [Currency.from_dict(data) for data in subscriptions_data]
+        return [Currency.from_row(row) for row in self.db.get_user_subscription_rows(user_id)]
+
+    def get_subscriptions_for_users(self, user_ids: Iterable) -> Dict[str, List[Currency]]:
+        """Подписки нескольких пользователей одним запросом, по ID пользователя"""
+        subscriptions = {}
+        for row in self.db.get_subscriptions_for_users(user_ids):
+            subscriptions.setdefault(str(row[0]), []).append(Currency.from_row(row[1:]))
+        return subscriptions
+
+    def subscription_loader(self) -> BatchLoader:
+        """Загрузчик подписок на один запрос: обращения объединяются в пакеты"""
+        return BatchLoader(self.get_subscriptions_for_users)
 
     def add_user_subscription(self, user_id: int, currency_id: int) -> int:
         """Добавление подписки пользователя на валюту"""
@@ -0,0 +1,126 @@
+"""Пересчёт сумм между любыми валютами по кросс-курсам
+
+Курсы ЦБ РФ заданы в рублях за nominal единиц валюты. Из них строится
+плотная матрица кросс-курсов rates[i, j] - сколько единиц валюты j стоит
+одна единица валюты i, с учётом номинала. Пакет пересчётов выполняется
+одним векторным проходом по индексам валют.
+"""
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+BASE_CURRENCY = 'RUB'
+
+
+class CrossRates:
+    """Матрица кросс-курсов, синхронизируемая с таблицей currency
+
+    При изменении курса одной валюты пересчитываются только её строка и
+    столбец (O(N)); полная перестройка (O(N^2)) нужна лишь при изменении
+    состава валют.
+    """
+
+    def __init__(self):
+        self.codes: List[str] = []
+        self.index: Dict[str, int] = {}
+        self.unit_rates = np.empty(0)
+        self.rates = np.empty((0, 0))
+        self.version = None
+        self.rebuilds = 0
+        self.updates = 0
+        self._sorted_codes = np.empty(0, dtype=str)
+        self._sorted_index = np.empty(0, dtype=np.intp)
+        self._lock = threading.Lock()
+
+    def build(self, currencies: Iterable[Tuple[str, float, int]]):
+        """Полная перестройка по тройкам (char_code, value, nominal)"""
+        codes, unit_rates = [BASE_CURRENCY], [1.0]
+        for char_code, value, nominal in currencies:
+            if char_code == BASE_CURRENCY or not value or not nominal:
+                continue
+            codes.append(char_code)
+            unit_rates.append(value / nominal)
+
+        unit_rates = np.array(unit_rates)
+        order = np.argsort(codes)
+        with self._lock:
+            self.codes = codes
+            self.index = {code: i for i, code in enumerate(codes)}
+            self.unit_rates = unit_rates
+            self.rates = unit_rates[:, None] / unit_rates[None, :]
+            self._sorted_codes = np.array(codes)[order]
+            self._sorted_index = order
+            self.rebuilds += 1
+
+    def update(self, char_code: str, value: float, nominal: int = 1):
+        """Изменение курса одной валюты: пересчёт её строки и столбца"""
+        with self._lock:
+            i = self.index[char_code]
+            rate = value / nominal
+            self.unit_rates[i] = rate
+            self.rates[i, :] = rate / self.unit_rates
+            self.rates[:, i] = self.unit_rates / rate
+            self.updates += 1
+
+    def sync(self, db) -> bool:
+        """Приведение матрицы к текущему состоянию БД; True, если она изменилась"""
+        version = db.data_version(('currency',))
+        if version == self.version:
+            return False
+
+        rows = [(row['char_code'], row['value'], row['nominal'])
+                for row in db.read_currencies()]
+        valid = {code: (value, nominal) for code, value, nominal in rows
+                 if code != BASE_CURRENCY and value and nominal}
+        if sorted(valid) != sorted(self.codes[1:]):
+            self.build(rows)
+        else:
+            for code, (value, nominal) in valid.items():
+                if value / nominal != self.unit_rates[self.index[code]]:
+                    self.update(code, value, nominal)
+        self.version = version
+        return True
+
+    def resolve(self, codes: Sequence[str]) -> np.ndarray:
+        """Индексы валют по кодам; -1 для неизвестных кодов"""
+        codes = np.asarray(codes, dtype=str)
+        if not len(self._sorted_codes):
+            return np.full(codes.shape, -1, dtype=np.intp)
+        position = np.searchsorted(self._sorted_codes, codes)
+        position = np.minimum(position, len(self._sorted_codes) - 1)
+        found = self._sorted_codes[position] == codes
+        return np.where(found, self._sorted_index[position], -1)
+
+    def convert_indices(self, source: np.ndarray, target: np.ndarray,
+                        amounts: np.ndarray) -> np.ndarray:
+        """Пересчёт amounts из валют source в валюты target (индексы матрицы)"""
+        with self._lock:
+            return amounts * self.rates[source, target]
+
+    def convert(self, source: Sequence[str], target: Sequence[str],
+                amounts: Sequence[float]) -> Tuple[np.ndarray, List[str]]:
+        """Пересчёт пакета по кодам валют
+
+        Возвращает суммы (NaN там, где валюта неизвестна) и список
+        неизвестных кодов.
+        """
+        amounts = np.asarray(amounts, dtype=float)
+        with self._lock:
+            source_index = self.resolve(source)
+            target_index = self.resolve(target)
+            unknown = (source_index < 0) | (target_index < 0)
+            result = amounts * self.rates[source_index, target_index]
+        if not unknown.any():
+            return result, []
+        result[unknown] = np.nan
+        bad = set(np.asarray(source, dtype=str)[source_index < 0].tolist())
+        bad |= set(np.asarray(target, dtype=str)[target_index < 0].tolist())
+        return result, sorted(bad)
+
+    def rate(self, source: str, target: str) -> Optional[float]:
+        """Кросс-курс одной пары или None"""
+        with self._lock:
+            if source not in self.index or target not in self.index:
+                return None
+            return float(self.rates[self.index[source], self.index[target]])
@@ -1,94 +1,698 @@
 import sys
+import os
+import json
+import time
+import threading
+import random
 import functools
 import logging
+import queue
+import reprlib
+import atexit
+import copy
+import gzip
+import multiprocessing
+import shutil
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+
+# Наибольшая длина представления аргументов и результата в журнале
+MAX_REPR = 200
+LOG_PATH = "currency_log.txt"
+# Ротация журнала: размер файла и число сжатых копий (currency_log.txt.1.gz, ...)
+LOG_MAX_BYTES = 10 * 2 ** 20
+LOG_BACKUP_COUNT = 20
+
+
+def short_repr(value, limit: int = MAX_REPR) -> str:
+    """repr с ограничением длины; большие коллекции не обходятся целиком"""
+    text = _repr.repr(value)
+    return text if len(text) <= limit else text[:limit - 3] + '...'
+
+
+_repr = reprlib.Repr()
+_repr.maxstring = _repr.maxother = MAX_REPR
+_repr.maxlist = _repr.maxtuple = _repr.maxdict = _repr.maxset = 20
+
+
+def _snapshot(value):
+    """Поверхностная копия списка, словаря или множества; прочее - как есть"""
+    return value.copy() if type(value) in (dict, list, set) else value
+
+
+class CallRecord:
+    """Вызов функции для журнала
+
+    Строки и JSON строятся только при выводе записи, то есть в потоке записи
+    журнала, а не в вызывающем. Поэтому списки, словари и множества среди
+    аргументов и в результате копируются при создании записи (поверхностно):
+    их изменение после вызова не попадает в журнал и не мешает его записи.
+    """
+    __slots__ = ('function', 'args', 'kwargs', 'result', 'error', 'duration', 'max_repr')
+
+    def __init__(self, function: str, args, kwargs, result=None, error=None,
+                 duration: float = 0.0, max_repr: int = MAX_REPR):
+        self.function = function
+        self.args = tuple(map(_snapshot, args))
+        self.kwargs = {name: _snapshot(value) for name, value in kwargs.items()} if kwargs else {}
+        self.result = _snapshot(result)
+        self.error = error
+        self.duration = duration
+        self.max_repr = max_repr
+
+    def _value(self, value):
+        """Значение как есть, если это короткий JSON, иначе усечённый repr"""
+        try:
+            if len(json.dumps(value, ensure_ascii=False)) <= self.max_repr:
+                return value
+        except (TypeError, ValueError):
+            pass
+        return short_repr(value, self.max_repr)
+
+    def fields(self) -> dict:
+        fields = {
+            'event': 'return' if self.error is None else 'error',
+            'function': self.function,
+            'duration_ms': round(self.duration * 1000, 3),
+            'args': short_repr(self.args, self.max_repr),
+            'kwargs': short_repr(self.kwargs, self.max_repr),
+        }
+        if self.error is None:
+            fields['result'] = self._value(self.result)
+        else:
+            fields['error'] = f'{type(self.error).__name__}: {self.error}'
+        return fields
+
+    def __str__(self):
+        if self.error is not None:
+            return f'{self.function} raised {type(self.error).__name__}: {self.error}'
+        return f'{self.function} returned {short_repr(self.result, self.max_repr)}'
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Запись журнала - одна строка JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': self.formatTime(record), 'ts': round(record.created, 6),
+                 'level': record.levelname, 'logger': record.name}
+        if isinstance(record.msg, CallRecord):
+            entry.update(record.msg.fields())
+        elif getattr(record, 'fields', None) is not None:
+            # Запись вызова, подготовленная для передачи между процессами
+            entry.update(record.fields)
+        else:
+            entry['message'] = record.getMessage()
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+_json_lines = JsonLinesFormatter()
+
+
+def _always(level: int) -> bool:
+    return True
 
 
 # Декоратор для логирования
-def logger(func=None, *, handle=sys.stdout):
+def logger(func=None, *, handle=sys.stdout, level: int = logging.INFO,
+           sample: float = 1.0, max_repr: int = MAX_REPR):
+    """Журналирование вызовов func: результат или исключение и длительность
+
+    handle - logging.Logger или поток вывода (строки JSON пишутся сразу).
+    Успешные вызовы пишутся с уровнем level в доле sample случайных вызовов,
+    исключения - всегда, с уровнем ERROR. Если уровни выключены, функция
+    вызывается напрямую, без замеров и без создания записей.
+
+    Запись форматируется позже, в потоке журнала. Коллекции верхнего уровня
+    в аргументах и результате копируются сразу, а вложенные объекты нет:
+    их нельзя изменять после вызова.
+    """
     if func is None:
-        return lambda f: logger(f, handle=handle)
+        return lambda f: logger(f, handle=handle, level=level, sample=sample,
+                                max_repr=max_repr)
+    if not 0 <= sample <= 1:
+        raise ValueError('Доля журналируемых вызовов должна быть в диапазоне [0, 1]')
+
+    if isinstance(handle, logging.Logger):
+        enabled, emit = handle.isEnabledFor, handle.log
+    else:
+        def emit(record_level, call):
+            fields = dict(time=time.strftime('%Y-%m-%d %H:%M:%S'), ts=round(time.time(), 6),
+                          level=logging.getLevelName(record_level), **call.fields())
+            handle.write(json.dumps(fields, ensure_ascii=False) + "\n")
+        enabled = _always
+    name = func.__name__
 
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        msg = f"INFO: {func.__name__} called with args={args}, kwargs={kwargs}"
-        if isinstance(handle, logging.Logger):
-            handle.info(msg)
-        else:
-            handle.write(msg + "\n")
+        log_call = enabled(level) and (sample >= 1 or random.random() < sample)
+        if not log_call and not enabled(logging.ERROR):
+            return func(*args, **kwargs)
 
+        started = time.perf_counter()
         try:
             result = func(*args, **kwargs)
-            msg = f"INFO: {func.__name__} returned {result}"
-            if isinstance(handle, logging.Logger):
-                handle.info(msg)
-            else:
-                handle.write(msg + "\n")
-            return result
-
         except Exception as e:
-            msg = f"ERROR: {func.__name__} raised {type(e).__name__}: {e}"
-            if isinstance(handle, logging.Logger):
-                handle.error(msg)
-            else:
-                handle.write(msg + "\n")
+            if enabled(logging.ERROR):
+                emit(logging.ERROR, CallRecord(name, args, kwargs, error=e,
+                                               duration=time.perf_counter() - started,
+                                               max_repr=max_repr))
             raise
+        if log_call:
+            emit(level, CallRecord(name, args, kwargs, result,
+                                   duration=time.perf_counter() - started, max_repr=max_repr))
+        return result
 
     return wrapper
 
 
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler, который не форматирует запись в вызывающем потоке
+
+    Стандартный prepare() строит сообщение до постановки в очередь; здесь
+    запись передаётся как есть, и её форматирует поток QueueListener.
+    При picklable запись уходит в другой процесс: аргументы и результат
+    вызова заменяются полями для JSON, исключение - текстом.
+    """
+
+    picklable = False
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if not self.picklable:
+            return record
+        record = copy.copy(record)
+        if isinstance(record.msg, CallRecord):
+            record.fields = record.msg.fields()
+            record.msg = str(record.msg)
+        else:
+            record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _json_lines.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class ProcessLogQueue:
+    """Очередь записей журнала, общая для процессов, созданных fork
+
+    multiprocessing.SimpleQueue с методами, которые вызывают QueueHandler
+    (put_nowait) и QueueListener (get).
+    """
+
+    def __init__(self):
+        self._queue = multiprocessing.get_context('fork').SimpleQueue()
+
+    def put_nowait(self, record):
+        self._queue.put(record)
+
+    def get(self, block: bool = True):
+        return self._queue.get()
+
+
+log_listener = None
+# Очередь, через которую дочерние процессы передают записи родителю
+shared_log_queue = None
+
+
+def gzip_namer(name: str) -> str:
+    return name + '.gz'
+
+
+def gzip_rotator(source: str, dest: str):
+    """Сжатие заполненного файла журнала в dest"""
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
 # Настройка файлового логгера
-def setup_file_logger():
-    """Настраивает логгер для записи в файл"""
+def setup_file_logger(path: str = LOG_PATH, level: int = logging.INFO,
+                      max_bytes: int = LOG_MAX_BYTES, backup_count: int = LOG_BACKUP_COUNT):
+    """Логгер currency: запись в файл строками JSON из фонового потока
+
+    Вызывающие потоки только кладут записи в очередь, форматирование и
+    запись в файл выполняет поток QueueListener. Файл больше max_bytes
+    сжимается в path.1.gz; хранится backup_count сжатых копий.
+    """
+    global log_listener
+
     file_logger = logging.getLogger("currency")
-    file_logger.setLevel(logging.INFO)  # Уровень логирования
+    file_logger.setLevel(level)  # Уровень логирования
+
+    # Обработчик записи в файл работает в потоке QueueListener, там же
+    # выполняются ротация и сжатие
+    file_handler = RotatingFileHandler(path, mode='a', maxBytes=max_bytes,
+                                       backupCount=backup_count, encoding='utf-8', delay=True)
+    file_handler.namer = gzip_namer
+    file_handler.rotator = gzip_rotator
+    file_handler.setFormatter(JsonLinesFormatter())
+
+    log_queue = queue.SimpleQueue()
+    file_logger.addHandler(DeferredQueueHandler(log_queue))
+    log_listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    log_listener.start()
+    # Оставшиеся в очереди записи дописываются при завершении процесса
+    atexit.register(_stop_log_listener)
+    return file_logger
 
-    # Создаём обработчик для записи в файл
-    file_handler = logging.FileHandler("currency_log.txt", mode='a', encoding='utf-8')
 
-    # Настраиваем формат сообщений
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    file_handler.setFormatter(formatter)
+def _stop_log_listener():
+    if log_listener is not None:
+        log_listener.stop()
 
-    # Добавляем обработчик к логгеру
-    file_logger.addHandler(file_handler)
 
-    return file_logger
+def _queue_handlers():
+    return [handler for handler in logging.getLogger("currency").handlers
+            if isinstance(handler, DeferredQueueHandler)]
+
+
+def flush_log():
+    """Запись в файл всех записей, уже поставленных в очередь
+
+    В дочернем процессе с общей очередью файл пишет родитель, и ждать нечего.
+    """
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener.start()
+
+
+def share_log_queue():
+    """Один поток записи журнала на все процессы, созданные fork после вызова
+
+    Каждый процесс со своим RotatingFileHandler ротировал бы файл
+    независимо от остальных, и записи терялись бы. После вызова файл пишет
+    и ротирует только поток QueueListener этого процесса, а дочерние
+    процессы передают ему записи через общую очередь.
+    """
+    global shared_log_queue
+    if shared_log_queue is not None:
+        return
+    log_listener.stop()
+    shared_log_queue = ProcessLogQueue()
+    for handler in _queue_handlers():
+        handler.queue = shared_log_queue
+    log_listener.queue = shared_log_queue
+    log_listener.start()
+
+
+def _restart_log_listener():
+    """После fork поток записи не существует: дочерний процесс запускает свой
+
+    Очередь тоже новая, иначе записи, не записанные родителем, попали бы в
+    файл дважды. С общей очередью (share_log_queue) своего потока записи
+    нет: записи уходят родителю.
+    """
+    global log_listener
+    if shared_log_queue is not None:
+        for handler in _queue_handlers():
+            handler.picklable = True
+        log_listener = None
+        return
+    log_queue = queue.SimpleQueue()
+    for handler in _queue_handlers():
+        handler.queue = log_queue
+    log_listener.queue = log_queue
+    log_listener._thread = None
+    log_listener.start()
 
 
 # Создаём файловый логгер
 file_logger = setup_file_logger()
+os.register_at_fork(after_in_child=_restart_log_listener)
+
+
+class CircuitBreaker:
+    """Размыкатель цепи для обращений к внешнему API
+
+    После failure_threshold неудачных обращений подряд цепь размыкается
+    (open), и обращения сразу отклоняются, не дожидаясь тайм-аута. Через
+    reset_timeout секунд пропускается одно пробное обращение (half_open):
+    при успехе цепь замыкается, при неудаче снова размыкается.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        if failure_threshold < 1:
+            raise ValueError('Порог срабатывания должен быть положительным')
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Можно ли выполнить обращение сейчас"""
+        if self.state == self.CLOSED:
+            return True
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Пробное обращение получает только один поток
+                self.state = self.HALF_OPEN
+                return True
+            return self.state == self.CLOSED
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class CBRClient:
+    """HTTP-клиент API ЦБ РФ
+
+    Использует одну сессию requests с пулом соединений, повторяет
+    неудачные обращения (ошибки сети и ответы 5xx) до retries раз с
+    экспоненциально растущей паузой и защищён размыкателем цепи. Время
+    последних window обращений хранится для расчёта перцентилей.
+    """
+
+    def __init__(self, timeout=(3.05, 5), retries: int = 2, backoff: float = 0.5,
+                 backoff_max: float = 4.0, pool_size: int = 4,
+                 breaker: CircuitBreaker = None, window: int = 1000):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self.breaker = breaker or CircuitBreaker()
+        self.latencies = deque(maxlen=window)
+        self.counters = {'requests': 0, 'attempts': 0, 'retries': 0, 'failures': 0,
+                         'rejected': 0}
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """Сессия requests, создаётся при первом обращении"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+        return self._session
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Пауза перед повтором номер attempt (с нуля), со случайным разбросом"""
+        delay = min(self.backoff_max, self.backoff * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def get(self, url: str, headers: dict = None):
+        """GET-запрос; ConnectionError, если API недоступен"""
+        import requests
+
+        self.counters['requests'] += 1
+        if not self.breaker.allow():
+            self.counters['rejected'] += 1
+            raise ConnectionError("API недоступен")
+
+        started = time.perf_counter()
+        recorded = False
+        try:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    self.counters['retries'] += 1
+                    time.sleep(self.backoff_delay(attempt - 1))
+                self.counters['attempts'] += 1
+                try:
+                    response = self.session.get(url, timeout=self.timeout, headers=headers)
+                except requests.exceptions.RequestException:
+                    continue
+                if response.status_code >= 500:
+                    continue
+                try:
+                    response.raise_for_status()
+                except requests.exceptions.RequestException:
+                    # 4xx не говорит о недоступности API и не размыкает цепь
+                    recorded = True
+                    self.breaker.record_success()
+                    raise ConnectionError("API недоступен")
+                recorded = True
+                self.breaker.record_success()
+                return response
+
+            self.counters['failures'] += 1
+            recorded = True
+            self.breaker.record_failure()
+            raise ConnectionError("API недоступен")
+        except BaseException:
+            # Любое другое исключение - тоже неудача: иначе пробное обращение
+            # оставило бы размыкатель в half_open, и он отклонял бы все вызовы
+            if not recorded:
+                self.counters['failures'] += 1
+                self.breaker.record_failure()
+            raise
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+
+    def stats(self) -> dict:
+        """Состояние размыкателя, счётчики и перцентили времени обращений, мс"""
+        samples = sorted(self.latencies)
+
+        def percentile(p):
+            if not samples:
+                return None
+            return round(samples[min(len(samples) - 1, int(len(samples) * p))] * 1000, 3)
+
+        return dict(
+            self.counters,
+            breaker=self.breaker.state,
+            consecutive_failures=self.breaker.failures,
+            trips=self.breaker.trips,
+            latency_ms={'p50': percentile(0.5), 'p95': percentile(0.95),
+                        'p99': percentile(0.99),
+                        'max': round(samples[-1] * 1000, 3) if samples else None},
+        )
+
+
+# Общий клиент ЦБ РФ: одна сессия и один размыкатель на процесс
+cbr_client = CBRClient()
+
+
+class StaleDataError(ConnectionError):
+    """API недоступен, но есть сохранённые данные
+
+    stale_data - данные последнего успешного ответа (или результат функции,
+    построенный по ним), fetched_at - время их получения. Вызывающий может
+    показать их, но не считать обновлением.
+    """
+
+    def __init__(self, message: str, stale_data, fetched_at: float):
+        super().__init__(message)
+        self.stale_data = stale_data
+        self.fetched_at = fetched_at
+
+    def with_data(self, stale_data) -> 'StaleDataError':
+        return StaleDataError(str(self), stale_data, self.fetched_at)
+
+
+class RatesCache:
+    """Кэш ответа API ЦБ РФ
+
+    Пока ответ моложе ttl секунд, он берётся из памяти без обращения к сети.
+    После этого выполняется условный запрос (If-None-Match /
+    If-Modified-Since): если данные не изменились, ЦБ РФ отвечает 304 без
+    тела. Последний корректный ответ сохраняется в файл snapshot_path и
+    загружается при запуске, поэтому после перезапуска курсы доступны без
+    сети. Если API недоступен, а сохранённые данные не старше max_stale
+    секунд, они передаются в исключении StaleDataError: это всё равно
+    ошибка обновления.
+    """
+
+    def __init__(self, ttl: float = 60.0, snapshot_path: str = None,
+                 max_stale: float = 24 * 60 * 60, client: CBRClient = None):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.client = client or cbr_client
+        self.snapshot_path = None
+        self.url = None
+        self.data = None
+        self.etag = None
+        self.last_modified = None
+        self.fetched_at = 0.0
+        self.stats = {'hits': 0, 'downloads': 0, 'not_modified': 0, 'stale': 0, 'errors': 0}
+        self._lock = threading.Lock()
+        if snapshot_path:
+            self.configure(snapshot_path)
+
+    def configure(self, snapshot_path: str) -> bool:
+        """Подключение файла снимка; True, если из него загружены данные"""
+        self.snapshot_path = snapshot_path
+        return self.load_snapshot()
+
+    def load_snapshot(self) -> bool:
+        try:
+            with open(self.snapshot_path, encoding='utf-8') as f:
+                snapshot = json.load(f)
+            data = snapshot['data']
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        if not isinstance(data, dict) or "Valute" not in data:
+            return False
+
+        with self._lock:
+            self.url = snapshot.get('url')
+            self.data = data
+            self.etag = snapshot.get('etag')
+            self.last_modified = snapshot.get('last_modified')
+            self.fetched_at = float(snapshot.get('fetched_at', 0.0))
+        return True
+
+    def save_snapshot(self):
+        """Атомарная запись снимка: читатель видит старый или новый файл целиком"""
+        snapshot = {
+            'url': self.url,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'fetched_at': self.fetched_at,
+            'data': self.data,
+        }
+        temp_path = f'{self.snapshot_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(temp_path, self.snapshot_path)
+
+    def clear(self):
+        with self._lock:
+            self.url = self.data = self.etag = self.last_modified = None
+            self.fetched_at = 0.0
+
+    def get(self, url: str) -> dict:
+        """Ответ API для url: из памяти, по условному запросу или загрузкой"""
+        data = self.data
+        if data is not None and self.url == url and time.time() - self.fetched_at < self.ttl:
+            self.stats['hits'] += 1
+            return data
+
+        with self._lock:
+            # Пока ждали блокировку, данные мог обновить другой поток
+            if self.data is not None and self.url == url \
+                    and time.time() - self.fetched_at < self.ttl:
+                self.stats['hits'] += 1
+                return self.data
+            try:
+                return self._revalidate(url)
+            except ConnectionError as e:
+                self.stats['errors'] += 1
+                if self.data is not None and self.url == url \
+                        and time.time() - self.fetched_at < self.max_stale:
+                    self.stats['stale'] += 1
+                    raise StaleDataError(str(e), self.data, self.fetched_at) from e
+                raise
+
+    def _revalidate(self, url: str) -> dict:
+        headers = {}
+        if self.data is not None and self.url == url:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+
+        response = self.client.get(url, headers)
+
+        if response.status_code == 304 and headers:
+            self.stats['not_modified'] += 1
+            self.fetched_at = time.time()
+            if self.snapshot_path:
+                self.save_snapshot()
+            return self.data
+
+        try:
+            data = response.json()
+        except ValueError:
+            raise ValueError("Некорректный JSON")
+        # Без ключа "Valute" ответ не кэшируется, ошибку сообщит get_currencies
+        if not isinstance(data, dict) or "Valute" not in data:
+            return data
+
+        self.stats['downloads'] += 1
+        self.url = url
+        self.data = data
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+        self.fetched_at = time.time()
+        if self.snapshot_path:
+            self.save_snapshot()
+        return data
+
+
+# Общий кэш ответов ЦБ РФ; файл снимка подключается через rates_cache.configure()
+rates_cache = RatesCache()
+
+
+CBR_DAILY_URL = "https://www.cbr-xml-daily.ru/daily_json.js"
+
+
+def load_daily(url: str = CBR_DAILY_URL, cache: RatesCache = rates_cache) -> dict:
+    """Ответ API ЦБ РФ целиком, через cache или (cache=None) без кэширования"""
+    if cache is not None:
+        # 1-2. Ответ API из кэша или по сети
+        return cache.get(url)
+
+    # 1. Делаем запрос к API
+    response = cbr_client.get(url)
+
+    # 2. Пытаемся прочитать JSON
+    try:
+        return response.json()
+    except ValueError:
+        raise ValueError("Некорректный JSON")
 
 
 # Функция для получения курсов валют с файловым логированием
 
-@logger(handle=file_logger)
-def get_currencies(currency_codes: list, url: str = "https://www.cbr-xml-daily.ru/daily_json.js") -> dict:
+# Результат пишется целиком: по нему logingest восстанавливает историю курсов
+@logger(handle=file_logger, max_repr=16384)
+def get_currencies(currency_codes: list, url: str = CBR_DAILY_URL,
+                   cache: RatesCache = rates_cache) -> dict:
     """
     Получает курсы валют от API ЦБ РФ
 
     Возвращает словарь вида: {"USD": 93.25, "EUR": 101.7}
 
+    Ответ API берётся через cache (см. RatesCache); cache=None - запрос
+    без кэширования.
+
     Исключения:
-    - ConnectionError: API недоступен
+    - ConnectionError: API недоступен; StaleDataError - с курсами из
+      сохранённого ответа в stale_data
     - ValueError: некорректный JSON
     - KeyError: нет ключа "Valute" или валюта отсутствует
     - TypeError: курс валюты имеет неверный тип
     """
-    import requests
-
-    # 1. Делаем запрос к API
     try:
-        response = requests.get(url, timeout=5)
-        response.raise_for_status()
-    except requests.exceptions.RequestException:
-        raise ConnectionError("API недоступен")
+        data = load_daily(url, cache)
+    except StaleDataError as e:
+        raise e.with_data(select_rates(e.stale_data, currency_codes)) from e
+    return select_rates(data, currency_codes)
 
-    # 2. Пытаемся прочитать JSON
-    try:
-        data = response.json()
-    except ValueError:
-        raise ValueError("Некорректный JSON")
 
+def select_rates(data: dict, currency_codes: list) -> dict:
+    """Курсы currency_codes из ответа API ЦБ РФ"""
     # 3. Проверяем есть ли ключ "Valute"
     if "Valute" not in data:
         raise KeyError('Нет ключа "Valute"')
@@ -114,6 +718,30 @@ def get_currencies(currency_codes: list, url: str = "https://www.cbr-xml-daily.r
     return result
 
 
+@logger(handle=file_logger)
+def get_valute(url: str = CBR_DAILY_URL, cache: RatesCache = rates_cache) -> dict:
+    """
+    Получает все валюты из ответа API ЦБ РФ
+
+    Возвращает словарь "Valute" как есть: {"USD": {"NumCode": "840", ...}, ...}.
+    Отдельные записи не проверяются, это делает CurrencyController.ingest_valute.
+
+    Исключения те же, что у get_currencies.
+    """
+    try:
+        data = load_daily(url, cache)
+    except StaleDataError as e:
+        raise e.with_data(select_valute(e.stale_data)) from e
+    return select_valute(data)
+
+
+def select_valute(data: dict) -> dict:
+    """Словарь "Valute" из ответа API ЦБ РФ"""
+    if not isinstance(data, dict) or not isinstance(data.get("Valute"), dict):
+        raise KeyError('Нет ключа "Valute"')
+    return data["Valute"]
+
+
 # Пример использования (раскомментируйте когда нужно)
 if __name__ == "__main__":
     print("Тестируем файловое логирование...")
@@ -130,6 +758,7 @@ if __name__ == "__main__":
 
     # Проверяем логи
     print("\n" + "=" * 50 + "\n")
+    flush_log()
     print("Содержимое лог-файла 'currency_log.txt':")
     print("-" * 30)
     try:
@@ -0,0 +1,305 @@
+"""Восстановление истории курсов из журнала currency_log.txt
+
+Журнал содержит результат каждого вызова get_currencies с временем вызова.
+Файлы читаются через mmap (сжатые копии после ротации - потоково через
+gzip) и разбираются регулярными выражениями по целым блокам, а не по
+строкам. Понимаются оба формата: прежний текстовый
+("... - INFO: get_currencies returned {...}") и строки JSON.
+
+Прочитанная часть каждого файла хранится в таблице log_offset, поэтому
+повторный запуск читает только новые байты. Файл определяется по хешу
+первой строки: после ротации сжатая копия продолжается с того же места.
+Большие файлы делятся на блоки по границам строк, блоки разбираются
+параллельно в процессах; в работе одновременно лишь несколько блоков, и
+каждый записывается в БД сразу после разбора.
+
+Запуск: python logingest.py --db app.db [--log currency_log.txt] [--workers N]
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+LOG_PATH = 'currency_log.txt'
+CHUNK_SIZE = 32 * 2 ** 20
+
+# Прежний формат: время локальное, с миллисекундами; результат - repr словаря
+_TEXT_RESULT = re.compile(
+    rb'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) - [^\n]*?'
+    rb'INFO: get_currencies returned \{([^\n]*)\}\r?$', re.M)
+_TEXT_RATE = re.compile(rb"'([A-Z]{3})': ([-+0-9.eE]+)")
+# Строки JSON: полный разбор только у строк с результатом get_currencies
+_JSON_RESULT = re.compile(rb'^\{[^\n]*"function": "get_currencies"[^\n]*$', re.M)
+
+# Разобранная точка: (ts, char_code, value)
+Point = Tuple[float, str, float]
+
+
+class Task(NamedTuple):
+    """Блок файла журнала [start, end); end=None - сжатый файл с start до конца"""
+    fingerprint: str
+    path: str
+    start: int
+    end: Optional[int]
+
+
+@lru_cache(maxsize=4096)
+def _local_hour(hour: bytes) -> float:
+    return time.mktime(time.strptime(hour.decode(), '%Y-%m-%d %H'))
+
+
+def _local_ts(stamp: bytes) -> float:
+    """Время 'YYYY-MM-DD HH:MM:SS' по локальному поясу
+
+    mktime вызывается один раз на час: переходы на летнее время происходят
+    на границе часа, поэтому минуты и секунды добавляются к началу часа.
+    """
+    return _local_hour(stamp[:13]) + int(stamp[14:16]) * 60 + int(stamp[17:19])
+
+
+def parse_block(data: bytes) -> List[Point]:
+    """Точки курсов из блока целых строк журнала"""
+    points = []
+    for match in _TEXT_RESULT.finditer(data):
+        stamp, millis, body = match.groups()
+        ts = _local_ts(stamp) + int(millis) / 1000
+        points.extend((ts, code.decode(), float(value))
+                      for code, value in _TEXT_RATE.findall(body))
+    for match in _JSON_RESULT.finditer(data):
+        try:
+            entry = json.loads(match.group())
+        except ValueError:
+            continue
+        result = entry.get('result')
+        if entry.get('event') != 'return' or not isinstance(result, dict):
+            continue
+        ts = entry['ts']
+        points.extend((ts, code, float(value)) for code, value in result.items()
+                      if isinstance(value, (int, float)))
+    return points
+
+
+def _is_gzip(path: str) -> bool:
+    return path.endswith('.gz')
+
+
+def _open(path: str):
+    return gzip.open(path, 'rb') if _is_gzip(path) else open(path, 'rb')
+
+
+def fingerprint(path: str) -> Optional[str]:
+    """Хеш первой строки файла; None, пока в файле нет целой строки"""
+    with _open(path) as f:
+        line = f.readline(4096)
+    if not line.endswith(b'\n'):
+        return None
+    return hashlib.sha1(line).hexdigest()
+
+
+def log_files(log_path: str = LOG_PATH) -> List[str]:
+    """Файлы журнала от старых к новым: path.N.gz, ..., path.1.gz, path"""
+    directory = os.path.dirname(log_path) or '.'
+    prefix = os.path.basename(log_path) + '.'
+    rotated = []
+    for name in os.listdir(directory):
+        number = name[len(prefix):].split('.')[0]
+        if name.startswith(prefix) and number.isdigit():
+            rotated.append((int(number), os.path.join(directory, name)))
+    files = [path for _, path in sorted(rotated, reverse=True)]
+    if os.path.exists(log_path):
+        files.append(log_path)
+    return files
+
+
+def plan(path: str, fp: str, start: int, chunk_size: int = CHUNK_SIZE,
+         finished: bool = False) -> List[Task]:
+    """Блоки непрочитанной части файла по границам строк
+
+    Незавершённая последняя строка не читается: её дочитает следующий запуск.
+    finished - сжатая копия уже прочитана до конца.
+    """
+    if _is_gzip(path):
+        # Сжатая копия не меняется и читается потоком одной задачей. Размер
+        # из заголовка gzip хранится по модулю 2**32, поэтому конец файла
+        # отмечается в log_offset при чтении, а не сравнением с ним
+        return [] if finished else [Task(fp, path, start, None)]
+
+    tasks = []
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= start:
+            return tasks
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+            end = mm.rfind(b'\n', start) + 1
+            while start < end:
+                cut = min(start + chunk_size, end)
+                if cut < end:
+                    cut = mm.find(b'\n', cut - 1) + 1
+                tasks.append(Task(fp, path, start, cut))
+                start = cut
+    return tasks
+
+
+def gzip_blocks(path: str, start: int,
+                chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple[int, List[Point]]]:
+    """Блоки сжатого файла с байта start: смещение конца целых строк и их точки"""
+    tail, offset = b'', start
+    with gzip.open(path, 'rb') as f:
+        f.seek(start)
+        while True:
+            block = f.read(chunk_size)
+            if not block:
+                break
+            data = tail + block
+            cut = data.rfind(b'\n') + 1
+            tail, offset = data[cut:], offset + cut
+            yield offset, parse_block(data[:cut])
+
+
+def parse_task(task: Task) -> Tuple[int, List[Point]]:
+    """Разбор блока несжатого файла; возвращает смещение его конца и точки"""
+    with open(task.path, 'rb') as f, \
+            mmap.mmap(f.fileno(), task.end, access=mmap.ACCESS_READ) as mm:
+        return task.end, parse_block(mm[task.start:task.end])
+
+
+class Block(NamedTuple):
+    """Разобранная часть задачи [start, end); finished - сжатый файл прочитан"""
+    task: Task
+    start: int
+    end: int
+    points: List[Point]
+    finished: bool
+
+
+def _blocks(tasks: List[Task], executor, window: int,
+            chunk_size: int = CHUNK_SIZE) -> Iterator[Block]:
+    """Разобранные блоки в порядке задач
+
+    В пуле одновременно не больше window блоков, поэтому память не растёт с
+    размером журнала. Сжатые файлы читаются потоком в этом процессе, пока
+    пул разбирает следующие блоки.
+    """
+    pending = deque()
+    submitted = 0
+    for task in tasks:
+        if executor is not None:
+            while submitted < len(tasks) and len(pending) < window:
+                ahead = tasks[submitted]
+                pending.append(executor.submit(parse_task, ahead)
+                               if ahead.end is not None else None)
+                submitted += 1
+            future = pending.popleft()
+        if task.end is None:
+            start = task.start
+            for end, points in gzip_blocks(task.path, task.start, chunk_size):
+                yield Block(task, start, end, points, False)
+                start = end
+            yield Block(task, start, start, [], True)
+        else:
+            end, points = future.result() if executor is not None else parse_task(task)
+            yield Block(task, task.start, end, points, False)
+
+
+class IngestStats(NamedTuple):
+    files: int
+    bytes: int
+    points: int
+    added: int
+    unknown: Dict[str, int]
+
+
+def ingest(db, log_path: str = LOG_PATH, workers: Optional[int] = None,
+           chunk_size: int = CHUNK_SIZE, rescan: bool = False) -> IngestStats:
+    """Загрузка новых точек из журнала и его сжатых копий в rate_history
+
+    Курс в журнале задан за nominal единиц; nominal берётся из таблицы
+    currency. Точки валют, которых нет в currency, не записываются и
+    считаются в unknown, а смещение файла не переходит через блок с ними:
+    следующий запуск прочитает его снова. Блоки записываются в порядке
+    файлов, каждый вместе со своим смещением, по мере разбора. rescan=True
+    читает файлы с начала; уже записанные точки заменяются теми же.
+    """
+    offsets = {} if rescan else db.read_log_offsets()
+    currencies = {row[2]: (row[0], row[5] or 1) for row in db.read_currency_rows()}
+    tasks, files = [], 0
+    for path in log_files(log_path):
+        fp = fingerprint(path)
+        if fp is None:
+            continue
+        start, finished = offsets.get(fp, (0, False))
+        file_tasks = plan(path, fp, start, chunk_size, finished)
+        files += bool(file_tasks)
+        tasks.extend(file_tasks)
+
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    read = points_total = added = 0
+    unknown: Dict[str, int] = {}
+    # Файлы с точками неизвестных валют: смещение остаётся на начале первого
+    # такого блока, чтобы после добавления валют блок прочитался снова
+    held: Dict[str, int] = {}
+    try:
+        for block in _blocks(tasks, executor, 2 * workers, chunk_size):
+            fp = block.task.fingerprint
+            rows = []
+            for ts, code, value in block.points:
+                currency = currencies.get(code)
+                if currency is None:
+                    unknown[code] = unknown.get(code, 0) + 1
+                    held.setdefault(fp, block.start)
+                else:
+                    rows.append((currency[0], ts, value, currency[1]))
+            offset = held.get(fp, block.end)
+            added += db.add_log_history(rows, fp, block.task.path, offset,
+                                        block.finished and fp not in held)
+            read += block.end - block.start
+            points_total += len(block.points)
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+    return IngestStats(files, read, points_total, added, unknown)
+
+
+def main(argv=None):
+    from controllers import DatabaseController
+
+    parser = argparse.ArgumentParser(description='Загрузка истории курсов из журнала')
+    parser.add_argument('--db', required=True, help='файл БД приложения')
+    parser.add_argument('--log', default=LOG_PATH, help='текущий файл журнала')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='процессов разбора (по умолчанию - по числу ядер)')
+    parser.add_argument('--chunk-mb', type=float, default=CHUNK_SIZE / 2 ** 20,
+                        help='размер блока большого файла')
+    parser.add_argument('--rescan', action='store_true',
+                        help='читать файлы с начала, без сохранённых смещений')
+    args = parser.parse_args(argv)
+
+    db = DatabaseController(args.db)
+    started = time.perf_counter()
+    stats = ingest(db, args.log, args.workers, int(args.chunk_mb * 2 ** 20), args.rescan)
+    elapsed = time.perf_counter() - started
+    print(f'файлов {stats.files}, прочитано {stats.bytes / 2 ** 20:.1f} MB, '
+          f'точек {stats.points}, записано {stats.added} за {elapsed:.2f} s')
+    db.close()
+    if stats.unknown:
+        print('неизвестные валюты: ' + ', '.join(f'{code} ({count})' for code, count
+                                                 in sorted(stats.unknown.items())),
+              file=sys.stderr)
+        print('их точки не записаны; после добавления валют в currency запустите '
+              'загрузку снова', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
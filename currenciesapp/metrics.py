@@ -0,0 +1,344 @@
+"""Метрики приложения в текстовом формате Prometheus
+
+Запись не берёт блокировок: каждый поток пишет в собственный набор
+счётчиков и гистограмм (threading.local), а при выдаче /metrics наборы всех
+потоков суммируются. Наборы завершившихся потоков сливаются в общий, поэтому
+их число не растёт с числом соединений. В режиме prefork у каждого рабочего
+процесса собственные метрики.
+"""
+import bisect
+import threading
+import time
+import weakref
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Границы корзин гистограмм длительности, с
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+Sample = Tuple[str, Labels, float]
+
+
+class _Shard:
+    """Счётчики и гистограммы одного потока"""
+    __slots__ = ('counters', 'histograms', '__weakref__')
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], List[float]] = {}
+
+
+IN_FLIGHT = ('http_requests_in_flight', ())
+
+
+def _observe(histograms, key, value: float, bounds: Tuple[float, ...]):
+    buckets = histograms.get(key)
+    if buckets is None:
+        # Число попаданий в каждую корзину, в +Inf и сумма значений
+        buckets = histograms[key] = [0] * (len(bounds) + 1) + [0.0]
+    buckets[bisect.bisect_left(bounds, value)] += 1
+    buckets[-1] += value
+
+
+class _RouteKeys:
+    """Готовые ключи метрик одного маршрута, чтобы не собирать метки на каждый запрос"""
+    __slots__ = ('route', 'duration', 'phases', 'requests')
+
+    def __init__(self, route: str):
+        self.route = route
+        self.duration = ('http_request_duration_seconds', (('route', route),))
+        self.phases: Dict[str, Tuple[str, Labels]] = {}
+        self.requests: Dict[str, Dict[int, Tuple[str, Labels]]] = {}
+
+    def phase(self, name: str):
+        key = self.phases.get(name)
+        if key is None:
+            key = self.phases[name] = ('http_request_phase_seconds',
+                                       (('route', self.route), ('phase', name)))
+        return key
+
+    def request(self, method: str, status: int):
+        by_status = self.requests.get(method)
+        if by_status is None:
+            by_status = self.requests[method] = {}
+        key = by_status.get(status)
+        if key is None:
+            key = by_status[status] = ('http_requests_total', (
+                ('route', self.route), ('method', method), ('status', str(status))))
+        return key
+
+
+def _merge(counters, histograms, shard_counters, shard_histograms):
+    for key, value in shard_counters.items():
+        counters[key] = counters.get(key, 0) + value
+    for key, buckets in shard_histograms.items():
+        total = histograms.get(key)
+        if total is None:
+            histograms[key] = list(buckets)
+        else:
+            for i, value in enumerate(buckets):
+                total[i] += value
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metrics:
+    """Реестр метрик: счётчики, гистограммы и сборщики значений по запросу
+
+    Метрика описывается через describe(name, kind, help); kind - counter,
+    gauge или histogram. Значение gauge, которое меняется на каждом запросе,
+    хранится как сумма приращений inc(). Значения, уже подсчитанные в других
+    объектах (кэши, клиент ЦБ РФ), отдают сборщики add_collector.
+    """
+
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.enabled = True
+        self._local = threading.local()
+        # Завершение потока может слить его набор и во время snapshot
+        self._lock = threading.RLock()
+        # Наборы живых потоков; сами _Shard держит только threading.local
+        self._shards: Dict[int, Tuple[dict, dict]] = {}
+        self._retired = _Shard()
+        self._meta: Dict[str, Tuple[str, str]] = {}
+        self._collectors: List[Callable[[], Iterable[Sample]]] = []
+        self._route_keys: Dict[str, _RouteKeys] = {}
+
+    def describe(self, name: str, kind: str, help: str):
+        self._meta[name] = (kind, help)
+
+    def add_collector(self, collector: Callable[[], Iterable[Sample]]):
+        """collector() возвращает тройки (имя, метки, значение) на момент выдачи"""
+        self._collectors.append(collector)
+
+    def _shard(self) -> _Shard:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            key = id(shard)
+            with self._lock:
+                self._shards[key] = (shard.counters, shard.histograms)
+            # Поток завершился - его значения переходят в общий набор
+            weakref.finalize(shard, self._retire, key, shard.counters, shard.histograms)
+        return shard
+
+    def _retire(self, key, counters, histograms):
+        with self._lock:
+            self._shards.pop(key, None)
+            _merge(self._retired.counters, self._retired.histograms, counters, histograms)
+
+    def inc(self, name: str, labels: Labels = (), value: float = 1):
+        if not self.enabled:
+            return
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: Labels, value: float):
+        """Добавление наблюдения в гистограмму"""
+        if not self.enabled:
+            return
+        _observe(self._shard().histograms, (name, labels), value, self.buckets)
+
+    def route_keys(self, route: str) -> _RouteKeys:
+        keys = self._route_keys.get(route)
+        if keys is None:
+            keys = self._route_keys.setdefault(route, _RouteKeys(route))
+        return keys
+
+    def request(self, method: str) -> 'RequestTimer':
+        """Замер нового запроса или пустой замер, если метрики выключены"""
+        return RequestTimer(self, method) if self.enabled else NULL_TIMER
+
+    def snapshot(self):
+        """Суммы по всем потокам: (counters, histograms)"""
+        counters, histograms = {}, {}
+        with self._lock:
+            shards = [(self._retired.counters, self._retired.histograms)]
+            for shard_counters, shard_histograms in shards + list(self._shards.values()):
+                # Копия словаря атомарна; владелец потока может писать параллельно
+                shard_histograms = {key: list(value)
+                                    for key, value in shard_histograms.copy().items()}
+                _merge(counters, histograms, shard_counters.copy(), shard_histograms)
+        return counters, histograms
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus (version 0.0.4)"""
+        counters, histograms = self.snapshot()
+        samples: Dict[str, List[Tuple[Labels, float]]] = {}
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, []).append((labels, value))
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                samples.setdefault(name, []).append((labels, value))
+        for name, _ in histograms:
+            samples.setdefault(name, [])
+
+        lines = []
+        for name in sorted(samples):
+            kind, help = self._meta.get(name, ('untyped', ''))
+            if help:
+                lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(samples[name]):
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+            for (hist_name, labels), buckets in sorted(histograms.items()):
+                if hist_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), buckets):
+                    cumulative += count
+                    le = labels + (('le', _format_value(float(bound))),)
+                    lines.append(f'{name}_bucket{_format_labels(le)} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(buckets[-1])}')
+                lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+class RequestTimer:
+    """Замер одного HTTP-запроса: фазы обработки и итог
+
+    route - шаблон пути маршрута, а не сам путь, чтобы число рядов метрик
+    не зависело от параметров запросов. Фазы накапливаются в самом замере и
+    записываются вместе с итогом за одно обращение к набору потока.
+    """
+    __slots__ = ('metrics', 'method', 'route', 'started', 'phases')
+
+    def __init__(self, metrics: Metrics, method: str):
+        self.metrics = metrics
+        self.method = method
+        self.route = 'unmatched'
+        self.phases: List[Tuple[str, float]] = []
+        counters = metrics._shard().counters
+        counters[IN_FLIGHT] = counters.get(IN_FLIGHT, 0) + 1
+        self.started = time.perf_counter()
+
+    def phase(self, name: str, started: float):
+        """Длительность фазы name (db, render), начатой в started"""
+        self.phases.append((name, time.perf_counter() - started))
+
+    def _record(self, status: int):
+        elapsed = time.perf_counter() - self.started
+        metrics = self.metrics
+        # Потоковый ответ может завершиться в другом потоке: набор берётся заново
+        shard = metrics._shard()
+        keys = metrics.route_keys(self.route)
+        counters, histograms, bounds = shard.counters, shard.histograms, metrics.buckets
+        counters[IN_FLIGHT] = counters.get(IN_FLIGHT, 0) - 1
+        key = keys.request(self.method, status)
+        counters[key] = counters.get(key, 0) + 1
+        _observe(histograms, keys.duration, elapsed, bounds)
+        for name, seconds in self.phases:
+            _observe(histograms, keys.phase(name), seconds, bounds)
+
+    def fail(self):
+        """Запрос прерван исключением"""
+        self._record(500)
+
+    def finish(self, response):
+        """Запись итога; для потокового ответа - после передачи всего тела"""
+        chunks = response.chunks
+        if chunks is None:
+            self._record(response.status)
+        elif hasattr(chunks, '__aiter__'):
+            response.chunks = self._finish_async(chunks, response.status)
+        else:
+            response.chunks = self._finish_sync(chunks, response.status)
+        return response
+
+    def _finish_sync(self, chunks, status):
+        try:
+            yield from chunks
+        finally:
+            self._record(status)
+
+    async def _finish_async(self, chunks, status):
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            self._record(status)
+
+    def render_chunks(self, chunks):
+        """Учёт времени генерации фрагментов потокового ответа как фазы render"""
+        spent = 0.0
+        iterator = iter(chunks)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    spent += time.perf_counter() - started
+                yield chunk
+        finally:
+            self._observe_render(spent)
+
+    async def render_chunks_async(self, chunks):
+        spent = 0.0
+        iterator = chunks.__aiter__()
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    spent += time.perf_counter() - started
+                yield chunk
+        finally:
+            self._observe_render(spent)
+
+    def _observe_render(self, seconds: float):
+        self.phases.append(('render', seconds))
+
+
+class _NullTimer:
+    """Замер, который ничего не записывает (метрики выключены)"""
+    route = None
+
+    def phase(self, name: str, started: float):
+        pass
+
+    def fail(self):
+        pass
+
+    def finish(self, response):
+        return response
+
+    def render_chunks(self, chunks):
+        return chunks
+
+    render_chunks_async = render_chunks
+
+
+NULL_TIMER = _NullTimer()
+
+
+def describe_http(metrics: Metrics):
+    """Описания метрик, которые записывает RequestTimer"""
+    metrics.describe('http_requests_total', 'counter', 'Обработанные HTTP-запросы')
+    metrics.describe('http_requests_in_flight', 'gauge', 'Запросы в обработке')
+    metrics.describe('http_request_duration_seconds', 'histogram',
+                     'Полное время обработки запроса')
+    metrics.describe('http_request_phase_seconds', 'histogram',
+                     'Время фаз обработки: db - обработчик маршрута с запросами '
+                     'к БД, render - шаблон')
@@ -2,6 +2,8 @@ from models import Author
 
 
 class App():
+    __slots__ = ('__name', '__version', '__author')
+
     def __init__(self, name: str, version: str, author: Author):
         self.__name: str = name
         self.__version: str = version
@@ -1,4 +1,6 @@
 class Author():
+    __slots__ = ('__name', '__group')
+
     def __init__(self, name: str, group: str):
         self.__name: str = name
         self.__group: str = group
@@ -1,4 +1,7 @@
 class Currency:
+    # Атрибуты в слотах: без __dict__ на каждый объект
+    __slots__ = ('__id', '__num_code', '__char_code', '__name', '__value', '__nominal')
+
     def __init__(self, id: str = None, num_code: str = "", char_code: str = "",
                  name: str = "", value: float = 0.0, nominal: int = 1):
         self.__id = id
@@ -90,5 +93,18 @@ class Currency:
             nominal=data.get('nominal', 1)
         )
 
+    @classmethod
+    def from_row(cls, row) -> 'Currency':
+        """Создание объекта из строки БД (id, num_code, char_code, name, value, nominal)
+
+        Как и from_dict, не проверяет значения; обходится без промежуточного
+        словаря и вызова __init__ - для загрузки больших таблиц.
+        """
+        currency = cls.__new__(cls)
+        (currency_id, currency.__num_code, currency.__char_code, currency.__name,
+         currency.__value, currency.__nominal) = row
+        currency.__id = str(currency_id) if currency_id else None
+        return currency
+
     def __str__(self):
         return f"{self.char_code} ({self.name}): {self.value} за {self.nominal}"
\ No newline at end of file
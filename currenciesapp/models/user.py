@@ -1,4 +1,6 @@
 class User():
+    __slots__ = ('__id', '__name')
+
     def __init__(self, id: str, name: str):
         self.__id: str = id
         self.__name: str = name
@@ -23,4 +25,12 @@ class User():
         if type(name) is str and len(name) >= 2:
             self.__name = name
         else:
-            raise ValueError('Ошибка при задании имени пользователя')
\ No newline at end of file
+            raise ValueError('Ошибка при задании имени пользователя')
+
+    @classmethod
+    def from_row(cls, row) -> 'User':
+        """Создание объекта из строки БД (id, name) без проверки значений"""
+        user = cls.__new__(cls)
+        user_id, user.__name = row
+        user.__id = str(user_id)
+        return user
\ No newline at end of file
@@ -1,4 +1,6 @@
 class UserCurrency:
+    __slots__ = ('__id', '__user_id', '__currency_id')
+
     def __init__(self, id: str, user_id: str, currency_id: str):
         self.__id: str = id
         self.__user_id: str = user_id
@@ -35,4 +37,11 @@ class UserCurrency:
         if type(currency_id) is str:
             self.__currency_id = currency_id
         else:
-            raise ValueError('Ошибка при задании ID валюты')
\ No newline at end of file
+            raise ValueError('Ошибка при задании ID валюты')
+
+    @classmethod
+    def from_row(cls, row) -> 'UserCurrency':
+        """Создание объекта из строки БД (id, user_id, currency_id) без проверки значений"""
+        subscription = cls.__new__(cls)
+        subscription.__id, subscription.__user_id, subscription.__currency_id = map(str, row)
+        return subscription
\ No newline at end of file
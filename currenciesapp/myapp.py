@@ -1,258 +1,851 @@
 
-from urllib.parse import urlparse, parse_qs
-from jinja2 import Environment, FileSystemLoader, select_autoescape
 from http.server import HTTPServer, BaseHTTPRequestHandler
+import argparse
+import functools
 import os
 import json
+import select
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlencode
 
 from models import Author, User, App
 from controllers import DatabaseController, CurrencyController, UserController
-from lab7 import get_currencies
+from controllers.databasecontr import HISTORY_AGGREGATES, HISTORY_STEPS, PAGE_COLUMNS
+from lab7 import cbr_client, get_currencies, get_valute, rates_cache, share_log_queue
+from metrics import Metrics, describe_http
+from pagecache import PageCache
+from refresher import RateRefresher
+from routing import Application, HTTPError, Page, Request, Response, Router
+from servers import PreforkSupervisor, ThreadPoolHTTPServer, serve_async
+from templating import TemplateSet
+
+try:
+    import numpy as np
+    import analytics
+    from conversion import CrossRates
+except ImportError:  # аналитика и пересчёт валют требуют NumPy
+    np = analytics = CrossRates = None
 
 # Инициализация Jinja2
 current_dir = os.path.dirname(os.path.abspath(__file__))
 templates_dir = os.path.join(current_dir, 'templates')
-env = Environment(
-    loader=FileSystemLoader(templates_dir),
-    autoescape=select_autoescape()
-)
+templates = TemplateSet(templates_dir)
+env = templates.env
+async_env = templates.async_env
 
 # Инициализация контроллеров
-db_controller = DatabaseController(':memory:')
-db_controller.seed_initial_data()
-currency_controller = CurrencyController(db_controller)
-user_controller = UserController(db_controller)
+db_controller = None
+currency_controller = None
+user_controller = None
+# Число валют и пользователей в кэшах объектов контроллеров
+IDENTITY_MAP_SIZE = 1024
+
+
+def configure_database(db_path: str = ':memory:', identity_map_size: int = IDENTITY_MAP_SIZE):
+    """Подключение приложения к базе данных db_path"""
+    global db_controller, currency_controller, user_controller
+
+    if db_controller is not None:
+        db_controller.close()
+    db_controller = DatabaseController(db_path)
+    db_controller.seed_initial_data()
+    currency_controller = CurrencyController(db_controller, identity_map_size)
+    user_controller = UserController(db_controller, identity_map_size)
+
+
+configure_database(':memory:')
 
 # Инициализация данных приложения
 main_author = Author("Kamila", 'Р3124')
 main_app = App("Знаю все валюты", "1.0.0", main_author)
 
 
-class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
+# Навигация и общий контекст страниц вычисляются один раз при запуске
+NAVIGATION = [
+    {'caption': 'Главная', 'href': '/'},
+    {'caption': 'Об авторе', 'href': '/author'},
+    {'caption': 'Пользователи', 'href': '/users'},
+    {'caption': 'Курсы валют', 'href': '/currencies'},
+    {'caption': 'Управление валютами', 'href': '/currencies/admin'}
+]
+ERROR_NAVIGATION = NAVIGATION[:2]
+BASE_CONTEXT = {'app_name': main_app.name, 'navigation': NAVIGATION}
+
+router = Router()
+page_cache = PageCache()
+metrics = Metrics()
+describe_http(metrics)
+metrics.describe('cbr_fetches_total', 'counter',
+                 'Обновления курсов из ЦБ РФ по исходу (ok или тип исключения)')
+metrics.describe('cbr_fetch_duration_seconds', 'histogram', 'Время обновления курсов из ЦБ РФ')
+metrics.describe('cbr_rates_cache_total', 'counter', 'Обращения к кэшу ответов ЦБ РФ по исходу')
+metrics.describe('cbr_client_events_total', 'counter', 'События HTTP-клиента ЦБ РФ')
+metrics.describe('cache_hits_total', 'counter', 'Попадания в кэши приложения')
+metrics.describe('cache_misses_total', 'counter', 'Промахи кэшей приложения')
+metrics.describe('cache_hit_ratio', 'gauge', 'Доля попаданий в кэши приложения')
+cross_rates = CrossRates() if CrossRates is not None else None
+
+
+RATE_CODES = ["USD", "EUR", "GBP", "JPY"]
+# Размер страницы списков по умолчанию и наибольший допустимый
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+
+
+def store_rates(actual_rates: dict) -> int:
+    """Обновление курсов в БД одной транзакцией; возвращает число изменённых"""
+    return currency_controller.update_values(actual_rates)
+
+
+def ingest_all(valute: dict) -> dict:
+    """Загрузка всех валют ЦБ РФ одним пакетом; возвращает отчёт"""
+    return currency_controller.ingest_valute(valute)
+
+
+def fetch_rates(all_currencies: bool = False):
+    """Получение курсов из ЦБ РФ с записью исхода и времени в метрики"""
+    started = time.perf_counter()
+    outcome = 'ok'
+    try:
+        return get_valute() if all_currencies else get_currencies(RATE_CODES)
+    except Exception as e:
+        outcome = type(e).__name__
+        raise
+    finally:
+        metrics.inc('cbr_fetches_total', (('outcome', outcome),))
+        metrics.observe('cbr_fetch_duration_seconds', (), time.perf_counter() - started)
+
+
+# Курсы обновляются в фоне, страницы всегда читают их из БД
+refresher = RateRefresher(fetch=fetch_rates, apply=store_rates)
+
+
+def configure_ingest(all_currencies: bool):
+    """Выбор режима обновления: только RATE_CODES или весь словарь Valute"""
+    if all_currencies:
+        refresher.fetch, refresher.apply = (lambda: fetch_rates(True)), ingest_all
+    else:
+        refresher.fetch, refresher.apply = fetch_rates, store_rates
+
+
+def cache_metrics():
+    """Счётчики кэшей и клиента ЦБ РФ на момент запроса /metrics"""
+    caches = {
+        'page': page_cache.stats(),
+        'currency_identity_map': currency_controller.identity_map.stats(),
+        'user_identity_map': user_controller.identity_map.stats(),
+    }
+    for name, stats in caches.items():
+        labels = (('cache', name),)
+        yield 'cache_hits_total', labels, stats['hits']
+        yield 'cache_misses_total', labels, stats['misses']
+        yield 'cache_hit_ratio', labels, stats['hit_ratio']
+    for outcome, count in rates_cache.stats.items():
+        yield 'cbr_rates_cache_total', (('outcome', outcome),), count
+    for event, count in cbr_client.counters.items():
+        yield 'cbr_client_events_total', (('event', event),), count
+
+
+metrics.add_collector(cache_metrics)
+
+
+def page_params(request: Request):
+    """Размер страницы, курсор и сортировка из параметров limit, cursor, sort"""
+    try:
+        limit = int(request.param('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise HTTPError(400, 'Некорректное значение параметра limit')
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise HTTPError(400, f'Параметр limit должен быть от 1 до {MAX_PAGE_SIZE}')
+    return limit, request.param('cursor'), request.param('sort')
 
-    def do_GET(self):
-        parsed_path = urlparse(self.path)
-        query_params = parse_qs(parsed_path.query)
 
-        # Устанавливаем заголовки по умолчанию
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.end_headers()
+def load_page(list_page, request: Request):
+    """Страница списка по параметрам запроса; HTTPError 400 при ошибке в них"""
+    try:
+        return list_page(*page_params(request))
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+
+
+def page_links(request: Request, page) -> dict:
+    """Ссылки на соседние страницы с теми же limit и sort"""
+    def link(cursor):
+        if cursor is None:
+            return None
+        query = {name: request.param(name) for name in ('limit', 'sort') if request.param(name)}
+        query['cursor'] = cursor
+        return f'{request.path}?{urlencode(query)}'
+    return {'next': link(page.next), 'prev': link(page.prev)}
+
+
+@router.route('/', cache=True, depends_on=('currency', 'user'))
+def index(request: Request):
+    """Главная страница"""
+    # Первые 2 валюты и 2 пользователя читаются с LIMIT, а не целыми таблицами
+    currencies = currency_controller.list_currencies_page(2).rows
+    users = user_controller.list_users_page(2).rows
+
+    return Page("index.html", dict(
+        BASE_CONTEXT,
+        myapp=main_app.name,
+        version=main_app.version,
+        author_name=main_app.author.name,
+        author_group=main_author.group,
+        currencies=currencies,
+        users=users
+    ))
+
+
+AUTHOR_CONTEXT = dict(
+    BASE_CONTEXT,
+    app_version=main_app.version,
+    author_name=main_author.name,
+    author_group=main_author.group
+)
+
+
+@router.route('/author', cache=True)
+def author(request: Request):
+    """Страница об авторе"""
+    return Page("author.html", AUTHOR_CONTEXT)
+
+
+@router.route('/users', cache=True, depends_on=('user', 'user_currency'))
+def users(request: Request):
+    """Список пользователей с числом подписок, по страницам"""
+    page = load_page(user_controller.list_users_page, request)
+    # Подписки всех пользователей страницы загружаются одним запросом
+    subscriptions = user_controller.subscription_loader().load_many(user.id for user in page.rows)
+    return Page("users.html", dict(BASE_CONTEXT, users=page.rows, subscriptions=subscriptions,
+                                   pages=page_links(request, page)))
+
+
+@router.route('/user', query={'id': int}, cache=True,
+              depends_on=('user', 'user_currency', 'currency'))
+@router.route('/user/{id:int}', cache=True, depends_on=('user', 'user_currency', 'currency'))
+def user_detail(request: Request):
+    """Страница пользователя"""
+    user_id = request.params['id']
+
+    user = user_controller.get_user(user_id)
+    if not user:
+        raise HTTPError(404, 'Пользователь не найден')
+
+    subscriptions = user_controller.get_user_subscriptions(user_id)
+
+    return Page("user.html", dict(BASE_CONTEXT, user=user, subscriptions=subscriptions))
+
+
+def refresh_state(request: Request):
+    """Состояние фонового обновления, от которого зависит страница курсов
+
+    Заодно запускает обновление устаревших курсов, не дожидаясь его.
+    """
+    refresher.maybe_refresh()
+    return refresher.last_success, refresher.error
+
+
+@router.route('/currencies', cache=True, depends_on=('currency',), vary=refresh_state,
+              headers=[('Cache-Control', 'no-cache')])
+def currencies(request: Request):
+    """Страница с курсами валют"""
+    # При ошибке последнего обновления показываем сохранённые данные из БД
+    error = refresher.error
+    last_success = refresher.last_success
+    return Page("currencies.html", dict(
+        BASE_CONTEXT,
+        currencies=currency_controller.list_currencies(),
+        success=error is None,
+        error=error,
+        updated_at=(time.strftime('%d.%m.%Y %H:%M:%S', time.localtime(last_success))
+                    if last_success else None)
+    ))
+
+
+@router.route('/currencies/status', headers=[('Cache-Control', 'no-store')])
+def currencies_status(request: Request):
+    """Состояние фонового обновления курсов"""
+    return Response.json(dict(refresher.status(), upstream_cache=dict(rates_cache.stats),
+                              upstream_client=cbr_client.stats()))
+
+
+@router.route('/currencies/admin', cache=True, depends_on=('currency',))
+def currencies_admin(request: Request):
+    """Админка для управления валютами, по страницам"""
+    page = load_page(currency_controller.list_currencies_page, request)
+    return Page("currencies_admin.html",
+                dict(BASE_CONTEXT, currencies=page.rows, pages=page_links(request, page)))
+
+
+@router.route('/currency/delete', query={'id': int}, headers=[('Cache-Control', 'no-store')])
+def currency_delete(request: Request):
+    """Удаление валюты"""
+    if currency_controller.delete_currency(request.params['id']):
+        # Перенаправляем на страницу управления
+        return Response.redirect('/currencies/admin')
+    raise HTTPError(404, 'Валюта не найдена')
+
+
+@router.route('/currency/show')
+def currency_show(request: Request):
+    """Бывшая отладочная страница валют: заменена на /api/v1/currencies"""
+    return Response.redirect('/api/v1/currencies', 301)
+
+
+# JSON API. Ответы строятся прямо из строк БД, без объектов моделей;
+# готовые байты кэшируются по версиям таблиц в page_cache.
+
+def api_error(status: int, message: str) -> Response:
+    return Response.json({'error': message}, status)
+
+
+def api_page(request: Request, table: str, read_page=None) -> Response:
+    """Страница строк таблицы со ссылками на соседние страницы
 
-        # Навигация для всех страниц
-        navigation = [
-            {'caption': 'Главная', 'href': '/'},
-            {'caption': 'Об авторе', 'href': '/author'},
-            {'caption': 'Пользователи', 'href': '/users'},
-            {'caption': 'Курсы валют', 'href': '/currencies'},
-            {'caption': 'Управление валютами', 'href': '/currencies/admin'}
-        ]
+    read_page(limit, cursor, sort) заменяет чтение всей таблицы, например
+    выборкой по условию.
+    """
+    read_page = read_page or functools.partial(db_controller.read_page, table)
+    try:
+        page = read_page(*page_params(request))
+    except HTTPError as e:
+        return api_error(e.status, e.message)
+    except ValueError as e:
+        return api_error(400, str(e))
+    columns = PAGE_COLUMNS[table].split(', ')
+    return Response.json({'data': [dict(zip(columns, row)) for row in page.rows],
+                          'links': page_links(request, page)})
+
+
+@router.route('/api/v1/currencies', cache=True, depends_on=('currency',))
+def api_currencies(request: Request):
+    """Валюты по страницам (limit, cursor, sort=char_code|id, '-' - по убыванию)"""
+    return api_page(request, 'currency')
+
+
+@router.route('/api/v1/currencies/{code:str}', cache=True, depends_on=('currency',))
+def api_currency(request: Request):
+    """Валюта по символьному коду"""
+    rows = db_controller.read_currencies(request.params['code'].upper())
+    if not rows:
+        return api_error(404, 'Валюта не найдена')
+    return Response.json({'data': rows[0]})
+
+
+@router.route('/api/v1/users', cache=True, depends_on=('user',))
+def api_users(request: Request):
+    """Пользователи по страницам (limit, cursor, sort=id|-id)"""
+    return api_page(request, 'user')
+
+
+@router.route('/api/v1/users/{id:int}/subscriptions', cache=True,
+              depends_on=('user', 'user_currency', 'currency'))
+def api_user_subscriptions(request: Request):
+    """Валюты, на которые подписан пользователь, по страницам (как /api/v1/currencies)"""
+    user_id = request.params['id']
+    if db_controller.read_user(user_id) is None:
+        return api_error(404, 'Пользователь не найден')
+    return api_page(request, 'currency',
+                    functools.partial(db_controller.read_subscription_page, user_id))
+
+
+@router.route('/api/v1/subscriptions', cache=True, depends_on=('user_currency',))
+def api_subscriptions(request: Request):
+    """Подписки по страницам (limit, cursor, sort=id|-id)"""
+    return api_page(request, 'user_currency')
+
+
+@router.route('/api/v1/rates', cache=True, depends_on=('currency',), vary=refresh_state)
+def api_rates(request: Request):
+    """Курсы в рублях за единицу валюты и время последнего обновления"""
+    rates = {char_code: value / nominal
+             for _, _, char_code, _, value, nominal in db_controller.read_currency_rows()
+             if value is not None and nominal}
+    return Response.json({'data': {'base': 'RUB', 'updated_at': refresher.last_success,
+                                   'rates': rates}})
+
+
+def parse_time(request: Request, name: str):
+    """Момент времени из параметра name: дата ГГГГ-ММ-ДД (UTC) или Unix-время"""
+    value = request.param(name)
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        raise HTTPError(400, f'Некорректное значение параметра {name}')
+
+
+@router.route('/currency/{id:int}/history', cache=True, depends_on=('currency', 'rate_history'))
+def currency_history(request: Request):
+    """История курса валюты за период, при необходимости прореженная
+
+    Параметры: start, end - границы периода; step - raw, day или week;
+    agg - last или mean.
+    """
+    currency = currency_controller.get_currency(request.params['id'])
+    if not currency:
+        raise HTTPError(404, 'Валюта не найдена')
+
+    step = request.param('step', 'raw')
+    aggregate = request.param('agg', 'last')
+    if step not in ('raw',) + tuple(HISTORY_STEPS) or aggregate not in HISTORY_AGGREGATES:
+        raise HTTPError(400, 'Некорректные параметры прореживания')
+
+    points = currency_controller.get_history(
+        request.params['id'], parse_time(request, 'start'), parse_time(request, 'end'),
+        None if step == 'raw' else step, aggregate)
+    return Response.json({
+        'id': request.params['id'],
+        'char_code': currency.char_code,
+        'step': step,
+        'agg': aggregate,
+        'points': [[point['ts'], point['value'], point['nominal']] for point in points],
+    })
+
+
+def analytics_matrix(request: Request):
+    """Матрица курсов по параметрам запроса start, end и step (day или week)"""
+    if analytics is None:
+        raise HTTPError(503, 'Аналитика недоступна: не установлен NumPy')
+    step = request.param('step', 'day')
+    if step not in HISTORY_STEPS:
+        raise HTTPError(400, 'Некорректное значение параметра step')
+    return analytics.load_rate_matrix(db_controller, step, parse_time(request, 'start'),
+                                      parse_time(request, 'end'))
+
+
+def analytics_window(request: Request) -> int:
+    try:
+        window = int(request.param('window', 30))
+    except ValueError:
+        window = 0
+    if window < 2:
+        raise HTTPError(400, 'Некорректное значение параметра window')
+    return window
+
+
+@router.route('/analytics', cache=True, depends_on=('currency', 'rate_history'))
+def analytics_summary(request: Request):
+    """Последние значения показателей по всем валютам"""
+    window = analytics_window(request)
+    matrix = analytics_matrix(request)
+    return Response.json({'window': window, 'currencies': analytics.summary(matrix, window)})
+
+
+@router.route('/analytics/series', query={'code': str}, cache=True,
+              depends_on=('currency', 'rate_history'))
+def analytics_series(request: Request):
+    """Ряды показателей одной валюты: курс, скользящее среднее, волатильность, изменение"""
+    window = analytics_window(request)
+    matrix = analytics_matrix(request)
+    code = request.params['code'].upper()
+    if code not in matrix.codes:
+        raise HTTPError(404, 'Нет истории курса валюты')
+    values = matrix.column(code)[:, None]
+    return Response.json({
+        'code': code,
+        'window': window,
+        'ts': matrix.ts.tolist(),
+        'value': analytics.to_json(values[:, 0]),
+        'moving_average': analytics.to_json(analytics.moving_average(values, window)[:, 0]),
+        'volatility': analytics.to_json(analytics.rolling_volatility(values, window)[:, 0]),
+        'change': analytics.to_json(analytics.percent_change(values)[:, 0]),
+    })
+
+
+@router.route('/analytics/correlation', cache=True, depends_on=('currency', 'rate_history'))
+def analytics_correlation(request: Request):
+    """Матрица корреляций лог-доходностей всех валют"""
+    matrix = analytics_matrix(request)
+    return Response.json({
+        'codes': matrix.codes,
+        'matrix': analytics.to_json(analytics.correlation_matrix(matrix.values)),
+    })
+
+
+def parse_conversions(request: Request):
+    """Тройки (из, в, сумма): из параметров from, to, amount или JSON-тела POST
+
+    Тело - список [[from, to, amount], ...] или {"items": [...]}.
+    """
+    if request.method == 'GET':
+        items = [(request.param('from'), request.param('to'), request.param('amount', 1))]
+        if not items[0][0] or not items[0][1]:
+            raise HTTPError(400, 'Не указаны параметры from и to')
+    else:
+        try:
+            items = json.loads(request.body or b'null')
+            if isinstance(items, dict):
+                items = items.get('items')
+            if not isinstance(items, list) or not all(
+                    isinstance(item, list) and len(item) == 3 for item in items):
+                raise ValueError
+        except ValueError:
+            raise HTTPError(400, 'Ожидается список [валюта, валюта, сумма]')
+    if not items:
+        return [], [], []
+    source, target, amounts = zip(*items)
+    try:
+        return ([str(code).upper() for code in source], [str(code).upper() for code in target],
+                np.asarray(amounts, dtype=float))
+    except (TypeError, ValueError):
+        raise HTTPError(400, 'Некорректная сумма')
+
+
+@router.route('/convert', methods=('GET', 'POST'), headers=[('Cache-Control', 'no-store')])
+def convert(request: Request):
+    """Пересчёт сумм между валютами по кросс-курсам, в том числе пакетами"""
+    if cross_rates is None:
+        raise HTTPError(503, 'Пересчёт недоступен: не установлен NumPy')
+    source, target, amounts = parse_conversions(request)
+    cross_rates.sync(db_controller)
+    results, unknown = cross_rates.convert(source, target, amounts)
+
+    if request.method == 'GET':
+        if unknown:
+            raise HTTPError(404, f'Неизвестная валюта: {", ".join(unknown)}')
+        return Response.json({'from': source[0], 'to': target[0], 'amount': float(amounts[0]),
+                              'rate': cross_rates.rate(source[0], target[0]),
+                              'result': float(results[0])})
+    return Response.json({'results': analytics.to_json(results), 'unknown': unknown})
+
+
+@router.route('/currency/create', methods=('POST',), headers=[('Cache-Control', 'no-store')])
+def currency_create(request: Request):
+    """Создание валюты из формы"""
+    form_data = request.form()
+
+    try:
+        currency_data = {
+            'num_code': form_data['num_code'][0],
+            'char_code': form_data['char_code'][0].upper(),
+            'name': form_data['name'][0],
+            'value': float(form_data['value'][0]),
+            'nominal': int(form_data['nominal'][0])
+        }
+
+        currency_controller.create_currency(currency_data)
+    except Exception as e:
+        raise HTTPError(400, f'Ошибка при создании валюты: {str(e)}')
+
+    # Перенаправляем на страницу управления
+    return Response.redirect('/currencies/admin')
+
+
+@router.route('/metrics', headers=[('Cache-Control', 'no-store')])
+def metrics_page(request: Request):
+    """Метрики процесса в текстовом формате Prometheus"""
+    return Response(metrics.render().encode('utf-8'), 200,
+                    [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')])
+
+
+@router.route('/cache/stats')
+def cache_stats(request: Request):
+    """Счётчики кэша страниц и кэшей объектов"""
+    stats = page_cache.stats()
+    stats['identity_map'] = {
+        'currencies': currency_controller.identity_map.stats(),
+        'users': user_controller.identity_map.stats(),
+    }
+    return Response.json(stats)
+
+
+def error_page(message: str, status_code: int = 500) -> Page:
+    """Создание страницы ошибки"""
+    return Page("error.html", dict(
+        app_name=main_app.name,
+        navigation=ERROR_NAVIGATION,
+        error_message=message,
+        status_code=status_code
+    ), status_code)
+
+
+app = Application(router, env, async_env, error_page=error_page, cache=page_cache,
+                  data_state=lambda tables: db_controller.data_state(tables), metrics=metrics)
+
+
+def after_fork(slot: int):
+    """Подготовка рабочего процесса prefork: свои соединения с БД и обновление курсов
+
+    Курсы из ЦБ РФ получает только процесс 0, остальные читают их из общей
+    БД, а итог обновления - из общей памяти.
+    """
+    db_controller.after_fork()
+    if slot == 0:
+        refresher.start()
+    else:
+        refresher.follow()
 
+
+def reload_templates():
+    """Перезагрузка шаблонов со сбросом отрендеренных ими страниц"""
+    templates.reload()
+    page_cache.clear()
+    app.etag_salt = os.urandom(8).hex()
+
+
+class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
+    """Адаптер http.server к общему слою маршрутизации
+
+    Поддерживает постоянные соединения HTTP/1.1. Простаивающее соединение
+    занимает рабочий поток, поэтому между запросами оно ждёт не дольше
+    keepalive_timeout секунд и закрывается сразу, как только новые клиенты
+    ждут свободного потока. Соединение также закрывается после
+    max_keepalive_requests запросов; timeout ограничивает операции чтения и
+    записи внутри запроса.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    timeout = 15
+    keepalive_timeout = 2
+    # Период проверки очереди ожидающих клиентов во время простоя, с
+    keepalive_poll = 0.05
+    max_keepalive_requests = 100
+    # Заголовки и тело уходят одним сегментом при сбросе буфера после
+    # каждого запроса; иначе на постоянном соединении ответ задерживается
+    # алгоритмом Нейгла и отложенным ACK клиента
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.requests_handled = 0
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self._wait_for_request():
+            self.handle_one_request()
+
+    def _others_waiting(self) -> bool:
+        """Ждут ли другие клиенты: в очереди пула или в очереди accept()"""
+        waiting = getattr(self.server, 'has_waiting', None)
+        if waiting is not None and waiting():
+            return True
+        return bool(select.select([self.server.socket], [], [], 0)[0])
+
+    def _wait_for_request(self) -> bool:
+        """Ожидание следующего запроса постоянного соединения; False - закрыть"""
+        # Конвейерный запрос мог уже попасть в буфер чтения
+        self.connection.settimeout(0)
         try:
-            if parsed_path.path == '/':
-                # Главная страница
-                currencies = currency_controller.list_currencies()
-                users = user_controller.list_users()
-
-                template = env.get_template("index.html")
-                result = template.render(
-                    app_name=main_app.name,
-                    myapp=main_app.name,
-                    version=main_app.version,
-                    navigation=navigation,
-                    author_name=main_app.author.name,
-                    author_group=main_author.group,
-                    currencies=currencies[:2],  # Показываем только первые 2 валюты
-                    users=users[:2]  # Показываем только первых 2 пользователей
-                )
-
-            elif parsed_path.path == '/author':
-                # Страница об авторе
-                template = env.get_template("author.html")
-                result = template.render(
-                    app_name=main_app.name,
-                    app_version=main_app.version,
-                    navigation=navigation,
-                    author_name=main_author.name,
-                    author_group=main_author.group
-                )
-
-            elif parsed_path.path == '/users':
-                # Список пользователей
-                users = user_controller.list_users()
-
-                template = env.get_template("users.html")
-                result = template.render(
-                    app_name=main_app.name,
-                    navigation=navigation,
-                    users=users
-                )
-
-            elif parsed_path.path == '/user':
-                # Страница пользователя
-                user_id = query_params.get('id', [None])[0]
-
-                if not user_id:
-                    result = self._error_page("400 - Не указан ID пользователя", 400)
-                else:
-                    user = user_controller.get_user(int(user_id))
-                    if not user:
-                        result = self._error_page("404 - Пользователь не найден", 404)
-                    else:
-                        subscriptions = user_controller.get_user_subscriptions(int(user_id))
-
-                        template = env.get_template("user.html")
-                        result = template.render(
-                            app_name=main_app.name,
-                            navigation=navigation,
-                            user=user,
-                            subscriptions=subscriptions
-                        )
-
-            elif parsed_path.path == '/currencies':
-                # Страница с курсами валют
-                try:
-                    # Получаем актуальные курсы
-                    actual_rates = get_currencies(["USD", "EUR", "GBP", "JPY"])
-
-                    # Обновляем курсы в БД
-                    for char_code, value in actual_rates.items():
-                        currency = currency_controller.get_currency_by_char_code(char_code)
-                        if currency:
-                            currency_controller.update_currency_value(currency.id, value)
-
-                    currencies = currency_controller.list_currencies()
-
-                    template = env.get_template("currencies.html")
-                    result = template.render(
-                        app_name=main_app.name,
-                        navigation=navigation,
-                        currencies=currencies,
-                        success=True,
-                        error=None
-                    )
-                except Exception as e:
-                    # Если ошибка, показываем данные из БД
-                    currencies = currency_controller.list_currencies()
-
-                    template = env.get_template("currencies.html")
-                    result = template.render(
-                        app_name=main_app.name,
-                        navigation=navigation,
-                        currencies=currencies,
-                        success=False,
-                        error=str(e)
-                    )
-
-            elif parsed_path.path == '/currencies/admin':
-                # Админка для управления валютами
-                currencies = currency_controller.list_currencies()
-
-                template = env.get_template("currencies_admin.html")
-                result = template.render(
-                    app_name=main_app.name,
-                    navigation=navigation,
-                    currencies=currencies
-                )
-
-            elif parsed_path.path == '/currency/delete':
-                # Удаление валюты
-                currency_id = query_params.get('id', [None])[0]
-
-                if not currency_id:
-                    result = self._error_page("400 - Не указан ID валюты", 400)
-                else:
-                    success = currency_controller.delete_currency(int(currency_id))
-                    if success:
-                        # Перенаправляем на страницу управления
-                        self.send_response(303)
-                        self.send_header('Location', '/currencies/admin')
-                        self.end_headers()
-                        return
-                    else:
-                        result = self._error_page("404 - Валюта не найдена", 404)
-
-            elif parsed_path.path == '/currency/show':
-                # Отладочная страница для просмотра валют
-                currencies = currency_controller.list_currencies()
-                result = f"<html><body><pre>{json.dumps([c.__dict__ for c in currencies], indent=2)}</pre></body></html>"
-
-            else:
-                result = self._error_page("404 - Страница не найдена", 404)
-
-        except Exception as e:
-            result = self._error_page(f"500 - Внутренняя ошибка сервера: {str(e)}", 500)
-
-        self.wfile.write(bytes(result, "utf-8"))
+            if self.rfile.peek(1):
+                return True
+        finally:
+            self.connection.settimeout(self.timeout)
+
+        deadline = time.monotonic() + self.keepalive_timeout
+        while True:
+            # Закрытие соединения клиентом тоже делает сокет читаемым
+            if select.select([self.connection], [], [], self.keepalive_poll)[0]:
+                return True
+            if time.monotonic() >= deadline or self._others_waiting():
+                return False
 
-    def do_POST(self):
-        """Обработка POST-запросов"""
-        parsed_path = urlparse(self.path)
-
-        if parsed_path.path == '/currency/create':
-            # Получаем данные формы
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length).decode('utf-8')
-            form_data = parse_qs(post_data)
-
-            # Создаем новую валюту
-            try:
-                currency_data = {
-                    'num_code': form_data['num_code'][0],
-                    'char_code': form_data['char_code'][0].upper(),
-                    'name': form_data['name'][0],
-                    'value': float(form_data['value'][0]),
-                    'nominal': int(form_data['nominal'][0])
-                }
-
-                currency_controller.create_currency(currency_data)
-
-                # Перенаправляем на страницу управления
-                self.send_response(303)
-                self.send_header('Location', '/currencies/admin')
-                self.end_headers()
-
-            except Exception as e:
-                result = self._error_page(f"400 - Ошибка при создании валюты: {str(e)}", 400)
-                self.send_response(400)
-                self.send_header('Content-Type', 'text/html; charset=utf-8')
-                self.end_headers()
-                self.wfile.write(bytes(result, "utf-8"))
+    def do_GET(self):
+        self._dispatch()
 
+    def do_POST(self):
+        self._dispatch()
+
+    def _dispatch(self):
+        # Тело читается целиком, чтобы следующий запрос в соединении
+        # (в том числе конвейерный) начинался с правильной позиции
+        content_length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(content_length) if content_length else b''
+        request = Request(self.command, self.path, dict(self.headers.items()), body,
+                          self.request_version)
+
+        response = app.respond(request)
+
+        self.requests_handled += 1
+        if self.requests_handled >= self.max_keepalive_requests:
+            self.close_connection = True
+
+        chunked = response.chunks is not None and self.request_version != 'HTTP/1.0'
+        if response.chunks is not None and not chunked:
+            # Клиенты HTTP/1.0 не понимают chunked: конец тела - закрытие соединения
+            self.close_connection = True
+
+        self.send_response(response.status)
+        for name, value in response.headers:
+            self.send_header(name, value)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        elif response.chunks is None and response.status != 304:
+            self.send_header('Content-Length', str(len(response.body)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        elif self.request_version == 'HTTP/1.0':
+            self.send_header('Connection', 'keep-alive')
+        self.end_headers()
+        if response.chunks is None:
+            self.wfile.write(response.body)
         else:
-            result = self._error_page("404 - Страница не найдена", 404)
-            self.send_response(404)
-            self.send_header('Content-Type', 'text/html; charset=utf-8')
-            self.end_headers()
-            self.wfile.write(bytes(result, "utf-8"))
-
-    def _error_page(self, message: str, status_code: int = 500):
-        """Создание страницы ошибки"""
-        template = env.get_template("error.html")
-        return template.render(
-            app_name=main_app.name,
-            navigation=[
-                {'caption': 'Главная', 'href': '/'},
-                {'caption': 'Об авторе', 'href': '/author'}
-            ],
-            error_message=message,
-            status_code=status_code
+            self._write_chunks(response.chunks, chunked)
+
+    def _write_chunks(self, chunks, chunked: bool):
+        """Передача потокового тела по мере рендеринга"""
+        try:
+            for chunk in chunks:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk)
+                self.wfile.flush()
+            if chunked:
+                self.wfile.write(b'0\r\n\r\n')
+        except Exception:
+            # Заголовки уже отправлены: оборванный ответ без завершающего
+            # фрагмента клиент распознает как ошибку
+            self.close_connection = True
+            raise
+
+
+def parse_args(argv=None):
+    """Разбор параметров командной строки"""
+    parser = argparse.ArgumentParser(description=main_app.name)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--mode', choices=['single', 'threaded', 'async', 'prefork'],
+                        default='threaded',
+                        help='однопоточный сервер, пул рабочих потоков, asyncio '
+                             'или несколько рабочих процессов')
+    parser.add_argument('--db', default=None,
+                        help="путь к файлу SQLite (по умолчанию currencies.db, в режиме "
+                             "single - ':memory:'); запросы к ':memory:' выполняются "
+                             "по одному, к файлу - параллельно (WAL)")
+    parser.add_argument('--workers', type=int, default=8,
+                        help='число рабочих потоков (в режиме async - потоков для SQLite, '
+                             'в режиме prefork - потоков в каждом процессе)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                        help='число рабочих процессов в режиме prefork')
+    parser.add_argument('--stats-interval', type=float, default=10.0,
+                        help='период вывода статистики по процессам в режиме prefork, с')
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help='максимальная длина очереди соединений')
+    parser.add_argument('--page-cache-entries', type=int, default=page_cache.max_entries,
+                        help='максимальное число страниц в кэше')
+    parser.add_argument('--page-cache-mb', type=float, default=page_cache.max_bytes / 2 ** 20,
+                        help='максимальный объём кэша страниц, МБ')
+    parser.add_argument('--page-cache-entry-kb', type=float,
+                        default=page_cache.max_entry_bytes / 2 ** 10,
+                        help='наибольший объём одной страницы в кэше, КБ')
+    parser.add_argument('--identity-map-size', type=int, default=IDENTITY_MAP_SIZE,
+                        help='число валют и пользователей в кэше объектов (0 - без кэша)')
+    parser.add_argument('--templates', choices=['development', 'production'],
+                        default='development',
+                        help='development - перечитывать изменённые шаблоны, production - '
+                             'без проверки файлов, с кэшем байт-кода и прогревом')
+    parser.add_argument('--template-cache-dir', default=None,
+                        help='каталог кэша байт-кода шаблонов в режиме production '
+                             '(по умолчанию .jinja_cache рядом с шаблонами)')
+    parser.add_argument('--precompile', metavar='DIR', default=None,
+                        help='собрать шаблоны в Python-модули в каталоге DIR')
+    parser.add_argument('--refresh-interval', type=float, default=refresher.interval,
+                        help='период фонового обновления курсов ЦБ РФ, с')
+    parser.add_argument('--refresh-jitter', type=float, default=refresher.jitter,
+                        help='случайное отклонение периода обновления, доля от периода')
+    parser.add_argument('--refresh-retry-delay', type=float, default=refresher.retry_delay,
+                        help='пауза перед повтором после неудачного обновления, с '
+                             '(удваивается при каждой неудаче подряд)')
+    parser.add_argument('--ingest-all', action='store_true',
+                        help='загружать в БД все валюты ЦБ РФ, а не только '
+                             + ', '.join(RATE_CODES))
+    parser.add_argument('--rates-ttl', type=float, default=rates_cache.ttl,
+                        help='время, в течение которого ответ ЦБ РФ берётся из памяти, с')
+    parser.add_argument('--rates-snapshot', default='cbr_snapshot.json',
+                        help='файл снимка последнего ответа ЦБ РФ '
+                             '(пустая строка - не сохранять)')
+    parser.add_argument('--stream', action='store_true',
+                        help='передавать страницы по мере рендеринга (chunked)')
+    parser.add_argument('--keepalive-timeout', type=float,
+                        default=SimpleHTTPRequestHandler.keepalive_timeout,
+                        help='время простоя постоянного соединения до закрытия, с')
+    parser.add_argument('--max-requests-per-connection', type=int,
+                        default=SimpleHTTPRequestHandler.max_keepalive_requests,
+                        help='максимальное число запросов в одном соединении')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Рабочие потоки и процессы читают файловую БД параллельно, а ':memory:'
+    # - только по одному, под общей блокировкой
+    db_path = args.db or (':memory:' if args.mode == 'single' else 'currencies.db')
+    if db_path != ':memory:' or args.identity_map_size != IDENTITY_MAP_SIZE:
+        configure_database(db_path, args.identity_map_size)
+    if args.templates == 'production':
+        templates.configure(
+            production=True,
+            cache_dir=args.template_cache_dir or os.path.join(current_dir, '.jinja_cache'),
+            compiled_dir=args.precompile
         )
+        templates.install_reload_signal(reload_templates)
+    elif args.precompile:
+        templates.configure(compiled_dir=args.precompile)
+
+    app.stream = args.stream
+    refresher.interval = args.refresh_interval
+    refresher.retry_delay = args.refresh_retry_delay
+    refresher.jitter = args.refresh_jitter
+    configure_ingest(args.ingest_all)
+    rates_cache.ttl = args.rates_ttl
+    if args.rates_snapshot:
+        rates_cache.configure(args.rates_snapshot)
+    page_cache.max_entries = args.page_cache_entries
+    page_cache.max_bytes = int(args.page_cache_mb * 2 ** 20)
+    page_cache.max_entry_bytes = int(args.page_cache_entry_kb * 2 ** 10)
+    SimpleHTTPRequestHandler.keepalive_timeout = args.keepalive_timeout
+    SimpleHTTPRequestHandler.max_keepalive_requests = args.max_requests_per_connection
+    print(f'Server is running on http://{args.host}:{args.port}')
+
+    if args.mode == 'prefork':
+        def make_server(address, handler, bind_and_activate=True):
+            return ThreadPoolHTTPServer(address, handler, workers=args.workers,
+                                        queue_size=args.queue_size,
+                                        bind_and_activate=bind_and_activate)
+
+        # Журнал пишет и ротирует только родительский процесс
+        share_log_queue()
+        refresher.share()
+        supervisor = PreforkSupervisor(make_server, SimpleHTTPRequestHandler,
+                                       (args.host, args.port), processes=args.processes,
+                                       after_fork=after_fork,
+                                       stats_interval=args.stats_interval)
+        supervisor.serve_forever()
+        db_controller.close()
+        return
 
+    # В режиме prefork планировщик запускается в рабочем процессе 0
+    refresher.start()
 
-if __name__ == '__main__':
-    httpd = HTTPServer(('localhost', 8080), SimpleHTTPRequestHandler)
-    print('Server is running on http://localhost:8080')
+    if args.mode == 'async':
+        try:
+            serve_async(app, args.host, args.port, workers=args.workers,
+                        idle_timeout=args.keepalive_timeout,
+                        max_requests=args.max_requests_per_connection)
+        except KeyboardInterrupt:
+            print("\nServer stopped")
+            db_controller.close()
+        return
+
+    if args.mode == 'threaded':
+        httpd = ThreadPoolHTTPServer((args.host, args.port), SimpleHTTPRequestHandler,
+                                     workers=args.workers, queue_size=args.queue_size)
+    else:
+        httpd = HTTPServer((args.host, args.port), SimpleHTTPRequestHandler)
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         print("\nServer stopped")
+        httpd.server_close()
         db_controller.close()
 
 
-
-
-
-
-
-
+if __name__ == '__main__':
+    main()
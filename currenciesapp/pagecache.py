@@ -0,0 +1,86 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+from routing import Response
+
+
+class PageCache:
+    """LRU-кэш готовых ответов, ограниченный числом записей и объёмом памяти
+
+    Ключ должен включать версии данных, от которых зависит страница, поэтому
+    после изменения данных старые записи просто перестают запрашиваться и
+    вытесняются по LRU. Ответ больше max_entry_bytes не кэшируется: такой
+    потоковый ответ не накапливается в памяти целиком.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 16 * 1024 * 1024,
+                 max_entry_bytes: int = 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def entry_limit(self) -> int:
+        """Наибольший объём одной записи"""
+        return min(self.max_entry_bytes, self.max_bytes)
+
+    @staticmethod
+    def _entry_size(response: Response) -> int:
+        return len(response.body) + sum(len(name) + len(value) for name, value in response.headers)
+
+    def get(self, key: Hashable) -> Optional[Response]:
+        """Ответ из кэша или None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        status, headers, body, _ = entry
+        return Response(body, status, headers)
+
+    def put(self, key: Hashable, response: Response):
+        """Сохранение ответа; слишком большие ответы не кэшируются"""
+        size = self._entry_size(response)
+        if size > self.entry_limit:
+            return
+
+        entry = (response.status, tuple(response.headers), response.body, size)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[3]
+            self._entries[key] = entry
+            self.size += size
+
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted[3]
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> Dict[str, float]:
+        """Счётчики попаданий и промахов"""
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / requests if requests else 0.0,
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,264 @@
+import multiprocessing
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+
+class _Flight:
+    """Одно выполняющееся обновление, которого могут ждать несколько потоков"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error: Optional[str] = None
+
+
+class SharedResult:
+    """Итог последнего обновления в памяти, общей для процессов после fork
+
+    Хранит last_success, last_failure (0 - не было) и текст last_error,
+    усечённый до ERROR_BYTES байт.
+    """
+
+    ERROR_BYTES = 1024
+
+    def __init__(self):
+        ctx = multiprocessing.get_context('fork')
+        self._times = ctx.RawArray('d', 2)
+        self._error = ctx.RawArray('c', self.ERROR_BYTES)
+        self._lock = ctx.Lock()
+
+    def publish(self, refresher: 'RateRefresher'):
+        error = (refresher.last_error or '').encode('utf-8')[:self.ERROR_BYTES - 1]
+        with self._lock:
+            self._times[:] = [refresher.last_success or 0.0, refresher.last_failure or 0.0]
+            self._error.value = error
+
+    def pull(self, refresher: 'RateRefresher'):
+        with self._lock:
+            success, failure = self._times[:]
+            error = self._error.value
+        refresher.last_success = success or None
+        refresher.last_failure = failure or None
+        refresher.last_error = error.decode('utf-8', 'ignore') or None
+
+
+class RateRefresher:
+    """Фоновое обновление курсов валют
+
+    fetch() получает курсы из внешнего источника, apply(rates) сохраняет их
+    в БД; значение, которое вернул apply (например, отчёт о загрузке),
+    доступно в last_result. Запросы страниц всегда читают БД и не ждут сети: устаревшие данные
+    отдаются сразу, а обновление запускается в фоне (stale-while-revalidate).
+    Одновременные запросы на обновление объединяются в одно обращение к
+    источнику. Планировщик повторяет обновление каждые interval секунд со
+    случайным отклонением jitter, чтобы процессы не обращались к ЦБ РФ
+    одновременно.
+
+    Если fetch() бросает исключение с атрибутом stale_data (данные из кэша
+    при недоступном источнике, см. lab7.StaleDataError), они передаются в
+    apply, но обновление считается неудачным: last_success не меняется.
+
+    После неудачного обновления запросы страниц не запускают новое раньше
+    retry_delay секунд; каждая следующая неудача подряд удваивает паузу,
+    но не больше interval. Иначе при недоступном источнике каждый запрос
+    устаревшей страницы обращался бы к нему снова.
+
+    Несколько процессов с общей БД обновляют курсы одним из них: после
+    share() итог обновлений попадает в общую память, а процессы, вызвавшие
+    follow(), к источнику не обращаются и только читают этот итог.
+    """
+
+    def __init__(self, fetch: Callable[[], Dict[str, float]],
+                 apply: Callable[[Dict[str, float]], Any],
+                 interval: float = 300.0, jitter: float = 0.1, retry_delay: float = 5.0):
+        if interval <= 0:
+            raise ValueError('Интервал обновления должен быть положительным')
+        if retry_delay < 0:
+            raise ValueError('Пауза после ошибки не может быть отрицательной')
+        if not 0 <= jitter < 1:
+            raise ValueError('Отклонение интервала должно быть в диапазоне [0, 1)')
+
+        self.fetch = fetch
+        self.apply = apply
+        self.interval = interval
+        self.jitter = jitter
+        self.retry_delay = retry_delay
+        # Запуск обновления из запросов страниц, когда данные устарели
+        self.on_demand = True
+
+        self.last_success: Optional[float] = None
+        self.last_failure: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.last_result: Any = None
+        self.fetches = 0
+        self.failures = 0
+        # Неудачных обновлений подряд после последнего успешного
+        self.consecutive_failures = 0
+        self.coalesced = 0
+
+        self._lock = threading.Lock()
+        self._flight: Optional[_Flight] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._shared: Optional[SharedResult] = None
+        self.follower = False
+
+    @property
+    def error(self) -> Optional[str]:
+        """Ошибка последнего обновления, если после неё не было успешного"""
+        if self.last_failure is None:
+            return None
+        if self.last_success is not None and self.last_success > self.last_failure:
+            return None
+        return self.last_error
+
+    def age(self) -> Optional[float]:
+        """Секунд с последнего успешного обновления"""
+        if self.last_success is None:
+            return None
+        return max(0.0, time.time() - self.last_success)
+
+    def is_stale(self) -> bool:
+        age = self.age()
+        return age is None or age >= self.interval
+
+    def retry_in(self) -> float:
+        """Секунд до конца паузы после неудачных обновлений (0 - паузы нет)"""
+        if not self.consecutive_failures:
+            return 0.0
+        backoff = min(self.retry_delay * 2 ** (self.consecutive_failures - 1), self.interval)
+        return max(0.0, self.last_failure + backoff - time.time())
+
+    def refresh(self, wait: bool = True) -> Optional[str]:
+        """Обновление курсов; возвращает текст ошибки или None
+
+        Если обновление уже выполняется, новое не начинается: вызывающий
+        поток дожидается текущего (при wait) и получает его результат.
+        """
+        with self._lock:
+            flight = self._flight
+            leader = flight is None
+            if leader:
+                flight = self._flight = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not wait:
+                return None
+            flight.done.wait()
+            return flight.error
+
+        try:
+            flight.error = self._run()
+            if self._shared is not None:
+                self._shared.publish(self)
+        finally:
+            with self._lock:
+                self._flight = None
+            flight.done.set()
+        return flight.error
+
+    def _run(self) -> Optional[str]:
+        self.fetches += 1
+        try:
+            result = self.apply(self.fetch())
+        except Exception as e:
+            error = e
+            stale_data = getattr(e, 'stale_data', None)
+            if stale_data is not None:
+                # Сохранённые данные применяются, но обновление не состоялось
+                try:
+                    self.last_result = self.apply(stale_data)
+                except Exception as apply_error:
+                    error = apply_error
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = str(error)
+            self.last_failure = time.time()
+            return self.last_error
+        self.last_result = result
+        self.last_success = time.time()
+        self.consecutive_failures = 0
+        return None
+
+    def trigger(self) -> bool:
+        """Запуск обновления в фоновом потоке; False, если оно уже идёт"""
+        with self._lock:
+            if self._flight is not None:
+                self.coalesced += 1
+                return False
+        threading.Thread(target=self.refresh, name='rates-refresh', daemon=True).start()
+        return True
+
+    def maybe_refresh(self) -> bool:
+        """Фоновое обновление устаревших данных, не блокирующее запрос
+
+        В ведомом процессе (follow) вместо обновления читается итог ведущего.
+        """
+        if self.follower:
+            self._shared.pull(self)
+            return False
+        if self.on_demand and self.is_stale() and not self.retry_in():
+            return self.trigger()
+        return False
+
+    def next_delay(self) -> float:
+        """Интервал до следующего обновления с учётом случайного отклонения"""
+        return self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def _schedule(self):
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(self.next_delay())
+
+    def share(self):
+        """Итог обновлений в общей памяти для процессов, созданных fork после вызова"""
+        if self._shared is None:
+            self._shared = SharedResult()
+            self._shared.publish(self)
+
+    def follow(self):
+        """Процесс не обновляет курсы сам, а читает итог ведущего (после share)"""
+        if self._shared is None:
+            raise RuntimeError('Итог обновлений не общий: сначала вызовите share()')
+        self.follower = True
+        self._shared.pull(self)
+
+    def start(self):
+        """Запуск планировщика; первое обновление выполняется сразу"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._schedule, name='rates-scheduler',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def status(self) -> Dict:
+        """Состояние обновления для мониторинга"""
+        if self.follower:
+            self._shared.pull(self)
+        age = self.age()
+        return {
+            'last_success': self.last_success,
+            'last_failure': self.last_failure,
+            'last_error': self.last_error,
+            'last_result': self.last_result,
+            'age': round(age, 3) if age is not None else None,
+            'stale': self.is_stale(),
+            'retry_in': round(self.retry_in(), 3),
+            'refreshing': self._flight is not None,
+            'follower': self.follower,
+            'interval': self.interval,
+            'fetches': self.fetches,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'coalesced': self.coalesced,
+        }
@@ -0,0 +1,493 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from http import HTTPStatus
+from typing import (Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Tuple)
+from urllib.parse import urlparse, parse_qs
+
+from metrics import NULL_TIMER
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class Request:
+    """HTTP-запрос, не зависящий от транспорта"""
+
+    def __init__(self, method: str, target: str, headers: Optional[Dict[str, str]] = None,
+                 body: bytes = b'', version: str = 'HTTP/1.1'):
+        parsed = urlparse(target)
+        self.method = method.upper()
+        self.version = version
+        self.target = target
+        self.path = parsed.path
+        self.query_string = parsed.query
+        self.query = parse_qs(parsed.query)
+        self.headers = {name.lower(): value for name, value in (headers or {}).items()}
+        self.body = body
+        # Параметры маршрута (из шаблона пути и объявленных query-параметров)
+        self.params: Dict[str, Any] = {}
+
+    def param(self, name: str, default=None):
+        """Первое значение параметра строки запроса"""
+        return self.query.get(name, [default])[0]
+
+    def form(self) -> Dict[str, List[str]]:
+        """Данные формы из тела запроса"""
+        return parse_qs(self.body.decode('utf-8'))
+
+
+STREAM_CHUNK_SIZE = 16 * 1024
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+def dumps(data: Any) -> bytes:
+    """Компактный JSON в UTF-8; через orjson, если он установлен"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return _json_encoder.encode(data).encode('utf-8')
+
+
+class Response:
+    """HTTP-ответ, не зависящий от транспорта
+
+    Тело задаётся целиком (body) или потоком байтовых фрагментов (chunks,
+    обычный или асинхронный итератор), который транспорт передаёт с
+    Transfer-Encoding: chunked.
+    """
+
+    def __init__(self, body: bytes = b'', status: int = 200,
+                 headers: Optional[List[Tuple[str, str]]] = None, chunks=None):
+        self.body = body
+        self.status = status
+        self.headers = list(headers or [])
+        self.chunks = chunks
+
+    @property
+    def reason(self) -> str:
+        try:
+            return HTTPStatus(self.status).phrase
+        except ValueError:
+            return ''
+
+    @classmethod
+    def redirect(cls, location: str, status: int = 303) -> 'Response':
+        return cls(status=status, headers=[('Location', location)])
+
+    @classmethod
+    def json(cls, data: Any, status: int = 200) -> 'Response':
+        return cls(dumps(data), status, [('Content-Type', 'application/json; charset=utf-8')])
+
+    @classmethod
+    def html(cls, text: str, status: int = 200) -> 'Response':
+        return cls(text.encode('utf-8'), status,
+                   [('Content-Type', 'text/html; charset=utf-8')])
+
+
+def encode_chunks(pieces: Iterable[str], size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    """Склейка строк из Template.generate() в UTF-8 фрагменты размером около size"""
+    buffer, buffered = [], 0
+    for piece in pieces:
+        data = piece.encode('utf-8')
+        buffer.append(data)
+        buffered += len(data)
+        if buffered >= size:
+            yield b''.join(buffer)
+            buffer, buffered = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+async def encode_chunks_async(pieces: AsyncIterator[str],
+                              size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Асинхронный вариант encode_chunks для Template.generate_async()"""
+    buffer, buffered = [], 0
+    async for piece in pieces:
+        data = piece.encode('utf-8')
+        buffer.append(data)
+        buffered += len(data)
+        if buffered >= size:
+            yield b''.join(buffer)
+            buffer, buffered = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+class Page:
+    """Результат обработчика, который ещё нужно отрендерить шаблоном
+
+    Если status не указан, используется статус, объявленный маршрутом.
+    """
+
+    def __init__(self, template: str, context: Dict[str, Any], status: Optional[int] = None):
+        self.template = template
+        self.context = context
+        self.status = status
+
+
+class HTTPError(Exception):
+    """Ошибка, которую маршрутизатор превращает в страницу ошибки"""
+
+    def __init__(self, status: int, message: str, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = list(headers or [])
+
+
+class Route:
+    """Описание маршрута: обработчик, методы, статус и заголовки ответа"""
+
+    _PARAM = re.compile(r'{(\w+)(?::(int|str))?}')
+    _CONVERTERS = {'int': (r'\d+', int), 'str': (r'[^/]+', str)}
+
+    def __init__(self, path: str, handler: Callable[[Request], Any], methods=('GET',),
+                 status: int = 200, headers=None, query=None,
+                 cache: bool = False, depends_on=(), vary=None):
+        self.path = path
+        self.handler = handler
+        self.methods = frozenset(method.upper() for method in methods)
+        self.status = status
+        self.headers = list(headers or [])
+        # Обязательные query-параметры: имя -> функция преобразования
+        self.query = dict(query or {})
+        # Можно ли кэшировать ответ и от каких таблиц БД он зависит
+        self.cache = cache
+        self.depends_on = tuple(depends_on)
+        # Дополнительная часть ключа кэша, вычисляемая по запросу
+        self.vary = vary
+
+        self.converters: Dict[str, Callable[[str], Any]] = {}
+        self.pattern = None
+        if self._PARAM.search(path):
+            self.pattern = re.compile('^' + self._PARAM.sub(self._compile_param, path) + '$')
+
+    def _compile_param(self, match) -> str:
+        name, kind = match.group(1), match.group(2) or 'str'
+        regex, converter = self._CONVERTERS[kind]
+        self.converters[name] = converter
+        return f'(?P<{name}>{regex})'
+
+    def bind(self, request: Request, path_params: Dict[str, str]):
+        """Заполнение request.params с проверкой и преобразованием типов"""
+        params = {name: self.converters[name](value) for name, value in path_params.items()}
+        for name, converter in self.query.items():
+            if name in params:
+                continue
+            value = request.param(name)
+            if not value:
+                raise HTTPError(400, f'Не указан параметр {name}')
+            try:
+                params[name] = converter(value)
+            except ValueError:
+                raise HTTPError(400, f'Некорректное значение параметра {name}')
+        request.params = params
+
+
+class Router:
+    """Таблица маршрутов
+
+    Статические пути ищутся в словаре за O(1), пути с параметрами
+    ({id:int}) - по заранее скомпилированным регулярным выражениям.
+    """
+
+    def __init__(self):
+        self._static: Dict[str, Route] = {}
+        self._patterns: List[Route] = []
+
+    def add(self, route: Route) -> Route:
+        if route.pattern is None:
+            self._static[route.path] = route
+        else:
+            self._patterns.append(route)
+        return route
+
+    def route(self, path: str, **kwargs):
+        """Декоратор регистрации обработчика"""
+        def decorator(handler):
+            self.add(Route(path, handler, **kwargs))
+            return handler
+        return decorator
+
+    def match(self, path: str) -> Tuple[Optional[Route], Dict[str, str]]:
+        route = self._static.get(path)
+        if route is not None:
+            return route, {}
+        for route in self._patterns:
+            found = route.pattern.match(path)
+            if found:
+                return route, found.groupdict()
+        return None, {}
+
+    def resolve(self, request: Request) -> Route:
+        """Поиск маршрута для запроса; HTTPError 404/405/400 при неудаче"""
+        route, path_params = self.match(request.path)
+        if route is None:
+            raise HTTPError(404, 'Страница не найдена')
+        if request.method not in route.methods:
+            raise HTTPError(405, 'Метод не поддерживается',
+                            [('Allow', ', '.join(sorted(route.methods)))])
+        route.bind(request, path_params)
+        return route
+
+
+class Application:
+    """Общий слой маршрутизации для синхронного и асинхронного серверов
+
+    Обработчики маршрутов выполняют всю блокирующую работу (SQLite) и
+    возвращают Response или Page.
+    error_page(message, status) строит страницу для HTTPError и исключений.
+
+    Ответ маршрута с cache=True определяется путём, параметрами запроса,
+    route.vary(request) и версиями таблиц depends_on, которые возвращает
+    data_state(depends_on) вместе со временем их последнего изменения.
+    Из этого строятся ETag и Last-Modified: на условный запрос с
+    совпадающими валидаторами сразу отдаётся 304, иначе ответ ищется в
+    cache. В обоих случаях ни БД, ни шаблоны не затрагиваются.
+
+    При stream=True страницы рендерятся потоком через Template.generate():
+    фрагменты уходят клиенту по мере готовности, и память на запрос не
+    растёт с размером страницы. Потоковый ответ попадает в кэш, только если
+    уложился в лимит одной записи (PageCache.max_entry_bytes): больший ответ
+    не накапливается. Ошибка шаблона даёт страницу 500. В потоковом режиме
+    так обрабатывается только ошибка загрузки шаблона:
+    при ошибке во время генерации статус уже отправлен, и соединение
+    закрывается.
+
+    Если задан metrics (metrics.Metrics), каждый запрос записывается в него:
+    итог по маршруту и статусу и время фаз db и render.
+    """
+
+    METRIC_METHODS = frozenset({'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'})
+
+    def __init__(self, router: Router, env, async_env=None, error_page=None,
+                 cache=None, data_state=None, etag_salt: Optional[str] = None,
+                 stream: bool = False, metrics=None):
+        self.router = router
+        self.metrics = metrics
+        self.stream = stream
+        self.env = env
+        self.async_env = async_env
+        self.error_page = error_page
+        self.cache = cache
+        self.data_state = data_state
+        # Соль отличает ETag разных запусков: версии in-memory БД начинаются заново
+        self.etag_salt = etag_salt or os.urandom(8).hex()
+
+    @staticmethod
+    def _not_modified(request: Request, etag: str, modified: Optional[float]) -> bool:
+        """Проверка If-None-Match / If-Modified-Since"""
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match is not None:
+            tags = {tag.strip() for tag in if_none_match.split(',')}
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+
+        if_modified_since = request.headers.get('if-modified-since')
+        if if_modified_since and modified is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(modified) <= since
+        return False
+
+    def _lookup(self, route: Route, request: Request):
+        """Валидаторы ответа и готовый ответ (304 или из кэша), если он есть"""
+        if self.data_state is None or not route.cache or request.method != 'GET':
+            return None, None
+
+        versions, modified = self.data_state(route.depends_on)
+        vary = route.vary(request) if route.vary is not None else None
+        key = (request.path, request.query_string, versions, vary)
+
+        digest = hashlib.sha1(repr((self.etag_salt, key)).encode('utf-8')).hexdigest()
+        etag = f'"{digest[:20]}"'
+        headers = [('ETag', etag)]
+        if modified is not None:
+            headers.append(('Last-Modified', formatdate(modified, usegmt=True)))
+
+        if self._not_modified(request, etag, modified):
+            return None, Response(status=304, headers=headers + route.headers)
+
+        cached = self.cache.get(key) if self.cache is not None else None
+        return (key, headers), cached
+
+    def _store(self, validators, response: Response) -> Response:
+        if validators is not None and response.status == 200:
+            key, headers = validators
+            response.headers.extend(headers)
+            if self.cache is None:
+                pass
+            elif response.chunks is None:
+                self.cache.put(key, response)
+            elif hasattr(response.chunks, '__aiter__'):
+                response.chunks = self._tee_async(key, response, response.chunks)
+            else:
+                response.chunks = self._tee(key, response, response.chunks)
+        return response
+
+    def _tee(self, key, response: Response, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Передача фрагментов с одновременным накоплением для кэша
+
+        Как только ответ превышает лимит записи кэша, накопленное
+        освобождается, и дальше фрагменты только передаются.
+        """
+        parts, size, limit = [], 0, self.cache.entry_limit
+        for chunk in chunks:
+            if parts is not None:
+                size += len(chunk)
+                if size <= limit:
+                    parts.append(chunk)
+                else:
+                    parts = None
+            yield chunk
+        if parts is not None:
+            self.cache.put(key, Response(b''.join(parts), response.status, response.headers))
+
+    async def _tee_async(self, key, response: Response,
+                         chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        parts, size, limit = [], 0, self.cache.entry_limit
+        async for chunk in chunks:
+            if parts is not None:
+                size += len(chunk)
+                if size <= limit:
+                    parts.append(chunk)
+                else:
+                    parts = None
+            yield chunk
+        if parts is not None:
+            self.cache.put(key, Response(b''.join(parts), response.status, response.headers))
+
+    def _error(self, status: int, message: str, headers=()):
+        page = self.error_page(f'{status} - {message}', status)
+        return page, headers
+
+    def _call(self, route: Route, request: Request):
+        """Вызов обработчика с преобразованием ошибок в страницы"""
+        try:
+            return route.handler(request), route.headers
+        except HTTPError as e:
+            return self._error(e.status, e.message, e.headers)
+        except Exception as e:
+            return self._error(500, f'Внутренняя ошибка сервера: {str(e)}')
+
+    def _resolve(self, request: Request):
+        try:
+            return self.router.resolve(request), None
+        except HTTPError as e:
+            return None, self._error(e.status, e.message, e.headers)
+
+    def _finish(self, route: Optional[Route], result, headers, html: Optional[str] = None,
+                chunks=None) -> Response:
+        if html is not None or chunks is not None:
+            status = result.status or (route.status if route else 200)
+            result = Response.html(html or '', status)
+            result.chunks = chunks
+        result.headers.extend(headers)
+        return result
+
+    def _timer(self, request: Request):
+        if self.metrics is None:
+            return NULL_TIMER
+        method = request.method if request.method in self.METRIC_METHODS else 'OTHER'
+        return self.metrics.request(method)
+
+    def respond(self, request: Request) -> Response:
+        """Синхронная обработка запроса"""
+        timer = self._timer(request)
+        try:
+            return timer.finish(self._respond(request, timer))
+        except BaseException:
+            timer.fail()
+            raise
+
+    def _respond(self, request: Request, timer) -> Response:
+        route, failed = self._resolve(request)
+        validators = None
+        if route is None:
+            result, headers = failed
+        else:
+            timer.route = route.path
+            validators, ready = self._lookup(route, request)
+            if ready is not None:
+                return ready
+            started = time.perf_counter()
+            result, headers = self._call(route, request)
+            timer.phase('db', started)
+
+        if isinstance(result, Page):
+            try:
+                return self._render(route, validators, result, headers, timer)
+            except Exception as e:
+                page, headers = self._error(500, f'Внутренняя ошибка сервера: {str(e)}')
+                html = self.env.get_template(page.template).render(**page.context)
+                return self._finish(None, page, headers, html)
+        return self._store(validators, self._finish(route, result, headers))
+
+    def _render(self, route: Route, validators, result: Page, headers, timer) -> Response:
+        template = self.env.get_template(result.template)
+        if self.stream:
+            chunks = timer.render_chunks(encode_chunks(template.generate(**result.context)))
+            return self._store(validators, self._finish(route, result, headers, chunks=chunks))
+        started = time.perf_counter()
+        html = template.render(**result.context)
+        timer.phase('render', started)
+        return self._store(validators, self._finish(route, result, headers, html))
+
+    async def respond_async(self, request: Request, executor=None) -> Response:
+        """Асинхронная обработка: блокирующая работа уходит в пул потоков"""
+        timer = self._timer(request)
+        try:
+            return timer.finish(await self._respond_async(request, timer, executor))
+        except BaseException:
+            timer.fail()
+            raise
+
+    async def _respond_async(self, request: Request, timer, executor) -> Response:
+        loop = asyncio.get_running_loop()
+
+        route, failed = self._resolve(request)
+        validators = None
+        if route is None:
+            result, headers = failed
+        else:
+            timer.route = route.path
+            if route.cache:
+                # Версии файловой БД читаются запросом, поэтому не в цикле событий
+                validators, ready = await loop.run_in_executor(
+                    executor, self._lookup, route, request)
+                if ready is not None:
+                    return ready
+            started = time.perf_counter()
+            result, headers = await loop.run_in_executor(executor, self._call, route, request)
+            timer.phase('db', started)
+
+        if isinstance(result, Page):
+            try:
+                return await self._render_async(route, validators, result, headers, timer)
+            except Exception as e:
+                page, headers = self._error(500, f'Внутренняя ошибка сервера: {str(e)}')
+                html = await self.async_env.get_template(page.template).render_async(
+                    **page.context)
+                return self._finish(None, page, headers, html)
+        return self._store(validators, self._finish(route, result, headers))
+
+    async def _render_async(self, route: Route, validators, result: Page, headers,
+                            timer) -> Response:
+        template = self.async_env.get_template(result.template)
+        if self.stream:
+            chunks = timer.render_chunks_async(
+                encode_chunks_async(template.generate_async(**result.context)))
+            return self._store(validators, self._finish(route, result, headers, chunks=chunks))
+        started = time.perf_counter()
+        html = await template.render_async(**result.context)
+        timer.phase('render', started)
+        return self._store(validators, self._finish(route, result, headers, html))
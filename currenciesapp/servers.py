@@ -0,0 +1,396 @@
+import asyncio
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer
+from multiprocessing import RawArray
+
+from routing import Request, Response
+
+MAX_HEADER_LINES = 100
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """HTTP-сервер с ограниченным пулом рабочих потоков
+
+    Принятые соединения ставятся в очередь ограниченной длины и
+    обрабатываются фиксированным числом потоков. Если очередь заполнена,
+    клиент сразу получает 503 вместо бесконечного ожидания. Постоянное
+    соединение занимает поток, пока открыто, поэтому время простоя
+    ограничивается обработчиком; has_waiting() говорит ему, что потоки
+    нужны ожидающим соединениям.
+    """
+
+    def __init__(self, server_address, handler_class, workers: int = 8,
+                 queue_size: int = 64, bind_and_activate: bool = True):
+        if workers < 1:
+            raise ValueError('Число рабочих потоков должно быть положительным')
+        if queue_size < 1:
+            raise ValueError('Длина очереди должна быть положительной')
+
+        self.request_queue_size = queue_size
+        super().__init__(server_address, handler_class, bind_and_activate)
+
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = [
+            threading.Thread(target=self._worker, name=f'http-worker-{i}', daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def process_request(self, request, client_address):
+        """Передача соединения в пул вместо обработки в главном потоке"""
+        try:
+            self._queue.put_nowait((request, client_address))
+        except queue.Full:
+            self._reject(request)
+
+    def has_waiting(self) -> bool:
+        """Есть ли принятые соединения, ожидающие свободного потока"""
+        return not self._queue.empty()
+
+    def _worker(self):
+        """Цикл рабочего потока"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def _reject(self, request):
+        """Отказ в обслуживании при переполненной очереди"""
+        try:
+            request.sendall(
+                b'HTTP/1.1 503 Service Unavailable\r\n'
+                b'Content-Length: 0\r\n'
+                b'Retry-After: 1\r\n'
+                b'Connection: close\r\n\r\n'
+            )
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def server_close(self):
+        """Остановка рабочих потоков и закрытие сокета"""
+        super().server_close()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+class AsyncHTTPServer:
+    """HTTP/1.1-сервер на asyncio поверх общего слоя маршрутизации
+
+    Соединения обслуживаются корутинами, поэтому простаивающие keep-alive
+    соединения не занимают потоков. SQLite-запросы выполняются в пуле
+    workers.
+    """
+
+    def __init__(self, app, workers: int = 8, idle_timeout: float = 15.0, max_requests: int = 100):
+        self.app = app
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='db')
+
+    async def _read_request(self, reader) -> Request:
+        """Чтение одного запроса; None, если клиент закрыл соединение"""
+        request_line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+        if not request_line:
+            return None
+
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            raise ValueError('Некорректная строка запроса')
+
+        headers = {}
+        for _ in range(MAX_HEADER_LINES):
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise ValueError('Слишком много заголовков')
+
+        length = int(headers.get('content-length') or 0)
+        if length > MAX_BODY_SIZE:
+            raise ValueError('Слишком большое тело запроса')
+        body = await reader.readexactly(length) if length else b''
+
+        return Request(method, target, headers, body, version)
+
+    def _keep_alive(self, request: Request) -> bool:
+        connection = request.headers.get('connection', '').lower()
+        if request.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    async def _write_response(self, writer, response: Response, keep_alive: bool,
+                              version: str = 'HTTP/1.1') -> bool:
+        """Запись ответа; возвращает, остаётся ли соединение открытым"""
+        chunked = response.chunks is not None and version != 'HTTP/1.0'
+        if response.chunks is not None and not chunked:
+            # Клиенты HTTP/1.0 не понимают chunked: конец тела - закрытие соединения
+            keep_alive = False
+        head = [f'HTTP/1.1 {response.status} {response.reason}']
+        head += [f'{name}: {value}' for name, value in response.headers]
+        if chunked:
+            head.append('Transfer-Encoding: chunked')
+        elif response.status != 304:
+            head.append(f'Content-Length: {len(response.body)}')
+        head.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+        head = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1')
+        if response.chunks is None:
+            writer.write(head + response.body)
+            await writer.drain()
+            return keep_alive
+
+        writer.write(head)
+        if hasattr(response.chunks, '__aiter__'):
+            async for chunk in response.chunks:
+                writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk)
+                await writer.drain()
+        else:
+            for chunk in response.chunks:
+                writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk)
+                await writer.drain()
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        return keep_alive
+
+    async def handle_connection(self, reader, writer):
+        """Обслуживание одного соединения, в том числе нескольких запросов подряд"""
+        try:
+            for handled in range(1, self.max_requests + 1):
+                try:
+                    request = await self._read_request(reader)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except ValueError:
+                    await self._write_response(writer, Response(status=400), False)
+                    break
+                if request is None:
+                    break
+
+                response = await self.app.respond_async(request, self.executor)
+                keep_alive = handled < self.max_requests and self._keep_alive(request)
+                keep_alive = await self._write_response(writer, response, keep_alive,
+                                                        request.version)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int, ready=None):
+        """Запуск сервера; ready(server) вызывается после открытия сокета"""
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        if ready is not None:
+            ready(server)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def serve_async(app, host: str, port: int, workers: int = 8, idle_timeout: float = 15.0,
+                max_requests: int = 100):
+    """Запуск асинхронного сервера до прерывания"""
+    server = AsyncHTTPServer(app, workers=workers, idle_timeout=idle_timeout,
+                             max_requests=max_requests)
+    try:
+        asyncio.run(server.serve(host, port))
+    finally:
+        server.close()
+
+
+def _counting_handler(handler_class, counts, slot: int):
+    """Обработчик, учитывающий каждый ответ в ячейке slot общего массива"""
+    lock = threading.Lock()
+
+    class CountingHandler(handler_class):
+        def log_request(self, *args, **kwargs):
+            with lock:
+                counts[slot] += 1
+            super().log_request(*args, **kwargs)
+
+    return CountingHandler
+
+
+class PreforkSupervisor:
+    """Запуск нескольких рабочих процессов на одном порту
+
+    Если доступен SO_REUSEPORT, каждый процесс открывает свой сокет и ядро
+    равномерно распределяет соединения между ними; иначе процессы принимают
+    соединения с общего сокета, унаследованного от родителя. Упавшие
+    процессы перезапускаются, число обслуженных запросов по процессам
+    периодически выводится в stdout. after_fork(slot) вызывается в рабочем
+    процессе с номером slot (0..processes-1) до начала обслуживания.
+    """
+
+    def __init__(self, server_factory, handler_class, address, processes: int = 2,
+                 after_fork=None, stats_interval: float = 10.0, reuse_port=None):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('Режим prefork требует os.fork()')
+        if processes < 1:
+            raise ValueError('Число процессов должно быть положительным')
+
+        self.server_factory = server_factory
+        self.handler_class = handler_class
+        self.processes = processes
+        self.after_fork = after_fork
+        self.stats_interval = stats_interval
+        if reuse_port is None:
+            reuse_port = hasattr(socket, 'SO_REUSEPORT')
+        self.reuse_port = reuse_port
+
+        self.counts = RawArray('q', processes)
+        self.pids = [0] * processes
+        self._stopping = False
+        # Обработчик SIGHUP приложения (перезагрузка шаблонов) выполняется
+        # в рабочих процессах, родитель только пересылает им сигнал
+        self._sighup = getattr(signal, 'SIGHUP', None)
+        self._worker_sighup = signal.getsignal(self._sighup) if self._sighup else None
+
+        # Родительский сокет резервирует порт; в режиме SO_REUSEPORT
+        # он не переводится в режим прослушивания и соединений не получает
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(address)
+        if not self.reuse_port:
+            self.socket.listen(128)
+        self.server_address = self.socket.getsockname()
+
+    def _make_server(self, slot: int):
+        handler = _counting_handler(self.handler_class, self.counts, slot)
+        server = self.server_factory(self.server_address, handler, bind_and_activate=False)
+        if self.reuse_port:
+            server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            server.server_bind()
+            server.server_activate()
+        else:
+            server.socket.close()
+            server.socket = self.socket
+            server.server_address = self.server_address
+        return server
+
+    def _run_worker(self, slot: int):
+        """Тело рабочего процесса"""
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        if self._sighup is not None:
+            signal.signal(self._sighup, self._worker_sighup)
+        code = 0
+        try:
+            if self.reuse_port:
+                self.socket.close()
+            if self.after_fork is not None:
+                self.after_fork(slot)
+            self._make_server(slot).serve_forever()
+        except BaseException:
+            sys.excepthook(*sys.exc_info())
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _spawn(self, slot: int):
+        pid = os.fork()
+        if pid == 0:
+            self._run_worker(slot)
+        self.pids[slot] = pid
+
+    def start(self):
+        """Запуск всех рабочих процессов"""
+        for slot in range(self.processes):
+            self._spawn(slot)
+
+    def reap(self):
+        """Перезапуск завершившихся рабочих процессов"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid in self.pids:
+                slot = self.pids.index(pid)
+                self.pids[slot] = 0
+                if not self._stopping:
+                    print(f'worker {slot} (pid {pid}) exited with status {status}, restarting',
+                          flush=True)
+                    self._spawn(slot)
+
+    def stats(self) -> str:
+        """Число обслуженных запросов по рабочим процессам"""
+        counts = list(self.counts)
+        lines = [f'worker {slot} pid={pid} requests={count}'
+                 for slot, (pid, count) in enumerate(zip(self.pids, counts))]
+        lines.append(f'total requests={sum(counts)}')
+        return '\n'.join(lines)
+
+    def signal_workers(self, signum: int):
+        """Отправка сигнала всем рабочим процессам"""
+        for pid in self.pids:
+            if pid:
+                try:
+                    os.kill(pid, signum)
+                except ProcessLookupError:
+                    pass
+
+    def stop(self):
+        """Остановка всех рабочих процессов"""
+        self._stopping = True
+        self.signal_workers(signal.SIGTERM)
+        for pid in self.pids:
+            if pid:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+        self.socket.close()
+
+    def serve_forever(self, poll_interval: float = 0.5):
+        """Цикл надзора до SIGINT/SIGTERM"""
+        def request_stop(signum, frame):
+            self._stopping = True
+
+        signal.signal(signal.SIGTERM, request_stop)
+        if self._sighup is not None:
+            signal.signal(self._sighup, lambda signum, frame: self.signal_workers(signum))
+        self.start()
+        next_stats = time.monotonic() + self.stats_interval
+        try:
+            while not self._stopping:
+                time.sleep(poll_interval)
+                self.reap()
+                if self.stats_interval and time.monotonic() >= next_stats:
+                    print(self.stats(), flush=True)
+                    next_stats = time.monotonic() + self.stats_interval
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            print(self.stats(), flush=True)
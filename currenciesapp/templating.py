@@ -0,0 +1,95 @@
+import os
+import signal
+import threading
+from typing import List, Optional
+
+from jinja2 import (Environment, FileSystemBytecodeCache, FileSystemLoader, ModuleLoader,
+                    select_autoescape)
+
+
+class TemplateSet:
+    """Синхронное и асинхронное окружения Jinja2 над одним каталогом шаблонов
+
+    В режиме разработки шаблоны перечитываются с диска при изменении. В
+    режиме production проверка файлов отключена, скомпилированный байт-код
+    сохраняется на диск (cache_dir), а шаблоны могут быть заранее собраны
+    в Python-модули (compiled_dir). Все шаблоны прогреваются при запуске,
+    изменения подхватываются только по явному reload(), например по SIGHUP.
+    """
+
+    def __init__(self, templates_dir: str):
+        self.templates_dir = templates_dir
+        self.source_loader = FileSystemLoader(templates_dir)
+        self.env = Environment(loader=self.source_loader, autoescape=select_autoescape())
+        self.async_env = Environment(loader=self.source_loader, autoescape=select_autoescape(),
+                                     enable_async=True)
+        self.production = False
+        self.cache_dir: Optional[str] = None
+        self.compiled_dir: Optional[str] = None
+        self._reload_lock = threading.RLock()
+
+    def _environments(self):
+        """Окружения с именами подкаталогов для их байт-кода и модулей
+
+        Код синхронных и асинхронных шаблонов различается, поэтому у каждого
+        окружения свой каталог.
+        """
+        return (('sync', self.env), ('async', self.async_env))
+
+    def configure(self, production: bool = False, cache_dir: Optional[str] = None,
+                  compiled_dir: Optional[str] = None):
+        """Переключение режима работы и прогрев всех шаблонов"""
+        self.production = production
+        self.cache_dir = cache_dir
+        self.compiled_dir = compiled_dir
+
+        for name, env in self._environments():
+            env.auto_reload = not production
+            env.bytecode_cache = None
+            if cache_dir:
+                path = os.path.join(cache_dir, name)
+                os.makedirs(path, exist_ok=True)
+                env.bytecode_cache = FileSystemBytecodeCache(path)
+
+        self.reload()
+
+    def template_names(self) -> List[str]:
+        return self.source_loader.list_templates()
+
+    def compile(self, target_dir: str):
+        """Сборка всех шаблонов в Python-модули и переключение на них"""
+        for name, env in self._environments():
+            path = os.path.join(target_dir, name)
+            os.makedirs(path, exist_ok=True)
+            env.loader = self.source_loader
+            env.compile_templates(path, zip=None, ignore_errors=False)
+            env.loader = ModuleLoader(path)
+
+    def warm(self) -> List[str]:
+        """Загрузка и компиляция всех шаблонов заранее"""
+        names = self.template_names()
+        for _, env in self._environments():
+            for name in names:
+                env.get_template(name)
+        return names
+
+    def reload(self):
+        """Сброс скомпилированных шаблонов и повторный прогрев"""
+        with self._reload_lock:
+            if self.compiled_dir:
+                self.compile(self.compiled_dir)
+            else:
+                for _, env in self._environments():
+                    env.loader = self.source_loader
+            for _, env in self._environments():
+                env.cache.clear()
+            self.warm()
+
+    def install_reload_signal(self, reload=None, signum: Optional[int] = None):
+        """Вызов reload (по умолчанию self.reload) по сигналу, по умолчанию SIGHUP"""
+        if signum is None:
+            signum = getattr(signal, 'SIGHUP', None)
+            if signum is None:
+                return
+        reload = reload or self.reload
+        signal.signal(signum, lambda received, frame: reload())
@@ -1,6 +1,21 @@
 import unittest
 from unittest.mock import patch, Mock
 import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import gzip
+import io
+import logging
+from logging.handlers import QueueListener, RotatingFileHandler
+import queue
+
+from lab7 import (CBRClient, CircuitBreaker, DeferredQueueHandler, JsonLinesFormatter,
+                  ProcessLogQueue, RatesCache, StaleDataError, get_currencies, gzip_namer,
+                  gzip_rotator, logger)
 
 
 
@@ -128,5 +143,401 @@ class TestGetCurrenciesSimple(unittest.TestCase):
                 get_currencies_simple(["USD"])
 
 
+class StubCBRHandler(BaseHTTPRequestHandler):
+    """Локальная замена API ЦБ РФ с поддержкой ETag"""
+
+    payload = {"Valute": {"USD": {"Value": 90.5}, "EUR": {"Value": 98.2}}}
+    etag = '"v1"'
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.send_header('ETag', self.etag)
+            self.end_headers()
+            return
+        body = json.dumps(self.payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', self.etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestRatesCache(unittest.TestCase):
+
+    def setUp(self):
+        StubCBRHandler.requests = []
+        self.server = HTTPServer(('127.0.0.1', 0), StubCBRHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/daily_json.js'
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.snapshot = os.path.join(tmp.name, 'snapshot.json')
+        self.client = CBRClient(retries=0)
+
+    def stop_server(self):
+        self.server.shutdown()
+
+    def test_ttl_hit(self):
+        """Повторные вызовы в пределах TTL не обращаются к сети"""
+        cache = RatesCache(ttl=60, client=self.client)
+        first = cache.get(self.url)
+        with patch.object(self.client.session, 'get') as session_get:
+            for _ in range(1000):
+                self.assertIs(cache.get(self.url), first)
+        session_get.assert_not_called()
+        self.assertEqual(len(StubCBRHandler.requests), 1)
+        self.assertEqual((cache.stats['hits'], cache.stats['downloads']), (1000, 1))
+
+    def test_conditional_request(self):
+        """После TTL данные проверяются условным запросом"""
+        cache = RatesCache(ttl=0, client=self.client)
+        first = cache.get(self.url)
+        second = cache.get(self.url)
+        self.assertIs(second, first)
+        self.assertEqual(StubCBRHandler.requests, [None, '"v1"'])
+        self.assertEqual(cache.stats['not_modified'], 1)
+
+    def test_snapshot_cold_start(self):
+        """После перезапуска курсы берутся из снимка без сети"""
+        RatesCache(ttl=60, snapshot_path=self.snapshot, client=self.client).get(self.url)
+        self.stop_server()
+
+        cache = RatesCache(ttl=60, snapshot_path=self.snapshot, client=self.client)
+        self.assertEqual(cache.get(self.url)["Valute"]["USD"]["Value"], 90.5)
+        self.assertEqual(cache.etag, '"v1"')
+        self.assertEqual(len(StubCBRHandler.requests), 1)
+
+    def test_stale_if_error(self):
+        """При недоступном API отдаются не слишком старые данные"""
+        cache = RatesCache(ttl=0, snapshot_path=self.snapshot, client=self.client)
+        cache.get(self.url)
+        self.stop_server()
+        self.server.server_close()
+
+        fetched_at = cache.fetched_at
+        with self.assertRaises(StaleDataError) as ctx:
+            cache.get(self.url)
+        self.assertIn("Valute", ctx.exception.stale_data)
+        self.assertEqual(ctx.exception.fetched_at, fetched_at)
+        self.assertEqual(cache.stats['stale'], 1)
+
+        # get_currencies передаёт курсы из сохранённого ответа в исключении
+        with self.assertRaises(StaleDataError) as ctx:
+            get_currencies.__wrapped__(['USD'], self.url, cache)
+        self.assertEqual(ctx.exception.stale_data, {'USD': 90.5})
+
+        cache.max_stale = 0
+        with self.assertRaises(ConnectionError) as ctx:
+            cache.get(self.url)
+        self.assertNotIsInstance(ctx.exception, StaleDataError)
+
+    def test_invalid_payload_not_cached(self):
+        cache = RatesCache(ttl=60, client=self.client)
+        with patch.object(StubCBRHandler, 'payload', {}):
+            self.assertEqual(cache.get(self.url), {})
+        self.assertIsNone(cache.data)
+
+
+class FlakyHandler(StubCBRHandler):
+    """Замена API, отвечающая 503 первые failures раз"""
+
+    failures = 0
+
+    def do_GET(self):
+        if FlakyHandler.failures > 0:
+            FlakyHandler.failures -= 1
+            self.requests.append('503')
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        super().do_GET()
+
+
+class TestCBRClient(unittest.TestCase):
+
+    def setUp(self):
+        StubCBRHandler.requests = []
+        self.server = HTTPServer(('127.0.0.1', 0), FlakyHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/daily_json.js'
+
+    def test_retry_with_backoff(self):
+        FlakyHandler.failures = 2
+        client = CBRClient(retries=2, backoff=0.01)
+        response = client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(client.counters['retries'], 2)
+        self.assertEqual(client.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_backoff_grows_exponentially(self):
+        client = CBRClient(backoff=0.5, backoff_max=4)
+        for attempt, limit in enumerate([0.5, 1, 2, 4, 4]):
+            delay = client.backoff_delay(attempt)
+            self.assertTrue(limit / 2 <= delay <= limit)
+
+    def test_breaker_fails_fast_and_recovers(self):
+        FlakyHandler.failures = 1000
+        client = CBRClient(retries=0, breaker=CircuitBreaker(failure_threshold=3,
+                                                             reset_timeout=0.2))
+        for _ in range(3):
+            with self.assertRaises(ConnectionError):
+                client.get(self.url)
+        self.assertEqual(client.breaker.state, CircuitBreaker.OPEN)
+
+        requests_before = len(StubCBRHandler.requests)
+        with patch.object(client.session, 'get', wraps=client.session.get) as session_get:
+            with self.assertRaises(ConnectionError):
+                client.get(self.url)
+        session_get.assert_not_called()
+        self.assertEqual(len(StubCBRHandler.requests), requests_before)
+        self.assertEqual(client.counters['rejected'], 1)
+
+        # После reset_timeout пробное обращение замыкает цепь
+        FlakyHandler.failures = 0
+        time.sleep(0.25)
+        self.assertEqual(client.get(self.url).status_code, 200)
+        stats = client.stats()
+        self.assertEqual(stats['breaker'], CircuitBreaker.CLOSED)
+        self.assertEqual(stats['trips'], 1)
+        self.assertIsNotNone(stats['latency_ms']['p99'])
+
+    def test_unexpected_error_in_probe_reopens_breaker(self):
+        client = CBRClient(retries=0, breaker=CircuitBreaker(failure_threshold=1,
+                                                             reset_timeout=0))
+        client.breaker.record_failure()
+        with patch.object(client.session, 'get', side_effect=ValueError('ошибка разбора')):
+            with self.assertRaises(ValueError):
+                client.get(self.url)
+        # Пробное обращение завершилось неудачей, а не оставило цепь в half_open
+        self.assertEqual(client.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(client.get(self.url).status_code, 200)
+        self.assertEqual(client.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_single_probe(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+
+class TestLogger(unittest.TestCase):
+    """Декоратор logger: строки JSON, усечение, выборка, очередь"""
+
+    def setUp(self):
+        self.log = logging.getLogger(f'test.lab7.{self.id()}')
+        self.log.propagate = False
+        self.log.setLevel(logging.INFO)
+        self.stream = io.StringIO()
+        handler = logging.StreamHandler(self.stream)
+        handler.setFormatter(JsonLinesFormatter())
+        self.log.addHandler(handler)
+        self.addCleanup(self.log.removeHandler, handler)
+
+    def records(self):
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_call_record_fields(self):
+        @logger(handle=self.log)
+        def add(a, b=0):
+            return {'sum': a + b}
+
+        self.assertEqual(add(1, b=2), {'sum': 3})
+        [record] = self.records()
+        self.assertEqual(record['event'], 'return')
+        self.assertEqual(record['function'], 'add')
+        self.assertEqual(record['level'], 'INFO')
+        self.assertEqual(record['args'], '(1,)')
+        self.assertEqual(record['kwargs'], "{'b': 2}")
+        self.assertEqual(record['result'], {'sum': 3})
+        self.assertGreaterEqual(record['duration_ms'], 0)
+
+    def test_long_values_are_truncated(self):
+        @logger(handle=self.log, max_repr=50)
+        def echo(value):
+            return value
+
+        echo('x' * 10000)
+        [record] = self.records()
+        self.assertLessEqual(len(record['args']), 50)
+        self.assertIsInstance(record['result'], str)
+        self.assertLessEqual(len(record['result']), 50)
+
+    def test_errors_are_logged_without_sampling(self):
+        @logger(handle=self.log, sample=0)
+        def fail(ok):
+            if not ok:
+                raise ValueError('плохо')
+            return ok
+
+        fail(True)
+        with self.assertRaises(ValueError):
+            fail(False)
+        [record] = self.records()
+        self.assertEqual(record['event'], 'error')
+        self.assertEqual(record['level'], 'ERROR')
+        self.assertEqual(record['error'], 'ValueError: плохо')
+
+    def test_disabled_level_skips_record(self):
+        self.log.setLevel(logging.ERROR)
+        calls = []
+
+        @logger(handle=self.log)
+        def work(value):
+            calls.append(value)
+            return value
+
+        with patch('lab7.CallRecord') as record:
+            self.assertEqual(work(5), 5)
+        record.assert_not_called()
+        self.assertEqual(calls, [5])
+        self.assertEqual(self.stream.getvalue(), '')
+
+    def test_stream_handle_writes_json_lines(self):
+        stream = io.StringIO()
+
+        @logger(handle=stream)
+        def square(x):
+            return x * x
+
+        square(3)
+        record = json.loads(stream.getvalue())
+        self.assertEqual((record['function'], record['result']), ('square', 9))
+
+    def test_rotation_compresses_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'currency_log.txt')
+            handler = RotatingFileHandler(path, maxBytes=200, backupCount=2, encoding='utf-8')
+            handler.namer = gzip_namer
+            handler.rotator = gzip_rotator
+            handler.setFormatter(JsonLinesFormatter())
+            self.log.addHandler(handler)
+
+            @logger(handle=self.log)
+            def rate(i):
+                return i
+
+            for i in range(10):
+                rate(i)
+            self.log.removeHandler(handler)
+            handler.close()
+
+            self.assertEqual(sorted(os.listdir(tmp)), ['currency_log.txt', 'currency_log.txt.1.gz',
+                                                       'currency_log.txt.2.gz'])
+            with gzip.open(path + '.1.gz', 'rt', encoding='utf-8') as f:
+                older = [json.loads(line)['result'] for line in f]
+            with open(path, encoding='utf-8') as f:
+                newer = [json.loads(line)['result'] for line in f]
+            self.assertEqual(older + newer, list(range(10 - len(older) - len(newer), 10)))
+
+    def test_queue_formats_on_listener_thread(self):
+        threads = []
+
+        class Formatter(JsonLinesFormatter):
+            def format(self, record):
+                threads.append(threading.current_thread())
+                return super().format(record)
+
+        log = logging.getLogger(f'test.lab7.queue.{self.id()}')
+        log.propagate = False
+        log.setLevel(logging.INFO)
+        stream = io.StringIO()
+        target = logging.StreamHandler(stream)
+        target.setFormatter(Formatter())
+        log_queue = queue.SimpleQueue()
+        handler = DeferredQueueHandler(log_queue)
+        log.addHandler(handler)
+        self.addCleanup(log.removeHandler, handler)
+        listener = QueueListener(log_queue, target)
+        listener.start()
+
+        @logger(handle=log)
+        def ping():
+            return 'pong'
+
+        for _ in range(3):
+            ping()
+        listener.stop()
+        self.assertEqual([json.loads(line)['result'] for line in stream.getvalue().splitlines()],
+                         ['pong'] * 3)
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_record_does_not_see_later_mutation(self):
+        log_queue = queue.SimpleQueue()
+        handler = DeferredQueueHandler(log_queue)
+        self.log.addHandler(handler)
+        self.addCleanup(self.log.removeHandler, handler)
+
+        @logger(handle=self.log)
+        def rates(codes):
+            return {code: 1.0 for code in codes}
+
+        codes = ['USD']
+        result = rates(codes)
+        # Вызывающий код меняет аргумент и результат до записи журнала
+        codes.append('EUR')
+        result['EUR'] = 2.0
+        fields = log_queue.get_nowait().msg.fields()
+        self.assertEqual((fields['args'], fields['result']), ("(['USD'],)", {'USD': 1.0}))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'нужен os.fork()')
+    def test_processes_share_one_writer(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'currency_log.txt')
+            target = RotatingFileHandler(path, maxBytes=2000, backupCount=50, encoding='utf-8')
+            target.namer = gzip_namer
+            target.rotator = gzip_rotator
+            target.setFormatter(JsonLinesFormatter())
+            log_queue = ProcessLogQueue()
+            handler = DeferredQueueHandler(log_queue)
+            self.log.addHandler(handler)
+            self.addCleanup(self.log.removeHandler, handler)
+            listener = QueueListener(log_queue, target)
+            listener.start()
+
+            @logger(handle=self.log)
+            def rate(worker, i):
+                return {'worker': worker, 'i': i}
+
+            pids = []
+            for worker in range(3):
+                pid = os.fork()
+                if pid == 0:
+                    handler.picklable = True
+                    try:
+                        for i in range(50):
+                            rate(worker, i)
+                    finally:
+                        os._exit(0)
+                pids.append(pid)
+            for pid in pids:
+                self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            listener.stop()
+            target.close()
+
+            results = []
+            for name in os.listdir(tmp):
+                opener = gzip.open if name.endswith('.gz') else open
+                with opener(os.path.join(tmp, name), 'rt', encoding='utf-8') as f:
+                    results.extend(json.loads(line)['result'] for line in f)
+            self.assertGreater(len(os.listdir(tmp)), 2)
+            self.assertEqual(sorted((r['worker'], r['i']) for r in results),
+                             [(worker, i) for worker in range(3) for i in range(50)])
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -1,6 +1,11 @@
 import unittest
 from jinja2 import Environment, FileSystemLoader, select_autoescape
+import asyncio
 import os
+import shutil
+import tempfile
+
+from templating import TemplateSet
 
 
 class TestJinjaTemplates(unittest.TestCase):
@@ -321,5 +326,56 @@ class TestJinjaTemplates(unittest.TestCase):
         self.assertEqual(result.count('<tr>'), 4)  # 3 пользователя + 1 заголовок
 
 
+class TestTemplateSet(unittest.TestCase):
+    """Тесты режима production для шаблонов"""
+
+    def setUp(self):
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.templates_dir = os.path.join(self.tmp, 'templates')
+        shutil.copytree(os.path.join(current_dir, 'templates'), self.templates_dir)
+        self.templates = TemplateSet(self.templates_dir)
+
+    def _write_template(self, name, text):
+        with open(os.path.join(self.templates_dir, name), 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    def test_production_bytecode_cache(self):
+        cache_dir = os.path.join(self.tmp, 'cache')
+        self.templates.configure(production=True, cache_dir=cache_dir)
+
+        self.assertFalse(self.templates.env.auto_reload)
+        # Байт-код всех шаблонов записан на диск при прогреве
+        count = len(self.templates.template_names())
+        self.assertEqual(len(os.listdir(os.path.join(cache_dir, 'sync'))), count)
+        self.assertEqual(len(os.listdir(os.path.join(cache_dir, 'async'))), count)
+
+    def test_precompiled_modules(self):
+        self.templates.configure(production=True,
+                                 compiled_dir=os.path.join(self.tmp, 'compiled'))
+
+        result = self.templates.env.get_template('error.html').render(
+            app_name='Test', navigation=[], error_message='Нет данных', status_code=404)
+        self.assertIn('Нет данных', result)
+
+        template = self.templates.async_env.get_template('error.html')
+        result = asyncio.run(template.render_async(
+            app_name='Test', navigation=[], error_message='Асинхронно', status_code=500))
+        self.assertIn('Асинхронно', result)
+
+    def test_explicit_reload(self):
+        self._write_template('probe.html', 'v1')
+        self.templates.configure(production=True, cache_dir=os.path.join(self.tmp, 'cache'))
+        self.assertEqual(self.templates.env.get_template('probe.html').render(), 'v1')
+
+        # Без reload изменения файла не подхватываются
+        self._write_template('probe.html', 'v2')
+        self.assertEqual(self.templates.env.get_template('probe.html').render(), 'v1')
+
+        self.templates.reload()
+        self.assertEqual(self.templates.env.get_template('probe.html').render(), 'v2')
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,7 +1,29 @@
+import asyncio
+import http.client
+import gzip
+import json
+import os
+import re
+import signal
+import socket
+import tempfile
+import threading
+import time
 import unittest
+from http.server import BaseHTTPRequestHandler
 from unittest.mock import MagicMock, patch
 from controllers.currencycontr import CurrencyController
+from controllers.databasecontr import DatabaseController
 from controllers.usercontr import UserController
+import logingest
+from models import Currency, User, UserCurrency
+from metrics import Metrics
+from pagecache import PageCache
+import routing
+from refresher import RateRefresher
+from routing import HTTPError, Request, Response, Router
+from servers import AsyncHTTPServer, PreforkSupervisor, ThreadPoolHTTPServer
+import myapp
 
 
 class TestCurrencyController(unittest.TestCase):
@@ -12,10 +34,8 @@ class TestCurrencyController(unittest.TestCase):
 
     def test_list_currencies(self):
         # Подготовка тестовых данных
-        test_data = [
-            {'id': 1, 'num_code': '840', 'char_code': 'USD', 'name': 'Доллар США', 'value': 90.5, 'nominal': 1}
-        ]
-        self.mock_db.read_currencies.return_value = test_data
+        test_data = [(1, '840', 'USD', 'Доллар США', 90.5, 1)]
+        self.mock_db.read_currency_rows.return_value = test_data
 
         # Выполнение теста
         result = self.controller.list_currencies()
@@ -24,7 +44,8 @@ class TestCurrencyController(unittest.TestCase):
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].char_code, 'USD')
         self.assertEqual(result[0].value, 90.5)
-        self.mock_db.read_currencies.assert_called_once()
+        self.assertEqual(result[0].id, '1')
+        self.mock_db.read_currency_rows.assert_called_once()
 
     def test_create_currency(self):
         # Подготовка тестовых данных
@@ -67,6 +88,28 @@ class TestCurrencyController(unittest.TestCase):
         self.assertTrue(result)
         self.mock_db.delete_currency.assert_called_once_with(1)
 
+    def test_ingest_valute_partial(self):
+        # Некорректные записи попадают в отчёт, остальные сохраняются одним пакетом
+        self.mock_db.bulk_upsert_currencies.return_value = 2
+        valute = {
+            'USD': {'NumCode': '840', 'CharCode': 'USD', 'Name': 'Доллар США',
+                    'Value': 91.0, 'Nominal': 1},
+            'AUD': {'NumCode': '036', 'CharCode': 'AUD', 'Name': 'Австралийский доллар',
+                    'Value': 60.1, 'Nominal': 1},
+            'XXX': {'NumCode': '999', 'CharCode': 'XXX', 'Name': 'Ошибка', 'Value': 'n/a',
+                    'Nominal': 1},
+            'YYY': {'CharCode': 'YYY'},
+        }
+
+        report = self.controller.ingest_valute(valute)
+
+        self.assertEqual(report['received'], 4)
+        self.assertEqual(report['stored'], 2)
+        self.assertEqual(report['changed'], 2)
+        self.assertEqual(set(report['errors']), {'XXX', 'YYY'})
+        rows = self.mock_db.bulk_upsert_currencies.call_args[0][0]
+        self.assertEqual([row['char_code'] for row in rows], ['USD', 'AUD'])
+
 
 class TestUserController(unittest.TestCase):
 
@@ -76,11 +119,8 @@ class TestUserController(unittest.TestCase):
 
     def test_list_users(self):
         # Подготовка тестовых данных
-        test_data = [
-            {'id': 1, 'name': 'Leisan'},
-            {'id': 2, 'name': 'Rashit'}
-        ]
-        self.mock_db.read_users.return_value = test_data
+        test_data = [(1, 'Leisan'), (2, 'Rashit')]
+        self.mock_db.read_user_rows.return_value = test_data
 
         # Выполнение теста
         result = self.controller.list_users()
@@ -89,14 +129,13 @@ class TestUserController(unittest.TestCase):
         self.assertEqual(len(result), 2)
         self.assertEqual(result[0].name, 'Leisan')
         self.assertEqual(result[1].name, 'Rashit')
-        self.mock_db.read_users.assert_called_once()
+        self.assertEqual(result[1].id, '2')
+        self.mock_db.read_user_rows.assert_called_once()
 
     def test_get_user_subscriptions(self):
         # Подготовка тестовых данных
-        test_data = [
-            {'id': 1, 'num_code': '840', 'char_code': 'USD', 'name': 'Доллар США', 'value': 90.5, 'nominal': 1}
-        ]
-        self.mock_db.get_user_subscriptions.return_value = test_data
+        test_data = [(1, '840', 'USD', 'Доллар США', 90.5, 1)]
+        self.mock_db.get_user_subscription_rows.return_value = test_data
 
         # Выполнение теста
         result = self.controller.get_user_subscriptions(1)
@@ -104,7 +143,1422 @@ class TestUserController(unittest.TestCase):
         # Проверки
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].char_code, 'USD')
-        self.mock_db.get_user_subscriptions.assert_called_once_with(1)
+        self.mock_db.get_user_subscription_rows.assert_called_once_with(1)
+
+
+class TestModels(unittest.TestCase):
+
+    def test_from_row_matches_from_dict(self):
+        db = DatabaseController()
+        db.seed_initial_data()
+        self.addCleanup(db.close)
+        for row, data in zip(db.read_currency_rows(), db.read_currencies()):
+            fast, slow = Currency.from_row(row), Currency.from_dict(data)
+            self.assertEqual((fast.id, fast.to_dict()), (slow.id, slow.to_dict()))
+        user = User.from_row(db.read_user_rows()[0])
+        self.assertEqual((user.id, user.name), ('1', db.read_user(1)['name']))
+
+    def test_slots_keep_validation(self):
+        currency = Currency.from_row((1, '840', 'USD', 'Доллар США', 90.5, 1))
+        self.assertFalse(hasattr(currency, '__dict__'))
+        with self.assertRaises(AttributeError):
+            currency.rate = 1.0
+        with self.assertRaises(ValueError):
+            currency.value = -1
+        currency.char_code = 'eur'
+        self.assertEqual(currency.char_code, 'EUR')
+
+        subscription = UserCurrency.from_row((1, 2, 3))
+        self.assertEqual((subscription.user_id, subscription.currency_id), ('2', '3'))
+        with self.assertRaises(ValueError):
+            subscription.user_id = 2
+
+
+class TestSubscriptionLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DatabaseController()
+        self.db.seed_initial_data()
+        self.addCleanup(self.db.close)
+        self.controller = UserController(self.db)
+
+    def test_loads_are_coalesced(self):
+        loader = self.controller.subscription_loader()
+        loader.load('1').load('2')
+        loader.load_many(['2', '999'])
+        self.assertEqual(loader.batches, 0)
+
+        codes = [currency.char_code for currency in loader['1']]
+        self.assertEqual(codes, sorted(c.char_code for c in self.controller.get_user_subscriptions(1)))
+        self.assertEqual(loader['999'], [])
+        self.assertEqual(loader.batches, 1)
+        # Ключ, не запрошенный заранее, загружается отдельным пакетом
+        loader['3']
+        self.assertEqual(loader.batches, 2)
+
+    def test_users_page_query_count_is_constant(self):
+        def count_selects(users):
+            self.db.bulk_create_users(f'user{i}' for i in range(users))
+            self.db.bulk_add_subscriptions((user['id'], 1) for user in self.db.read_users())
+            statements = []
+            self.db.conn.set_trace_callback(statements.append)
+            try:
+                with patch.object(myapp, 'user_controller', self.controller):
+                    response = myapp.users(Request('GET', '/users'))
+                    html = myapp.env.get_template(response.template).render(response.context)
+            finally:
+                self.db.conn.set_trace_callback(None)
+            return html, sum(s.lstrip().upper().startswith('SELECT') for s in statements)
+
+        _, few = count_selects(5)
+        html, many = count_selects(200)
+        self.assertEqual(few, many)
+        self.assertIn('<th>Подписки</th>', html)
+
+
+class TestDatabaseControllerThreads(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DatabaseController(':memory:')
+        self.db.seed_initial_data()
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_connection_per_thread(self):
+        # Каждый поток получает своё соединение, но видит общие данные
+        results = {}
+
+        def worker():
+            results['conn'] = self.db.conn
+            results['users'] = self.db.read_users()
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+
+        self.assertIsNot(results['conn'], self.db.conn)
+        self.assertEqual(len(results['users']), 2)
+
+    def test_concurrent_writes(self):
+        # Параллельные записи из разных потоков не теряются
+        def worker(n):
+            for i in range(20):
+                self.db.create_user(f'user-{n}-{i}')
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.db.read_users()), 2 + 4 * 20)
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    """Обработчик с фиксированной задержкой ответа"""
+
+    def do_GET(self):
+        time.sleep(0.2)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestThreadPoolHTTPServer(unittest.TestCase):
+
+    def _start(self, **kwargs):
+        httpd = ThreadPoolHTTPServer(('127.0.0.1', 0), SlowHandler, **kwargs)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        return httpd.server_address[1]
+
+    def _get(self, port):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('GET', '/')
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        return response.status
+
+    def test_requests_processed_in_parallel(self):
+        # 4 медленных запроса на 4 потоках выполняются примерно за время одного
+        port = self._start(workers=4, queue_size=8)
+        statuses = []
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=lambda: statuses.append(self._get(port)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        self.assertEqual(statuses, [200] * 4)
+        self.assertLess(elapsed, 0.6)
+
+    def test_invalid_pool_size(self):
+        with self.assertRaises(ValueError):
+            ThreadPoolHTTPServer(('127.0.0.1', 0), SlowHandler, workers=0)
+
+
+class FastHandler(SlowHandler):
+    """Обработчик, отвечающий без задержки"""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'требуется os.fork()')
+class TestPreforkSupervisor(unittest.TestCase):
+
+    def _get(self, port):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('GET', '/')
+        status = conn.getresponse().status
+        conn.close()
+        return status
+
+    def test_workers_serve_and_restart(self):
+        def make_server(address, handler, bind_and_activate=True):
+            return ThreadPoolHTTPServer(address, handler, workers=2,
+                                        bind_and_activate=bind_and_activate)
+
+        supervisor = PreforkSupervisor(make_server, FastHandler, ('127.0.0.1', 0),
+                                       processes=2, stats_interval=0)
+        port = supervisor.server_address[1]
+        supervisor.start()
+        try:
+            time.sleep(0.3)
+            for _ in range(10):
+                self.assertEqual(self._get(port), 200)
+            self.assertEqual(sum(supervisor.counts), 10)
+
+            # Упавший процесс перезапускается в той же ячейке
+            crashed = supervisor.pids[0]
+            os.kill(crashed, signal.SIGKILL)
+            time.sleep(0.3)
+            supervisor.reap()
+            self.assertNotIn(crashed, supervisor.pids)
+            self.assertTrue(all(supervisor.pids))
+
+            time.sleep(0.3)
+            self.assertEqual(self._get(port), 200)
+        finally:
+            supervisor.stop()
+
+
+class TestRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.router = Router()
+        self.router.route('/items')(lambda request: 'list')
+        self.router.route('/item', query={'id': int})(lambda request: 'query')
+        self.router.route('/item/{id:int}', methods=('GET', 'POST'))(lambda request: 'path')
+
+    def test_static_route(self):
+        route = self.router.resolve(Request('GET', '/items'))
+        self.assertEqual(route.handler(None), 'list')
+
+    def test_pattern_route(self):
+        request = Request('POST', '/item/42')
+        route = self.router.resolve(request)
+        self.assertEqual(route.handler(request), 'path')
+        self.assertEqual(request.params, {'id': 42})
+
+    def test_query_params(self):
+        request = Request('GET', '/item?id=7')
+        self.router.resolve(request)
+        self.assertEqual(request.params, {'id': 7})
+
+        with self.assertRaises(HTTPError) as ctx:
+            self.router.resolve(Request('GET', '/item?id=abc'))
+        self.assertEqual(ctx.exception.status, 400)
+
+    def test_not_found_and_method_not_allowed(self):
+        with self.assertRaises(HTTPError) as ctx:
+            self.router.resolve(Request('GET', '/nothing'))
+        self.assertEqual(ctx.exception.status, 404)
+
+        with self.assertRaises(HTTPError) as ctx:
+            self.router.resolve(Request('DELETE', '/items'))
+        self.assertEqual(ctx.exception.status, 405)
+        self.assertIn(('Allow', 'GET'), ctx.exception.headers)
+
+
+class TestApplication(unittest.TestCase):
+
+    def test_index_page(self):
+        response = myapp.app.respond(Request('GET', '/'))
+        self.assertEqual(response.status, 200)
+        self.assertIn('Главная страница', response.body.decode('utf-8'))
+
+    def test_error_statuses(self):
+        self.assertEqual(myapp.app.respond(Request('GET', '/missing')).status, 404)
+        self.assertEqual(myapp.app.respond(Request('GET', '/user')).status, 400)
+        self.assertEqual(myapp.app.respond(Request('POST', '/missing')).status, 404)
+        self.assertEqual(myapp.app.respond(Request('POST', '/users')).status, 405)
+        self.assertEqual(myapp.app.respond(Request('GET', '/user/999')).status, 404)
+
+    def test_user_page_by_path(self):
+        response = myapp.app.respond(Request('GET', '/user/1'))
+        self.assertEqual(response.status, 200)
+        self.assertIn('Leisan', response.body.decode('utf-8'))
+
+    def test_currencies_upstream_error(self):
+        # При недоступном API показываются данные из БД
+        with patch('myapp.get_currencies', side_effect=ConnectionError('API недоступен')), \
+                patch.object(myapp.refresher, 'on_demand', False):
+            myapp.refresher.refresh()
+            response = myapp.app.respond(Request('GET', '/currencies'))
+        self.assertEqual(response.status, 200)
+        self.assertIn('API недоступен', response.body.decode('utf-8'))
+
+    def test_template_error_returns_500(self):
+        from jinja2 import DictLoader, Environment
+
+        templates = {'broken.html': '{{ missing.attribute }}',
+                     'error.html': '{{ status_code }}: {{ error_message }}'}
+        router = Router()
+        router.route('/broken')(lambda request: routing.Page('broken.html', {}))
+        app = routing.Application(
+            router, Environment(loader=DictLoader(templates)),
+            Environment(loader=DictLoader(templates), enable_async=True),
+            error_page=lambda message, status: routing.Page(
+                'error.html', {'error_message': message, 'status_code': status}, status))
+
+        for response in (app.respond(Request('GET', '/broken')),
+                         asyncio.run(app.respond_async(Request('GET', '/broken')))):
+            self.assertEqual(response.status, 500)
+            self.assertIn("'missing' is undefined", response.body.decode('utf-8'))
+
+    def test_async_server_keep_alive(self):
+        # Два запроса по одному соединению к асинхронному серверу
+        async def scenario():
+            server = AsyncHTTPServer(myapp.app, workers=2)
+            listener = await asyncio.start_server(server.handle_connection, '127.0.0.1', 0)
+            port = listener.sockets[0].getsockname()[1]
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                statuses = []
+                for path, connection in (('/author', 'keep-alive'), ('/users', 'close')):
+                    writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n'
+                                 f'Connection: {connection}\r\n\r\n'.encode())
+                    status_line = await reader.readline()
+                    headers = {}
+                    while (line := await reader.readline()) != b'\r\n':
+                        name, _, value = line.decode().partition(':')
+                        headers[name.lower()] = value.strip()
+                    await reader.readexactly(int(headers['content-length']))
+                    statuses.append(status_line.split()[1])
+                # После Connection: close сервер сам закрывает соединение
+                self.assertEqual(await reader.read(), b'')
+                writer.close()
+                return statuses
+            finally:
+                listener.close()
+                server.close()
+
+        self.assertEqual(asyncio.run(scenario()), [b'200', b'200'])
+
+
+class QuietAppHandler(myapp.SimpleHTTPRequestHandler):
+    """Обработчик приложения без журнала запросов"""
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestKeepAlive(unittest.TestCase):
+
+    def setUp(self):
+        httpd = ThreadPoolHTTPServer(('127.0.0.1', 0), QuietAppHandler, workers=2)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        self.port = httpd.server_address[1]
+
+    def test_persistent_connection(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        for path in ('/author', '/users', '/missing'):
+            conn.request('GET', path)
+            response = conn.getresponse()
+            body = response.read()
+            self.assertEqual(int(response.getheader('Content-Length')), len(body))
+            self.assertFalse(response.will_close)
+        self.assertEqual(response.status, 404)
+        conn.close()
+
+    def test_pipelined_requests(self):
+        # Два запроса отправлены сразу, ответы приходят по порядку
+        with socket.create_connection(('127.0.0.1', self.port), timeout=5) as sock:
+            sock.sendall(b'GET /author HTTP/1.1\r\nHost: x\r\n\r\n'
+                         b'GET /missing HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+            data = b''
+            while chunk := sock.recv(65536):
+                data += chunk
+
+        statuses = re.findall(rb'HTTP/1\.1 (\d{3}) ', data)
+        self.assertEqual(statuses, [b'200', b'404'])
+
+    def test_idle_connections_do_not_block_new_clients(self):
+        # Оба потока пула заняты простаивающими постоянными соединениями
+        idle = []
+        for _ in range(2):
+            conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+            conn.request('GET', '/author')
+            conn.getresponse().read()
+            idle.append(conn)
+        self.addCleanup(lambda: [conn.close() for conn in idle])
+
+        started = time.perf_counter()
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        conn.request('GET', '/author')
+        self.assertEqual(conn.getresponse().status, 200)
+        conn.close()
+        self.assertLess(time.perf_counter() - started, 1)
+
+    def test_idle_timeout(self):
+        with patch.object(QuietAppHandler, 'keepalive_timeout', 0.2), \
+                socket.create_connection(('127.0.0.1', self.port), timeout=5) as sock:
+            sock.sendall(b'GET /author HTTP/1.1\r\nHost: x\r\n\r\n')
+            started = time.perf_counter()
+            data = b''
+            while chunk := sock.recv(65536):
+                data += chunk
+        self.assertTrue(data.startswith(b'HTTP/1.1 200'))
+        self.assertLess(time.perf_counter() - started, 2)
+
+    def test_requests_per_connection_cap(self):
+        with patch.object(QuietAppHandler, 'max_keepalive_requests', 2):
+            conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+            conn.request('GET', '/author')
+            first = conn.getresponse()
+            first.read()
+            conn.request('GET', '/author')
+            second = conn.getresponse()
+            second.read()
+            conn.close()
+
+        self.assertFalse(first.will_close)
+        self.assertTrue(second.will_close)
+
+
+class TestDataVersions(unittest.TestCase):
+
+    def test_bulk_upsert_currencies(self):
+        db = DatabaseController()
+        db.seed_initial_data()
+        self.addCleanup(db.close)
+        rows = [
+            {'num_code': '840', 'char_code': 'USD', 'name': 'Доллар США', 'value': 92.0,
+             'nominal': 1},
+            {'num_code': '036', 'char_code': 'AUD', 'name': 'Австралийский доллар',
+             'value': 60.1, 'nominal': 1},
+            {'num_code': '978', 'char_code': 'EUR', 'name': 'Евро', 'value': 98.2, 'nominal': 1},
+        ]
+        version = db.table_versions()['currency']
+
+        # EUR не изменился и не считается
+        self.assertEqual(db.bulk_upsert_currencies(rows), 2)
+        self.assertEqual(db.table_versions()['currency'], version + 1)
+        self.assertEqual(db.read_currencies('USD')[0]['value'], 92.0)
+        self.assertEqual(len(db.read_currencies()), 5)
+
+        self.assertEqual(db.bulk_upsert_currencies(rows), 0)
+        self.assertEqual(db.table_versions()['currency'], version + 1)
+
+    def test_writes_bump_versions(self):
+        db = DatabaseController(':memory:')
+        self.addCleanup(db.close)
+        before = db.table_versions()
+
+        db.create_user('Ivan')
+        db.read_users()
+
+        after = db.table_versions()
+        self.assertEqual(after['user'], before['user'] + 1)
+        self.assertEqual(after['currency'], before['currency'])
+
+    def test_file_database_versions_shared(self):
+        # Изменения, сделанные другим процессом, видны через таблицу версий
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'test.db')
+            first = DatabaseController(path)
+            second = DatabaseController(path)
+            try:
+                before = first.data_version(('currency',))
+                second.create_currency({'num_code': '036', 'char_code': 'AUD',
+                                        'name': 'Австралийский доллар',
+                                        'value': 60.0, 'nominal': 1})
+                self.assertNotEqual(first.data_version(('currency',)), before)
+            finally:
+                first.close()
+                second.close()
+
+    def test_file_database_version_bumped_once_per_write(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = DatabaseController(os.path.join(tmp, 'test.db'))
+            try:
+                before = db.table_versions()
+                db.bulk_create_users(f'user{i}' for i in range(100))
+                db.bulk_add_subscriptions([])
+                after = db.table_versions()
+                self.assertEqual(after['user'], before['user'] + 1)
+                self.assertEqual(after['user_currency'], before['user_currency'])
+                # Версии не ведутся построчными триггерами
+                with db._read_cursor() as cursor:
+                    cursor.execute("SELECT name FROM sqlite_master "
+                                   "WHERE type = 'trigger' AND name LIKE '%_version_%'")
+                    self.assertEqual(cursor.fetchall(), [])
+            finally:
+                db.close()
+
+    def test_memory_database_has_no_version_table(self):
+        db = DatabaseController(':memory:')
+        self.addCleanup(db.close)
+        with db._read_cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE name = 'table_version'")
+            self.assertIsNone(cursor.fetchone())
+
+
+class TestBulkOperations(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DatabaseController()
+        self.db.seed_initial_data()
+        self.addCleanup(self.db.close)
+
+    def test_bulk_update_values(self):
+        changed = self.db.bulk_update_values({'USD': 95.0, 'EUR': 98.2, 'XYZ': 1.0})
+        self.assertEqual(changed, 1)
+        self.assertEqual(self.db.read_currencies('USD')[0]['value'], 95.0)
+
+    def test_bulk_users_and_subscriptions(self):
+        versions = self.db.table_versions()
+        self.assertEqual(self.db.bulk_create_users(f'user{i}' for i in range(1000)), 1000)
+        self.assertEqual(len(self.db.read_users()), 1002)
+
+        # Повторная подписка (1, 1) пропускается
+        added = self.db.bulk_add_subscriptions([(1, 1), (1, 4), (3, 1), (3, 2)])
+        self.assertEqual(added, 3)
+        self.assertEqual(len(self.db.get_user_subscriptions(1)), 3)
+
+        after = self.db.table_versions()
+        self.assertEqual(after['user'], versions['user'] + 1)
+        self.assertEqual(after['user_currency'], versions['user_currency'] + 1)
+
+    def test_batch_is_atomic(self):
+        with self.assertRaises(Exception):
+            self.db.bulk_create_users(['Анна', None])
+        self.assertEqual(len(self.db.read_users()), 2)
+
+    def test_reads_do_not_commit(self):
+        with patch.object(self.db, '_get_cursor', side_effect=AssertionError):
+            self.db.read_currencies()
+            self.db.read_users()
+            self.db.read_user(1)
+            self.db.get_user_subscriptions(1)
+        self.assertFalse(self.db.conn.in_transaction)
+
+
+class TestIdentityMap(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DatabaseController()
+        self.db.seed_initial_data()
+        self.addCleanup(self.db.close)
+        self.controller = CurrencyController(self.db, identity_map_size=2)
+
+    def test_hit_returns_same_object_without_query(self):
+        first = self.controller.get_currency(1)
+        with patch.object(self.db, 'read_currency', side_effect=AssertionError), \
+                patch.object(self.db, 'read_currencies', side_effect=AssertionError):
+            self.assertIs(self.controller.get_currency(1), first)
+            self.assertIs(self.controller.get_currency_by_char_code(first.char_code), first)
+        stats = self.controller.identity_map.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+        self.assertAlmostEqual(stats['hit_ratio'], 2 / 3)
+
+    def test_miss_reads_by_primary_key(self):
+        with patch.object(self.db, 'read_currencies', side_effect=AssertionError):
+            self.assertEqual(self.controller.get_currency(2).id, '2')
+            self.assertIsNone(self.controller.get_currency(999))
+
+    def test_write_invalidates(self):
+        before = self.controller.get_currency(1)
+        self.db.update_currency_value(1, 123.0)
+        after = self.controller.get_currency(1)
+        self.assertIsNot(after, before)
+        self.assertEqual(after.value, 123.0)
+        self.assertEqual(self.controller.identity_map.stats()['invalidations'], 1)
+
+    def test_size_is_bounded(self):
+        for currency_id in (1, 2, 3):
+            self.controller.get_currency(currency_id)
+        stats = self.controller.identity_map.stats()
+        self.assertEqual(stats['entries'], 2)
+        # Вытесненная валюта недоступна и по char_code
+        self.assertIsNone(self.controller.identity_map.get(1))
+
+    def test_read_before_invalidation_is_not_cached(self):
+        identity_map = self.controller.identity_map
+        generation = identity_map.generation
+        self.db.update_currency_value(1, 123.0)
+        identity_map.put(1, object(), generation)
+        self.assertEqual(identity_map.stats()['entries'], 0)
+
+    def test_user_controller(self):
+        users = UserController(self.db)
+        self.assertIs(users.get_user(1), users.get_user(1))
+        self.db.create_user('Анна')
+        self.assertEqual(users.identity_map.stats()['entries'], 0)
+
+
+class TestKeysetPagination(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DatabaseController()
+        self.db.seed_initial_data()
+        self.addCleanup(self.db.close)
+        self.db.bulk_create_users(f'user{i}' for i in range(8))
+
+    def test_pages_forward_and_back(self):
+        first = self.db.read_page('user', 4)
+        self.assertEqual([row[0] for row in first.rows], [1, 2, 3, 4])
+        self.assertIsNone(first.prev)
+        second = self.db.read_page('user', 4, first.next)
+        third = self.db.read_page('user', 4, second.next)
+        self.assertEqual([row[0] for row in third.rows], [9, 10])
+        self.assertIsNone(third.next)
+        self.assertEqual(self.db.read_page('user', 4, second.prev), first)
+
+    def test_sort(self):
+        page = self.db.read_page('currency', 2, sort='-char_code')
+        self.assertEqual([row[2] for row in page.rows], ['USD', 'JPY'])
+        page = self.db.read_page('currency', 2, page.next, sort='-char_code')
+        self.assertEqual([row[2] for row in page.rows], ['GBP', 'EUR'])
+        for sort, cursor in (('name', None), ('id', 'after:x'), ('id', 'next:1')):
+            with self.assertRaises(ValueError):
+                self.db.read_page('user', 2, cursor, sort)
+
+    def test_limit_is_pushed_into_sql(self):
+        statements = []
+        self.db.conn.set_trace_callback(statements.append)
+        try:
+            self.db.read_page('currency', 2, 'after:EUR')
+        finally:
+            self.db.conn.set_trace_callback(None)
+        self.assertIn('LIMIT', statements[-1])
+        with self.db._read_cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + statements[-1])
+            plan = ' '.join(row['detail'] for row in cursor.fetchall())
+        self.assertIn('USING INDEX', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_pages_and_links(self):
+        with patch.object(myapp, 'db_controller', self.db), \
+                patch.object(myapp, 'user_controller', UserController(self.db)):
+            response = myapp.users(Request('GET', '/users?limit=3&sort=id'))
+            self.assertEqual(len(response.context['users']), 3)
+            self.assertEqual(response.context['pages'],
+                             {'next': '/users?limit=3&sort=id&cursor=after%3A3', 'prev': None})
+            html = myapp.env.get_template(response.template).render(response.context)
+            self.assertIn('rel="next"', html)
+
+            body = json.loads(myapp.api_users(Request('GET', '/api/v1/users?limit=3&cursor=after%3A3')).body)
+            self.assertEqual([user['id'] for user in body['data']], [4, 5, 6])
+            self.assertEqual(body['links']['prev'], '/api/v1/users?limit=3&cursor=before%3A4')
+            self.assertEqual(myapp.api_users(Request('GET', '/api/v1/users?limit=0')).status, 400)
+            with self.assertRaises(HTTPError):
+                myapp.users(Request('GET', '/users?cursor=bad'))
+
+
+class TestRateHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DatabaseController()
+        self.db.seed_initial_data()
+        self.addCleanup(self.db.close)
+        self.usd = self.db.read_currencies('USD')[0]['id']
+
+    def test_changes_appended(self):
+        # Время точки хранится с точностью до миллисекунды
+        time.sleep(0.002)
+        self.db.bulk_update_values({'USD': 91.0})
+        self.db.bulk_update_values({'USD': 91.0})
+        time.sleep(0.002)
+        self.db.update_currency_value(self.usd, 92.0)
+        values = [point['value'] for point in self.db.read_rate_history(self.usd)]
+        # Начальное значение и два изменения; повторное 91.0 не записывается
+        self.assertEqual(values, [90.5, 91.0, 92.0])
+
+    def test_range_and_downsampling(self):
+        day = 86400
+        self.db.bulk_add_history((self.usd, i * day / 4, float(i), 1) for i in range(40))
+
+        window = self.db.read_rate_history(self.usd, day, 2 * day)
+        self.assertEqual([point['value'] for point in window], [4.0, 5.0, 6.0, 7.0])
+
+        last = self.db.read_rate_history_downsampled(self.usd, 'day', 'last', 0, 3 * day)
+        self.assertEqual([(p['ts'], p['value']) for p in last],
+                         [(0, 3.0), (day, 7.0), (2 * day, 11.0)])
+        mean = self.db.read_rate_history_downsampled(self.usd, 'day', 'mean', 0, day)
+        self.assertEqual(mean[0]['value'], 1.5)
+        # 1970-01-01 - четверг, неделя начинается с понедельника 29.12.1969
+        weeks = self.db.read_rate_history_downsampled(self.usd, 'week', 'last', 0, 10 * day)
+        self.assertEqual([p['ts'] for p in weeks], [-3 * day, 4 * day])
+
+    def test_range_scan_uses_index(self):
+        plan = ' '.join(self.db.explain_history_query(self.usd))
+        self.assertIn('USING PRIMARY KEY (currency_id=? AND ts>? AND ts<?)', plan)
+        self.assertNotIn('SCAN', plan)
+
+    def test_history_endpoint(self):
+        currency = myapp.currency_controller.get_currency_by_char_code('EUR')
+        myapp.db_controller.bulk_add_history(
+            (int(currency.id), 1700000000 + i * 3600, 100.0 + i, 1) for i in range(48))
+        response = myapp.app.respond(Request(
+            'GET', f'/currency/{currency.id}/history?start=2023-11-14&end=2023-11-17&step=day'))
+        data = json.loads(response.body)
+        self.assertEqual(data['char_code'], 'EUR')
+        self.assertEqual(len(data['points']), 3)
+        self.assertEqual(data['points'][-1][1], 147.0)
+
+        bad = myapp.app.respond(Request('GET', f'/currency/{currency.id}/history?step=year'))
+        self.assertEqual(bad.status, 400)
+        self.assertEqual(myapp.app.respond(Request('GET', '/currency/999/history')).status, 404)
+
+
+class TestLogIngest(unittest.TestCase):
+    """Загрузка истории курсов из журнала"""
+    TEXT = ("2025-12-05 19:38:38,911 - currency - INFO - INFO: get_currencies called with "
+            "args=(['USD', 'EUR'],), kwargs={{}}\n"
+            "2025-12-05 19:38:{:02d},000 - currency - INFO - INFO: get_currencies returned "
+            "{{'USD': {}, 'EUR': 88.7}}\n")
+
+    def setUp(self):
+        self.db = DatabaseController()
+        self.db.seed_initial_data()
+        self.addCleanup(self.db.close)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.log = os.path.join(tmp.name, 'currency_log.txt')
+        self.usd = self.db.read_currencies('USD')[0]['id']
+
+    def json_line(self, ts, usd, function='get_currencies', **rates):
+        return json.dumps({'time': '2025-12-06 10:00:00,000', 'ts': ts, 'level': 'INFO',
+                           'logger': 'currency', 'event': 'return', 'function': function,
+                           'duration_ms': 1.5, 'args': "(['USD'],)", 'kwargs': '{}',
+                           'result': {'USD': usd, **rates}}) + '\n'
+
+    def append(self, text):
+        with open(self.log, 'a', encoding='utf-8') as f:
+            f.write(text)
+
+    def history(self):
+        return [(point['ts'], point['value'])
+                for point in self.db.read_rate_history(self.usd, 1700000000, 1770000000)]
+
+    def test_both_formats(self):
+        self.append(self.TEXT.format(40, 76.0937))
+        self.append(self.json_line(1765000000.5, 77.5))
+        self.append(self.json_line(1765000001.0, 1.0, function='get_valute'))
+        stats = logingest.ingest(self.db, self.log)
+        self.assertEqual((stats.files, stats.points, stats.unknown), (1, 3, {}))
+        history = self.history()
+        self.assertEqual([value for _, value in history], [76.0937, 77.5])
+        self.assertAlmostEqual(history[0][0] % 1, 0.0, places=3)
+        self.assertEqual(history[1][0], 1765000000.5)
+
+    def test_unknown_currencies_keep_offset(self):
+        self.append(self.json_line(1765000000.0, 77.0))
+        logingest.ingest(self.db, self.log)
+        self.append(self.json_line(1765000001.0, 78.0, XYZ=1.5))
+        stats = logingest.ingest(self.db, self.log)
+        self.assertEqual((stats.points, stats.unknown), (2, {'XYZ': 1}))
+        self.assertEqual([value for _, value in self.history()], [77.0, 78.0])
+
+        # Блок с неизвестной валютой читается снова, пока валюту не добавят
+        self.assertEqual(logingest.ingest(self.db, self.log).unknown, {'XYZ': 1})
+        xyz = self.db.create_currency({'num_code': '999', 'char_code': 'XYZ', 'name': 'Test',
+                                       'value': None, 'nominal': 10})
+        stats = logingest.ingest(self.db, self.log)
+        self.assertEqual((stats.added, stats.unknown), (2, {}))
+        self.assertEqual([(p['value'], p['nominal']) for p in self.db.read_rate_history(xyz)],
+                         [(1.5, 10)])
+        self.assertEqual(logingest.ingest(self.db, self.log).bytes, 0)
+
+    def test_main_fails_when_points_are_dropped(self):
+        self.append(self.json_line(1765000000.0, 77.0, XYZ=1.5))
+        db_path = os.path.join(os.path.dirname(self.log), 'app.db')
+        with patch('sys.stdout'), patch('sys.stderr'):
+            self.assertEqual(logingest.main(['--db', db_path, '--log', self.log,
+                                             '--workers', '1']), 1)
+
+    def test_incremental_offsets_and_partial_line(self):
+        self.append(self.json_line(1765000000.0, 77.0))
+        self.append(self.json_line(1765000001.0, 78.0)[:-20])
+        first = logingest.ingest(self.db, self.log)
+        self.assertEqual(first.points, 1)
+        self.assertEqual(first.bytes, len(self.json_line(1765000000.0, 77.0)))
+
+        # Дописанная строка читается с места предыдущего запуска
+        self.append(self.json_line(1765000001.0, 78.0)[-20:])
+        second = logingest.ingest(self.db, self.log)
+        self.assertEqual(second.points, 1)
+        self.assertEqual(logingest.ingest(self.db, self.log).bytes, 0)
+        self.assertEqual([value for _, value in self.history()], [77.0, 78.0])
+
+    def test_rotated_files_continue_from_offset(self):
+        self.append(self.json_line(1765000000.0, 77.0))
+        logingest.ingest(self.db, self.log)
+        self.append(self.json_line(1765000001.0, 78.0))
+        # Ротация: текущий файл сжат в .1.gz, новые записи - в новом файле
+        with open(self.log, 'rb') as f_in, gzip.open(self.log + '.1.gz', 'wb') as f_out:
+            f_out.write(f_in.read())
+        os.remove(self.log)
+        self.append(self.json_line(1765000002.0, 79.0))
+
+        self.assertEqual(logingest.log_files(self.log), [self.log + '.1.gz', self.log])
+        stats = logingest.ingest(self.db, self.log)
+        self.assertEqual((stats.files, stats.points), (2, 2))
+        self.assertEqual([value for _, value in self.history()], [77.0, 78.0, 79.0])
+        self.assertEqual(logingest.ingest(self.db, self.log).files, 0)
+
+    def test_rotated_file_marked_finished(self):
+        self.append(self.json_line(1765000000.0, 77.0))
+        with open(self.log, 'rb') as f_in, gzip.open(self.log + '.1.gz', 'wb') as f_out:
+            f_out.write(f_in.read())
+        os.remove(self.log)
+        logingest.ingest(self.db, self.log)
+        self.assertEqual(list(self.db.read_log_offsets().values()),
+                         [(len(self.json_line(1765000000.0, 77.0)), True)])
+        # Прочитанная сжатая копия больше не распаковывается
+        with patch.object(logingest, 'gzip_blocks') as gzip_blocks:
+            self.assertEqual(logingest.ingest(self.db, self.log).files, 0)
+        gzip_blocks.assert_not_called()
+
+    def test_parsed_blocks_are_bounded(self):
+        for i in range(50):
+            self.append(self.json_line(1765000000.0 + i, 70.0 + i))
+        tasks = logingest.plan(self.log, 'fp', 0, chunk_size=256)
+        in_flight = []
+
+        class Executor:
+            def submit(self, fn, *args):
+                in_flight.append(len(in_flight) - consumed[0] + 1)
+                future = MagicMock()
+                future.result.return_value = fn(*args)
+                return future
+
+        consumed = [0]
+        for _ in logingest._blocks(tasks, Executor(), 3):
+            consumed[0] += 1
+        self.assertEqual(consumed[0], len(tasks))
+        self.assertLessEqual(max(in_flight), 3)
+
+    def test_chunks_parsed_in_parallel(self):
+        for i in range(200):
+            self.append(self.json_line(1765000000.0 + i, 70.0 + i))
+        tasks = logingest.plan(self.log, 'fp', 0, chunk_size=4096)
+        self.assertGreater(len(tasks), 1)
+        self.assertEqual([task.start for task in tasks[1:]], [task.end for task in tasks[:-1]])
+
+        stats = logingest.ingest(self.db, self.log, workers=2, chunk_size=4096)
+        self.assertEqual(stats.bytes, os.path.getsize(self.log))
+        self.assertEqual([value for _, value in self.history()],
+                         [70.0 + i for i in range(200)])
+
+
+@unittest.skipIf(myapp.analytics is None, 'требуется NumPy')
+class TestAnalytics(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DatabaseController()
+        self.db.seed_initial_data()
+        self.addCleanup(self.db.close)
+        self.ids = {row['char_code']: row['id'] for row in self.db.read_currencies()}
+
+    def test_load_rate_matrix(self):
+        np = myapp.analytics.np
+        day = 86400
+        # USD: две точки в первый день; EUR появляется со второго дня;
+        # JPY котируется за 100 единиц
+        self.db.bulk_add_history([
+            (self.ids['USD'], 10 * day, 90.0, 1), (self.ids['USD'], 10 * day + 60, 91.0, 1),
+            (self.ids['USD'], 12 * day, 93.0, 1),
+            (self.ids['EUR'], 11 * day, 100.0, 1),
+            (self.ids['JPY'], 10 * day, 60.0, 100),
+        ])
+        matrix = myapp.analytics.load_rate_matrix(self.db, start=5 * day, end=13 * day)
+
+        self.assertEqual(matrix.ts.tolist(), [10 * day, 11 * day, 12 * day])
+        np.testing.assert_allclose(matrix.column('USD'), [91.0, 91.0, 93.0])
+        np.testing.assert_allclose(matrix.column('EUR'), [np.nan, 100.0, 100.0])
+        np.testing.assert_allclose(matrix.column('JPY'), [0.6, 0.6, 0.6])
+
+    def test_indicators(self):
+        analytics = myapp.analytics
+        np = analytics.np
+        values = np.array([[1.0, 2.0], [2.0, 4.0], [4.0, 8.0], [8.0, 16.0]])
+
+        np.testing.assert_allclose(analytics.moving_average(values, 2)[:, 0],
+                                   [np.nan, 1.5, 3.0, 6.0])
+        np.testing.assert_allclose(analytics.percent_change(values)[1:, 1], [100.0] * 3)
+        # Постоянная доходность - нулевая волатильность и полная корреляция
+        np.testing.assert_allclose(analytics.rolling_volatility(values, 2)[2:, 0], [0.0, 0.0],
+                                   atol=1e-12)
+        steps = np.array([[1.0, 1.0], [2.0, 3.0], [3.0, 2.0], [5.0, 4.0]])
+        np.testing.assert_allclose(analytics.correlation_matrix(steps).diagonal(), [1.0, 1.0])
+        self.assertEqual(analytics.to_json(np.array([1.5, np.nan])), [1.5, None])
+
+    def test_endpoints(self):
+        usd = myapp.currency_controller.get_currency_by_char_code('USD')
+        myapp.db_controller.bulk_add_history(
+            (int(usd.id), 1600000000 + i * 86400, 90.0 + i % 3, 1) for i in range(60))
+
+        summary = json.loads(myapp.app.respond(Request('GET', '/analytics?window=7')).body)
+        self.assertIn('USD', summary['currencies'])
+        series = json.loads(myapp.app.respond(
+            Request('GET', '/analytics/series?code=usd&window=7&end=2020-11-13')).body)
+        self.assertEqual(len(series['value']), len(series['ts']))
+        self.assertIsNone(series['moving_average'][0])
+        correlation = json.loads(myapp.app.respond(Request('GET', '/analytics/correlation')).body)
+        self.assertEqual(len(correlation['matrix']), len(correlation['codes']))
+
+        self.assertEqual(myapp.app.respond(Request('GET', '/analytics?window=1')).status, 400)
+        self.assertEqual(
+            myapp.app.respond(Request('GET', '/analytics/series?code=XYZ')).status, 404)
+
+
+@unittest.skipIf(myapp.cross_rates is None, 'требуется NumPy')
+class TestCrossRates(unittest.TestCase):
+
+    def setUp(self):
+        from conversion import CrossRates
+        self.db = DatabaseController()
+        self.db.seed_initial_data()
+        self.addCleanup(self.db.close)
+        self.engine = CrossRates()
+        self.engine.sync(self.db)
+
+    def test_nominal(self):
+        # JPY котируется за 100 единиц: 1 EUR = 98.2 / 0.0061 JPY
+        self.assertAlmostEqual(self.engine.rate('EUR', 'JPY'), 98.2 / 0.0061)
+        self.assertAlmostEqual(self.engine.rate('JPY', 'RUB'), 0.0061)
+        results, unknown = self.engine.convert(['EUR', 'RUB', 'XXX'], ['JPY', 'USD', 'USD'],
+                                               [100, 905, 1])
+        self.assertAlmostEqual(results[0], 100 * 98.2 / 0.0061)
+        self.assertAlmostEqual(results[1], 10.0)
+        self.assertEqual(unknown, ['XXX'])
+
+    def test_incremental_update(self):
+        self.db.bulk_update_values({'USD': 95.0})
+        self.assertTrue(self.engine.sync(self.db))
+        self.assertFalse(self.engine.sync(self.db))
+        self.assertEqual((self.engine.rebuilds, self.engine.updates), (1, 1))
+        rates = self.engine.unit_rates
+        myapp.np.testing.assert_allclose(self.engine.rates, rates[:, None] / rates[None, :])
+
+        # Новая валюта требует полной перестройки
+        self.db.bulk_upsert_currencies([{'num_code': '036', 'char_code': 'AUD',
+                                         'name': 'Австралийский доллар', 'value': 60.0,
+                                         'nominal': 1}])
+        self.engine.sync(self.db)
+        self.assertEqual(self.engine.rebuilds, 2)
+        self.assertAlmostEqual(self.engine.rate('AUD', 'USD'), 60.0 / 95.0)
+
+    def test_convert_endpoint(self):
+        single = json.loads(myapp.app.respond(
+            Request('GET', '/convert?from=usd&to=RUB&amount=2')).body)
+        self.assertAlmostEqual(single['result'], 2 * single['rate'])
+
+        body = json.dumps({'items': [['EUR', 'JPY', 1], ['USD', 'ZZZ', 1]]}).encode()
+        batch = json.loads(myapp.app.respond(Request('POST', '/convert', body=body)).body)
+        self.assertEqual(batch['unknown'], ['ZZZ'])
+        self.assertIsNone(batch['results'][1])
+
+        bad = myapp.app.respond(Request('POST', '/convert', body=b'[["EUR", "USD"]]'))
+        self.assertEqual(bad.status, 400)
+        missing = myapp.app.respond(Request('GET', '/convert?from=EUR&to=ZZZ'))
+        self.assertEqual(missing.status, 404)
+
+
+class TestJsonApi(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(myapp.refresher, 'on_demand', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        myapp.page_cache.clear()
+
+    def get(self, path):
+        response = myapp.app.respond(Request('GET', path))
+        return response.status, json.loads(response.body) if response.body else None
+
+    def test_currencies(self):
+        status, body = self.get('/api/v1/currencies')
+        self.assertEqual(status, 200)
+        self.assertEqual(body['data'], myapp.db_controller.read_currencies())
+        self.assertEqual(set(body['data'][0]),
+                         {'id', 'num_code', 'char_code', 'name', 'value', 'nominal'})
+
+        status, body = self.get('/api/v1/currencies/usd')
+        self.assertEqual(body['data']['char_code'], 'USD')
+        self.assertEqual(self.get('/api/v1/currencies/XYZ'), (404, {'error': 'Валюта не найдена'}))
+
+    def test_users_and_subscriptions(self):
+        _, users = self.get('/api/v1/users')
+        self.assertEqual(users['data'], myapp.db_controller.read_users())
+        _, subscriptions = self.get('/api/v1/subscriptions')
+        user_id = subscriptions['data'][0]['user_id']
+        _, currencies = self.get(f'/api/v1/users/{user_id}/subscriptions')
+        self.assertIn(subscriptions['data'][0]['currency_id'],
+                      [row['id'] for row in currencies['data']])
+        self.assertEqual(self.get('/api/v1/users/999/subscriptions')[0], 404)
+
+    def test_user_subscriptions_pages(self):
+        user_id = myapp.db_controller.create_user('Подписчик')
+        for currency in myapp.db_controller.read_currencies():
+            myapp.db_controller.add_user_subscription(user_id, currency['id'])
+        expected = [row['char_code'] for row in myapp.db_controller.read_currencies()]
+
+        codes, path = [], f'/api/v1/users/{user_id}/subscriptions?limit=2'
+        while path:
+            status, body = self.get(path)
+            self.assertEqual(status, 200)
+            self.assertLessEqual(len(body['data']), 2)
+            codes.extend(row['char_code'] for row in body['data'])
+            path = body['links']['next']
+        self.assertEqual(codes, expected)
+
+        status, body = self.get(f'/api/v1/users/{user_id}/subscriptions?limit=0')
+        self.assertEqual(status, 400)
+
+    def test_subscriptions_pages(self):
+        expected = myapp.db_controller.read_subscriptions()
+        self.assertGreater(len(expected), 1)
+        rows, path = [], '/api/v1/subscriptions?limit=1'
+        while path:
+            status, body = self.get(path)
+            self.assertEqual(status, 200)
+            self.assertEqual(len(body['data']), 1)
+            rows.extend(body['data'])
+            path = body['links']['next']
+        self.assertEqual(rows, expected)
+
+        _, body = self.get('/api/v1/subscriptions?limit=1&sort=-id')
+        self.assertEqual(body['data'], expected[-1:])
+        for query in ('limit=0', 'limit=x', 'sort=user_id', 'cursor=next:1'):
+            self.assertEqual(self.get(f'/api/v1/subscriptions?{query}')[0], 400)
+
+    def test_rates(self):
+        _, body = self.get('/api/v1/rates')
+        usd = myapp.db_controller.read_currencies('USD')[0]
+        self.assertEqual(body['data']['base'], 'RUB')
+        self.assertAlmostEqual(body['data']['rates']['USD'], usd['value'] / usd['nominal'])
+
+    def test_bytes_cached_per_version(self):
+        first = myapp.app.respond(Request('GET', '/api/v1/currencies'))
+        with patch.object(myapp.db_controller, 'read_currencies', side_effect=AssertionError):
+            second = myapp.app.respond(Request('GET', '/api/v1/currencies'))
+        self.assertIs(second.body, first.body)
+
+        currency = myapp.db_controller.read_currencies('EUR')[0]
+        myapp.db_controller.update_currency_value(currency['id'], currency['value'] + 1)
+        try:
+            _, body = self.get('/api/v1/currencies/EUR')
+            self.assertEqual(body['data']['value'], currency['value'] + 1)
+        finally:
+            myapp.db_controller.update_currency_value(currency['id'], currency['value'])
+
+    def test_show_redirects(self):
+        response = myapp.app.respond(Request('GET', '/currency/show'))
+        self.assertEqual(response.status, 301)
+        self.assertIn(('Location', '/api/v1/currencies'), response.headers)
+
+    def test_dumps_fallback(self):
+        with patch('routing.orjson', None):
+            self.assertEqual(routing.dumps({'a': [1, 'б'], 2: None}),
+                             '{"a":[1,"б"],"2":null}'.encode('utf-8'))
+
+
+class TestPageCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = PageCache(max_entries=2)
+        for key in ('a', 'b'):
+            cache.put(key, Response(key.encode()))
+        cache.get('a')
+        cache.put('c', Response(b'c'))
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a').body, b'a')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_memory_budget(self):
+        cache = PageCache(max_bytes=10)
+        cache.put('big', Response(b'x' * 20))
+        cache.put('a', Response(b'x' * 6))
+        cache.put('b', Response(b'x' * 6))
+
+        self.assertIsNone(cache.get('big'))
+        self.assertIsNone(cache.get('a'))
+        self.assertLessEqual(cache.stats()['bytes'], 10)
+
+    def test_application_cache_invalidated_on_write(self):
+        myapp.page_cache.clear()
+        first = myapp.app.respond(Request('GET', '/users'))
+        with patch.object(myapp.user_controller, 'list_users') as list_users:
+            second = myapp.app.respond(Request('GET', '/users'))
+        list_users.assert_not_called()
+        self.assertEqual(first.body, second.body)
+
+        myapp.user_controller.create_user('Новый пользователь')
+        third = myapp.app.respond(Request('GET', '/users'))
+        self.assertIn('Новый пользователь', third.body.decode('utf-8'))
+
+
+class TestConditionalGet(unittest.TestCase):
+
+    def _get(self, path, **headers):
+        return myapp.app.respond(Request('GET', path, headers))
+
+    def _header(self, response, name):
+        return dict(response.headers).get(name)
+
+    def test_if_none_match(self):
+        first = self._get('/users')
+        etag = self._header(first, 'ETag')
+        self.assertIsNotNone(etag)
+
+        with patch.object(myapp.user_controller, 'list_users') as list_users:
+            second = self._get('/users', **{'If-None-Match': etag})
+        list_users.assert_not_called()
+        self.assertEqual(second.status, 304)
+        self.assertEqual(second.body, b'')
+
+        # После изменения данных ETag меняется
+        myapp.user_controller.create_user('Пётр')
+        third = self._get('/users', **{'If-None-Match': etag})
+        self.assertEqual(third.status, 200)
+        self.assertNotEqual(self._header(third, 'ETag'), etag)
+
+    def test_if_modified_since(self):
+        first = self._get('/currencies/admin')
+        last_modified = self._header(first, 'Last-Modified')
+        self.assertIsNotNone(last_modified)
+
+        second = self._get('/currencies/admin', **{'If-Modified-Since': last_modified})
+        self.assertEqual(second.status, 304)
+        stale = self._get('/currencies/admin',
+                          **{'If-Modified-Since': 'Mon, 01 Jan 2001 00:00:00 GMT'})
+        self.assertEqual(stale.status, 200)
+
+    def test_currencies_not_modified(self):
+        rates = {'USD': 90.0, 'EUR': 99.0, 'GBP': 111.0, 'JPY': 0.6}
+        with patch('myapp.get_currencies', return_value=rates), \
+                patch.object(myapp.refresher, 'on_demand', False):
+            myapp.refresher.refresh()
+            first = self._get('/currencies')
+            second = self._get('/currencies', **{'If-None-Match': self._header(first, 'ETag')})
+        self.assertEqual(first.status, 200)
+        self.assertEqual(second.status, 304)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_threads_are_summed(self):
+        metrics = Metrics(buckets=(0.1, 1.0))
+        metrics.describe('jobs_total', 'counter', 'Задания')
+
+        def work():
+            for _ in range(100):
+                metrics.inc('jobs_total', (('kind', 'a'),))
+            metrics.observe('job_seconds', (), 0.5)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        del thread, threads
+        metrics.inc('jobs_total', (('kind', 'a'),))
+
+        text = metrics.render()
+        self.assertIn('# TYPE jobs_total counter', text)
+        self.assertIn('jobs_total{kind="a"} 401', text)
+        self.assertIn('job_seconds_bucket{le="0.1"} 0', text)
+        self.assertIn('job_seconds_bucket{le="1"} 4', text)
+        self.assertIn('job_seconds_bucket{le="+Inf"} 4', text)
+        self.assertIn('job_seconds_count 4', text)
+        # Наборы завершившихся потоков слиты в общий
+        self.assertEqual(len(metrics._shards), 1)
+
+    def test_disabled(self):
+        metrics = Metrics()
+        metrics.enabled = False
+        metrics.inc('jobs_total')
+        metrics.request('GET').finish(Response(b''))
+        self.assertEqual(metrics.snapshot(), ({}, {}))
+
+    def test_application_records_requests(self):
+        metrics = Metrics()
+        with patch.object(myapp.app, 'metrics', metrics):
+            myapp.app.respond(Request('GET', '/user/1'))
+            myapp.app.respond(Request('GET', '/user/999'))
+            myapp.app.respond(Request('GET', '/missing'))
+        counters, histograms = metrics.snapshot()
+
+        def total(route, status):
+            return counters.get(('http_requests_total', (('route', route), ('method', 'GET'),
+                                                         ('status', status))))
+        self.assertEqual(total('/user/{id:int}', '200'), 1)
+        self.assertEqual(total('/user/{id:int}', '404'), 1)
+        self.assertEqual(total('unmatched', '404'), 1)
+        self.assertEqual(counters[('http_requests_in_flight', ())], 0)
+        for phase in ('db', 'render'):
+            buckets = histograms[('http_request_phase_seconds',
+                                  (('route', '/user/{id:int}'), ('phase', phase)))]
+            self.assertEqual(sum(buckets[:-1]), 2)
+
+    def test_streamed_response_finishes_after_body(self):
+        metrics = Metrics()
+        myapp.page_cache.clear()
+        with patch.object(myapp.app, 'metrics', metrics), patch.object(myapp.app, 'stream', True):
+            response = myapp.app.respond(Request('GET', '/users'))
+            self.assertEqual(metrics.snapshot()[0][('http_requests_in_flight', ())], 1)
+            b''.join(response.chunks)
+        counters, histograms = metrics.snapshot()
+        self.assertEqual(counters[('http_requests_in_flight', ())], 0)
+        self.assertIn(('http_request_phase_seconds', (('route', '/users'), ('phase', 'render'))),
+                      histograms)
+
+    def test_metrics_endpoint(self):
+        with patch('myapp.get_currencies', side_effect=ConnectionError('API недоступен')):
+            with self.assertRaises(ConnectionError):
+                myapp.fetch_rates()
+        response = myapp.app.respond(Request('GET', '/metrics'))
+        self.assertIn(('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+                      response.headers)
+        text = response.body.decode('utf-8')
+        self.assertRegex(text, r'cbr_fetches_total\{outcome="ConnectionError"\} [1-9]')
+        self.assertIn('cache_hit_ratio{cache="page"}', text)
+        self.assertIn('http_requests_in_flight 1', text)
+
+
+class TestRateRefresher(unittest.TestCase):
+
+    def test_concurrent_refreshes_coalesced(self):
+        started = threading.Event()
+        release = threading.Event()
+        applied = []
+
+        def fetch():
+            started.set()
+            release.wait(5)
+            return {'USD': 90.0}
+
+        refresher = RateRefresher(fetch, applied.append, interval=60)
+        leader = threading.Thread(target=refresher.refresh)
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=refresher.refresh) for _ in range(5)]
+        for thread in followers:
+            thread.start()
+        self.assertFalse(refresher.trigger())
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+
+        self.assertEqual(refresher.fetches, 1)
+        self.assertEqual(applied, [{'USD': 90.0}])
+        self.assertEqual(refresher.coalesced, 6)
+        self.assertFalse(refresher.is_stale())
+
+    def test_failure_keeps_stale_data(self):
+        refresher = RateRefresher(MagicMock(side_effect=ConnectionError('API недоступен')),
+                                  MagicMock(), interval=60)
+        self.assertEqual(refresher.refresh(), 'API недоступен')
+        status = refresher.status()
+        self.assertIsNone(status['last_success'])
+        self.assertIsNotNone(status['last_failure'])
+        self.assertTrue(status['stale'])
+        self.assertEqual(refresher.error, 'API недоступен')
+
+        refresher.fetch = MagicMock(return_value={})
+        self.assertIsNone(refresher.refresh())
+        self.assertIsNone(refresher.error)
+        self.assertLess(refresher.status()['age'], 1)
+
+    def test_stale_data_is_applied_as_failure(self):
+        from lab7 import StaleDataError
+
+        applied = []
+        refresher = RateRefresher(
+            MagicMock(side_effect=StaleDataError('API недоступен', {'USD': 90.0}, 1.0)),
+            applied.append, interval=60)
+        self.assertEqual(refresher.refresh(), 'API недоступен')
+        self.assertEqual(applied, [{'USD': 90.0}])
+        self.assertIsNone(refresher.last_success)
+        self.assertEqual(refresher.failures, 1)
+        self.assertTrue(refresher.is_stale())
+
+    def test_failure_backoff(self):
+        fetch = MagicMock(side_effect=ConnectionError('API недоступен'))
+        refresher = RateRefresher(fetch, MagicMock(), interval=60, retry_delay=10)
+        refresher.refresh()
+        self.assertTrue(refresher.is_stale())
+        self.assertFalse(refresher.maybe_refresh())
+        self.assertGreater(refresher.retry_in(), 9)
+
+        refresher.refresh()
+        self.assertGreater(refresher.retry_in(), 19)
+        for _ in range(5):
+            refresher.refresh()
+        self.assertLessEqual(refresher.retry_in(), 60)
+        self.assertEqual(fetch.call_count, 7)
+
+        refresher.last_failure -= 60
+        self.assertEqual(refresher.retry_in(), 0)
+        refresher.fetch = MagicMock(return_value={})
+        refresher.refresh()
+        self.assertEqual(refresher.consecutive_failures, 0)
+        self.assertEqual(refresher.retry_in(), 0)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'нужен os.fork()')
+    def test_follower_process_reads_leader_result(self):
+        fetch = MagicMock(return_value={'USD': 90.0})
+        refresher = RateRefresher(fetch, MagicMock(), interval=60)
+        refresher.share()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                refresher.follow()
+                # Ждём, пока ведущий обновит курсы
+                deadline = time.monotonic() + 5
+                while refresher.last_success is None and time.monotonic() < deadline:
+                    self.assertFalse(refresher.maybe_refresh())
+                    time.sleep(0.01)
+                code = 0 if refresher.last_success and fetch.call_count == 0 else 2
+            finally:
+                os._exit(code)
+        self.assertIsNone(refresher.refresh())
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(fetch.call_count, 1)
+
+    def test_jitter_bounds(self):
+        refresher = RateRefresher(dict, MagicMock(), interval=100, jitter=0.2)
+        delays = [refresher.next_delay() for _ in range(100)]
+        self.assertTrue(all(80 <= delay <= 120 for delay in delays))
+
+    def test_page_does_not_wait_for_upstream(self):
+        release = threading.Event()
+
+        def slow_rates(codes):
+            release.wait(5)
+            return {}
+
+        with patch('myapp.get_currencies', side_effect=slow_rates), \
+                patch.object(myapp.refresher, 'last_success', None):
+            started = time.perf_counter()
+            response = myapp.app.respond(Request('GET', '/currencies'))
+            elapsed = time.perf_counter() - started
+            status = json.loads(myapp.app.respond(Request('GET', '/currencies/status')).body)
+            release.set()
+            while myapp.refresher.status()['refreshing']:
+                time.sleep(0.01)
+
+        self.assertEqual(response.status, 200)
+        self.assertLess(elapsed, 1)
+        self.assertTrue(status['refreshing'])
+
+
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(myapp.app, 'stream', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        myapp.page_cache.clear()
+
+    def test_chunked_over_keep_alive(self):
+        httpd = ThreadPoolHTTPServer(('127.0.0.1', 0), QuietAppHandler, workers=1)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+
+        expected = myapp.env.get_template('users.html').render(
+            **dict(myapp.BASE_CONTEXT, users=myapp.user_controller.list_users(),
+                   subscriptions=myapp.user_controller.subscription_loader()))
+        hits = myapp.page_cache.hits
+        conn = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1], timeout=5)
+        for _ in range(2):
+            conn.request('GET', '/users')
+            response = conn.getresponse()
+            body = response.read().decode('utf-8')
+            self.assertEqual(body, expected)
+            self.assertFalse(response.will_close)
+        conn.close()
+        # Первый ответ шёл потоком, второй взят из кэша целиком
+        self.assertEqual(myapp.page_cache.hits, hits + 1)
+
+    def test_large_stream_is_not_cached(self):
+        def read(request):
+            response = myapp.app.respond(request)
+            return b''.join(response.chunks) if response.chunks is not None else response.body
+
+        body = read(Request('GET', '/users'))
+        self.assertEqual(myapp.page_cache.stats()['entries'], 1)
+
+        myapp.page_cache.clear()
+        with patch.object(myapp.page_cache, 'max_entry_bytes', len(body) - 1):
+            self.assertEqual(read(Request('GET', '/users')), body)
+            self.assertEqual(myapp.page_cache.stats()['entries'], 0)
+
+    def _async_exchange(self, raw_request):
+        async def scenario():
+            server = AsyncHTTPServer(myapp.app, workers=1)
+            listener = await asyncio.start_server(server.handle_connection, '127.0.0.1', 0)
+            port = listener.sockets[0].getsockname()[1]
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(raw_request)
+                data = await asyncio.wait_for(reader.read(), 5)
+                writer.close()
+                return data
+            finally:
+                listener.close()
+                server.close()
+
+        return asyncio.run(scenario()).partition(b'\r\n\r\n')[::2]
+
+    def test_chunked_async(self):
+        head, body = self._async_exchange(
+            b'GET /author HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+        self.assertIn(b'Transfer-Encoding: chunked', head)
+        self.assertTrue(body.endswith(b'0\r\n\r\n'))
+        self.assertIn(b'Kamila', body)
+
+    def test_async_http10_gets_plain_body(self):
+        # Клиент просит keep-alive, но тело без длины заканчивается закрытием
+        head, body = self._async_exchange(
+            b'GET /author HTTP/1.0\r\nConnection: keep-alive\r\n\r\n')
+        self.assertNotIn(b'chunked', head)
+        self.assertIn(b'Connection: close', head)
+        self.assertTrue(body.rstrip().endswith(b'</html>'))
+        self.assertIn(b'Kamila', body)
 
 
 if __name__ == '__main__':